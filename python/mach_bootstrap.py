@@ -4,10 +4,14 @@
 
 from __future__ import print_function, unicode_literals
 
+import atexit
+import hashlib
+import json
 import os
 import platform
 import subprocess
 import sys
+import time
 from distutils.spawn import find_executable
 from pipes import quote
 
@@ -17,10 +21,29 @@ SEARCH_PATHS = [
 # Individual files providing mach commands.
 MACH_MODULES = [
     os.path.join('python', 'vaani', 'bootstrap_commands.py'),
-    os.path.join('python', 'vaani', 'build_commands.py')
+    os.path.join('python', 'vaani', 'env_commands.py'),
+    os.path.join('python', 'vaani', 'build_commands.py'),
+    os.path.join('python', 'vaani', 'bench_commands.py'),
+    os.path.join('python', 'vaani', 'workspace_commands.py'),
 ]
 
 
+# Global mach options that take a value, to find the command in argv
+GLOBAL_OPTIONS_WITH_VALUE = ['-l', '--log-file', '--settings', '--profile']
+
+# The outcome of bootstrapping the virtualenv and the index of the commands
+# each module in MACH_MODULES provides, kept in the virtualenv so that mach
+# can skip both on later runs
+STATE_PATH = os.path.join('python', '_virtualenv', '.vaani-mach-state.json')
+
+REQUIREMENTS_PATHS = [
+    os.path.join("python", "requirements.txt")
+]
+# Hash of the requirements installed in the virtualenv
+REQUIREMENTS_MARKER = 'requirements.sha1'
+# Wheels of the requirements, shared by all virtualenvs of the workspace
+WHEELHOUSE_PATH = os.path.join('shared', 'cache', 'wheelhouse')
+
 CATEGORIES = {
     'bootstrap': {
         'short': 'Bootstrap Commands',
@@ -31,7 +54,12 @@ CATEGORIES = {
         'short': 'Build Commands',
         'long': 'Interact with the build system',
         'priority': 80,
-    }
+    },
+    'testing': {
+        'short': 'Testing Commands',
+        'long': 'Run tests and benchmarks',
+        'priority': 60,
+    },
 }
 
 
@@ -56,14 +84,98 @@ VIRTUALENV_NAMES = ["virtualenv-2.7", "virtualenv2.7", "virtualenv2", "virtualen
 PIP_NAMES = ["pip-2.7", "pip2.7", "pip2", "pip"]
 
 
+def _requirements_hash(topdir):
+    digest = hashlib.sha1()
+    for req_rel_path in REQUIREMENTS_PATHS:
+        digest.update(req_rel_path.encode('utf-8') + b'\0')
+        try:
+            with open(os.path.join(topdir, req_rel_path), 'rb') as f:
+                digest.update(f.read())
+        except IOError:
+            pass
+    return digest.hexdigest()
+
+
+def _state_key(topdir):
+    """Hash of what the virtualenv depends on: the interpreter and the
+    requirements."""
+    digest = hashlib.sha1()
+    digest.update(sys.executable.encode('utf-8'))
+    digest.update(sys.version.encode('utf-8'))
+    digest.update(_requirements_hash(topdir))
+    return digest.hexdigest()
+
+
+def _load_state(state_path, key):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if state.get('key') != key:
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    tmp_path = state_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, state_path)
+    except (IOError, OSError):
+        # Only a cache; mach bootstraps again next time
+        pass
+
+
+def _pip(pip, args):
+    process = subprocess.Popen(
+        [pip] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    error = process.communicate()[1]
+    return process.returncode, error
+
+
+def _install_requirements(pip, req_paths, wheelhouse):
+    """Install all requirements files with a single pip invocation, so pip
+    sees conflicts between them.
+
+    Packages come from the wheelhouse when it has them all, which works
+    offline. Otherwise the missing wheels are built into it first, and if
+    even that fails, pip installs from the index directly."""
+    req_args = []
+    for req_path in req_paths:
+        req_args += ["-r", req_path]
+    offline = ["install", "-q", "--no-index", "--find-links", wheelhouse] + req_args
+    if os.path.isdir(wheelhouse) and _pip(pip, offline)[0] == 0:
+        return
+    if (_pip(pip, ["wheel", "-q", "--wheel-dir", wheelhouse] + req_args)[0] == 0 and
+            _pip(pip, offline)[0] == 0):
+        return
+    returncode, error = _pip(pip, ["install", "-q"] + req_args)
+    if returncode:
+        sys.exit("Pip failed to execute properly: {}".format(error))
+
+
 def _activate_virtualenv(topdir):
+    """Create and activate the virtualenv, install the requirements and
+    return the bootstrap state."""
     virtualenv_path = os.path.join(topdir, "python", "_virtualenv")
+    script_dir = _get_virtualenv_script_dir()
+    activate_path = os.path.join(virtualenv_path, script_dir, "activate_this.py")
+    state_path = os.path.join(topdir, STATE_PATH)
+    key = _state_key(topdir)
+
+    state = _load_state(state_path, key)
+    if state is not None and os.path.exists(activate_path):
+        execfile(activate_path, dict(__file__=quote(activate_path)))
+        return state
+
     python = _get_exec(*PYTHON_NAMES)
     if python is None:
         sys.exit("Python is not installed. Please install it prior to running mach.")
 
-    script_dir = _get_virtualenv_script_dir()
-    activate_path = os.path.join(virtualenv_path, script_dir, "activate_this.py")
     if not (os.path.exists(virtualenv_path) and os.path.exists(activate_path)):
         virtualenv = _get_exec(*VIRTUALENV_NAMES)
         if virtualenv is None:
@@ -80,42 +192,130 @@ def _activate_virtualenv(topdir):
 
     execfile(activate_path, dict(__file__=quote(activate_path)))
 
-    # TODO: Right now, we iteratively install all the requirements by invoking
-    # `pip install` each time. If it were the case that there were conflicting
-    # requirements, we wouldn't know about them. Once
-    # https://github.com/pypa/pip/issues/988 is addressed, then we can just
-    # chain each of the requirements files into the same `pip install` call
-    # and it will check for conflicts.
-    requirements_paths = [
-        os.path.join("python", "requirements.txt")
-    ]
-    for req_rel_path in requirements_paths:
-        req_path = os.path.join(topdir, req_rel_path)
-        marker_file = req_rel_path.replace(os.path.sep, '-')
-        marker_path = os.path.join(virtualenv_path, marker_file)
-        try:
-            if os.path.getmtime(req_path) + 10 < os.path.getmtime(marker_path):
-                continue
-        except OSError:
-            pass
-
+    # The requirements are installed when their content changed, not their
+    # mtime, which checkouts and copies don't preserve
+    marker_path = os.path.join(virtualenv_path, REQUIREMENTS_MARKER)
+    requirements_hash = _requirements_hash(topdir)
+    try:
+        with open(marker_path) as f:
+            installed = f.read().strip() == requirements_hash
+    except IOError:
+        installed = False
+    if not installed:
         pip = _get_exec(*PIP_NAMES)
         if pip is None:
             sys.exit("Python pip is not installed. Please install it prior to running mach.")
-
-        process = subprocess.Popen(
-            [pip, "install", "-q", "-r", req_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        process.wait()
-        if process.returncode:
-            sys.exit("Pip failed to execute properly: {}"
-                     .format(process.communicate()[1]))
-
-        open(marker_path, 'w').close()
+        _install_requirements(pip, [os.path.join(topdir, req_rel_path)
+                                    for req_rel_path in REQUIREMENTS_PATHS],
+                              os.path.join(topdir, WHEELHOUSE_PATH))
+        with open(marker_path, 'w') as f:
+            f.write(requirements_hash)
+
+    state = {'key': key}
+    _save_state(state_path, state)
+    return state
+
+
+def _command_name(argv):
+    """The command mach is asked to run, or None."""
+    args = iter(argv)
+    for arg in args:
+        if arg in GLOBAL_OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
 
 
-def bootstrap(topdir):
+def _profile_options(argv):
+    """The trace file --profile asks for, or None, and whether
+    --profile-python was given. Tracing starts before mach parses its
+    arguments, to also cover the virtualenv and the loading of commands."""
+    output = None
+    python_profile = False
+    args = iter(argv)
+    for arg in args:
+        if arg == '--profile':
+            output = next(args, None)
+        elif arg.startswith('--profile='):
+            output = arg.split('=', 1)[1]
+        elif arg == '--profile-python':
+            python_profile = True
+        elif arg in GLOBAL_OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            # Global options come before the command
+            break
+    return output, python_profile
+
+
+def _span(name, start):
+    """Record a span of the bootstrap from `start` until now, if mach is
+    profiling."""
+    trace = sys.modules.get('vaani.trace')
+    if trace is not None:
+        trace.complete(name, 'bootstrap', start, time.time())
+
+
+class CommandLoader(object):
+    """Load the modules in MACH_MODULES on demand.
+
+    The index of which module provides which command is kept in the
+    bootstrap state, along with the mtimes of the modules it was made from,
+    so a command only costs loading its own module."""
+
+    def __init__(self, mach, topdir, state):
+        self.mach = mach
+        self.topdir = topdir
+        self.state = state
+        self.loaded = set()
+        self.mtimes = {}
+        for rel_path in MACH_MODULES:
+            try:
+                self.mtimes[rel_path] = os.path.getmtime(os.path.join(topdir, rel_path))
+            except OSError:
+                self.mtimes[rel_path] = None
+        commands = state.get('commands', {})
+        if commands.get('mtimes') == self.mtimes:
+            self.index = commands['index']
+        else:
+            self.index = None
+
+    def _load_module(self, rel_path):
+        if rel_path not in self.loaded:
+            self.loaded.add(rel_path)
+            start = time.time()
+            self.mach.load_commands_from_file(os.path.join(self.topdir, rel_path))
+            _span('load ' + os.path.basename(rel_path), start)
+
+    def load_all(self):
+        from mach.registrar import Registrar
+
+        index = {}
+        for rel_path in MACH_MODULES:
+            before = set(Registrar.command_handlers)
+            self._load_module(rel_path)
+            for name in set(Registrar.command_handlers) - before:
+                index[name] = rel_path
+        if self.index is None:
+            self.index = index
+            return True
+        return False
+
+    def load(self, name):
+        """Load the module providing command `name`, or all modules if the
+        index doesn't know it. Returns whether the index was rebuilt."""
+        if self.index is not None and name in self.index:
+            self._load_module(self.index[name])
+            return False
+        return self.load_all()
+
+    def save(self):
+        self.state['commands'] = {'mtimes': self.mtimes, 'index': self.index}
+        _save_state(os.path.join(self.topdir, STATE_PATH), self.state)
+
+
+def bootstrap(topdir, argv=None):
     topdir = os.path.abspath(topdir)
 
     # We don't support paths with Unicode characters for now
@@ -140,25 +340,63 @@ def bootstrap(topdir):
         print('You are running Python', platform.python_version())
         sys.exit(1)
 
-    _activate_virtualenv(topdir)
+    argv = sys.argv[1:] if argv is None else argv
+    trace_path, python_profile = _profile_options(argv)
+
+    start = time.time()
+    state = _activate_virtualenv(topdir)
+    if trace_path:
+        from vaani import trace
+        trace.start(trace_path, start_time=start, python_profile=python_profile)
+        atexit.register(trace.finish)
+        _span('activate virtualenv', start)
+
+    start = time.time()
+    sys.path[0:0] = [os.path.join(topdir, path) for path in SEARCH_PATHS]
+    import mach.main
+    mach = mach.main.Mach(os.getcwd())
+    _span('import mach', start)
+    loader = CommandLoader(mach, topdir, state)
 
     def populate_context(context, key=None):
         if key is None:
             return
         if key == 'topdir':
             return topdir
+        if key == 'command_loader':
+            return loader
+        # Spans of the commands run, including those dispatched by others.
+        # Mach skips the post-dispatch handler of a command that raised or
+        # exited; trace.finish ends its span when mach exits.
+        if key == 'pre_dispatch_handler' and trace_path:
+            return lambda context, handler, args: trace.begin(
+                'mach ' + handler.name, 'command',
+                **dict((name, unicode(value)) for name, value in args.items()))
+        if key == 'post_dispatch_handler' and trace_path:
+            return lambda context, handler, args: trace.end('mach ' + handler.name, 'command')
         raise AttributeError(key)
 
-    sys.path[0:0] = [os.path.join(topdir, path) for path in SEARCH_PATHS]
-    import mach.main
-    mach = mach.main.Mach(os.getcwd())
     mach.populate_context_handler = populate_context
+    mach.add_global_argument('--profile', dest='profile_trace', metavar='FILENAME',
+                             help='Write a Chrome trace of where the time goes, '
+                                  'for chrome://tracing or ui.perfetto.dev, to FILENAME.')
+    mach.add_global_argument('--profile-python', dest='profile_python', action='store_true',
+                             help='With --profile, also profile the Python code of mach with '
+                                  'cProfile, written to FILENAME.pstats.')
 
     for category, meta in CATEGORIES.items():
         mach.define_category(category, meta['short'], meta['long'],
                              meta['priority'])
 
-    for path in MACH_MODULES:
-        mach.load_commands_from_file(os.path.join(topdir, path))
+    start = time.time()
+    command = _command_name(argv)
+    # help and mach's suggestions for mistyped commands need all commands
+    if command is None or command == 'help':
+        rebuilt = loader.load_all()
+    else:
+        rebuilt = loader.load(command)
+    if rebuilt:
+        loader.save()
+    _span('load commands', start)
 
     return mach
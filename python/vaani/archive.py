@@ -0,0 +1,315 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import httplib
+import os
+import os.path as path
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import urllib2
+
+from vaani.download import (
+    ChunkSizer,
+    Progress,
+    cached,
+    download_file,
+    fetch_checksum,
+    format_size,
+    validators,
+    DEFAULT_CONNECTIONS,
+    DEFAULT_TTL,
+)
+from vaani import trace
+from vaani.locks import FileLock
+from vaani.parallel import WorkerPool
+
+# Connection drops a streaming download reconnects after before giving up
+STREAM_RETRIES = 3
+
+
+def _member_path(dst, member):
+    target = path.normpath(path.join(dst, member.name))
+    if not (target + os.sep).startswith(path.normpath(dst) + os.sep):
+        raise tarfile.ExtractError("Refusing to extract %s outside of %s" % (member.name, dst))
+    return target
+
+
+def _unchanged(target, member, data, compare):
+    try:
+        st = os.stat(target)
+    except OSError:
+        return False
+    if st.st_size != member.size:
+        return False
+    if compare == "hash":
+        with open(target, "rb") as f:
+            return hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest()
+    return int(st.st_mtime) == int(member.mtime)
+
+
+def _write_member(target, member, data, compare, stats, current=None):
+    if _unchanged(current or target, member, data, compare):
+        stats.count("unchanged", 0)
+        return
+    tmp_path = "%s.tmp%d" % (target, threading.current_thread().ident)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.chmod(tmp_path, member.mode & 0o777)
+    os.utime(tmp_path, (member.mtime, member.mtime))
+    os.rename(tmp_path, target)
+    stats.count("written", len(data))
+
+
+class ExtractStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {"written": 0, "unchanged": 0}
+        self.bytes = 0
+
+    def count(self, kind, size):
+        with self.lock:
+            self.files[kind] += 1
+            self.bytes += size
+
+
+@trace.traced("disk", "dst")
+def extract_members(tar, dst, jobs=None, compare="mtime", current_dir=None):
+    """Extract `tar` into `dst`, writing only the files that are missing or
+    differ from what is on disk, either by size and mtime or, with
+    compare="hash", by content. With `current_dir`, the files are compared
+    with those there instead, so that only what differs from it is written.
+
+    Members are read in archive order, which also works for streams, while
+    the files are written by a pool of worker threads."""
+    stats = ExtractStats()
+    pool = WorkerPool(jobs)
+    directories = []
+    try:
+        for member in tar:
+            target = _member_path(dst, member)
+            current = _member_path(current_dir, member) if current_dir else None
+            if member.isdir():
+                if not path.isdir(target):
+                    os.makedirs(target)
+                directories.append((target, member))
+            elif member.isfile():
+                parent = path.dirname(target)
+                if not path.isdir(parent):
+                    os.makedirs(parent)
+                data = tar.extractfile(member).read()
+                pool.submit(_write_member, target, member, data, compare, stats, current)
+            else:
+                # Links and special files are rare; let tarfile handle them
+                tar.extract(member, dst)
+    finally:
+        errors = pool.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    for target, member in directories:
+        os.chmod(target, member.mode & 0o777 | 0o700)
+    return stats
+
+
+def _extract_incremental(tar, dst, jobs, compare, current_dir=None):
+    stats = extract_members(tar, dst, jobs, compare, current_dir)
+    print("%d files written (%s), %d unchanged."
+          % (stats.files["written"], format_size(stats.bytes), stats.files["unchanged"]))
+
+
+@trace.traced("disk", "src")
+def extract(src, dst, movedir=None, incremental=False, jobs=None, compare="mtime"):
+    if incremental:
+        _extract_incremental(tarfile.open(src), dst, jobs, compare)
+    else:
+        tarfile.open(src).extractall(dst)
+
+    if movedir:
+        for f in os.listdir(movedir):
+            frm = path.join(movedir, f)
+            to = path.join(dst, f)
+            os.rename(frm, to)
+        os.rmdir(movedir)
+
+    os.remove(src)
+
+
+def _move_into(src_dir, dst_dir):
+    """Move the contents of `src_dir` into `dst_dir`, replacing what is
+    there by the same name, but for directories, whose contents are moved
+    in turn."""
+    for name in os.listdir(src_dir):
+        src = path.join(src_dir, name)
+        dst = path.join(dst_dir, name)
+        if path.isdir(dst) and not path.islink(dst):
+            if path.isdir(src) and not path.islink(src):
+                _move_into(src, dst)
+                continue
+            shutil.rmtree(dst)
+        os.rename(src, dst)
+
+
+class StreamInterrupted(Exception):
+    pass
+
+
+class ResumingReader(object):
+    """File-like view of an HTTP download.
+
+    When the connection drops, reading continues through a Range request
+    from the current position, so a consumer such as a streaming tar
+    reader does not notice. Everything read is hashed with `algorithm`
+    and copied to `tee` if given."""
+
+    def __init__(self, desc, url, algorithm=None, tee=None):
+        self.url = url
+        self.pos = 0
+        self.retries = STREAM_RETRIES
+        self.tee = tee
+        self.digest = hashlib.new(algorithm) if algorithm else None
+        self.resp = urllib2.urlopen(url)
+        # Of the first response; those of resumed ones are partial
+        self.headers = self.resp.info()
+        length = self.resp.info().getheader('Content-Length')
+        self.total = int(length.strip()) if length else None
+        self.progress = Progress(desc, self.total)
+        self.sizer = ChunkSizer()
+
+    def _reconnect(self):
+        if not self.retries or self.total is None:
+            raise StreamInterrupted()
+        self.retries -= 1
+        try:
+            self.resp = urllib2.urlopen(urllib2.Request(
+                self.url, headers={'Range': 'bytes=%d-' % self.pos}))
+        except (urllib2.URLError, socket.error):
+            raise StreamInterrupted()
+        if self.resp.getcode() != 206:
+            raise StreamInterrupted()
+
+    def read(self, size=-1):
+        while True:
+            try:
+                if size is None or size < 0:
+                    chunk = self.resp.read()
+                else:
+                    chunk = self.sizer.read(self.resp, size)
+            except (socket.error, httplib.HTTPException):
+                self._reconnect()
+                continue
+            if not chunk and self.total is not None and self.pos < self.total:
+                # Closed before the announced length
+                self._reconnect()
+                continue
+            break
+        self.pos += len(chunk)
+        if self.digest:
+            self.digest.update(chunk)
+        if self.tee:
+            self.tee.write(chunk)
+        self.progress.update(len(chunk))
+        return chunk
+
+    def drain(self):
+        # A tar reader stops at the end-of-archive marker, before the
+        # padding and the gzip trailer
+        while self.read(1024 * 1024):
+            pass
+        self.progress.finish()
+
+    @property
+    def complete(self):
+        return self.total is None or self.pos == self.total
+
+
+@trace.traced("network", "desc")
+def stream_extract(desc, src, tgz_file, dst, checksum_url=None,
+                   connections=DEFAULT_CONNECTIONS, cache=None, incremental=False, jobs=None,
+                   compare="mtime", ttl=DEFAULT_TTL):
+    """Download the tarball at `src` and extract it into `dst` while it is
+    being downloaded.
+
+    The tarball only touches the disk when it goes into the cache, where it
+    is written as it streams by. If the stream can't be resumed after the
+    connection dropped, fall back to a resumable download to `tgz_file`
+    followed by a regular extraction."""
+    # Like download_file, which it may fall back to
+    with FileLock(tgz_file + ".lock", "Waiting for another process downloading %s..." % desc):
+        _stream_extract(desc, src, tgz_file, dst, checksum_url, connections, cache, incremental,
+                        jobs, compare, ttl)
+
+
+def _stream_extract(desc, src, tgz_file, dst, checksum_url, connections, cache, incremental, jobs,
+                    compare, ttl):
+    if cache is not None:
+        blob = cached(desc, src, cache, ttl)
+        if blob is not None:
+            print("Using cached %s." % desc)
+            if incremental:
+                _extract_incremental(tarfile.open(blob), dst, jobs, compare)
+            else:
+                tarfile.open(blob).extractall(dst)
+            return
+
+    checksum = fetch_checksum(checksum_url) if checksum_url else None
+    if checksum_url and checksum is None:
+        print("No checksum published at %s; not verifying %s." % (checksum_url, desc))
+    tmp_path = tgz_file + ".part"
+    tee = open(tmp_path, "wb") if cache is not None else None
+    # The archive is only known to be intact once it was read to the end,
+    # so what it holds goes into `dst` once the checksum was verified; an
+    # incremental extraction stages only what differs from `dst`
+    dst = path.normpath(dst)
+    staging_dir = tempfile.mkdtemp(prefix=path.basename(dst) + ".part",
+                                   dir=path.dirname(dst))
+    print("Downloading and extracting %s..." % desc)
+    try:
+        try:
+            try:
+                reader = ResumingReader(desc, src, checksum[0] if checksum else None, tee)
+                tar = tarfile.open(fileobj=reader, mode="r|gz")
+                if incremental:
+                    _extract_incremental(tar, staging_dir, jobs, compare, current_dir=dst)
+                else:
+                    tar.extractall(staging_dir)
+                reader.drain()
+                if not reader.complete:
+                    raise StreamInterrupted()
+            finally:
+                if tee:
+                    tee.close()
+        except (StreamInterrupted, urllib2.URLError, socket.error, httplib.HTTPException,
+                tarfile.ReadError, IOError):
+            print()
+            print("Streaming %s failed; falling back to a resumable download." % desc)
+            if tee is None and path.exists(tmp_path):
+                os.remove(tmp_path)
+            download_file(desc, src, tgz_file, checksum_url=checksum_url,
+                          connections=connections, cache=cache, ttl=ttl)
+            print("Extracting %s..." % desc)
+            extract(tgz_file, dst, incremental=incremental, jobs=jobs, compare=compare)
+            return
+
+        if checksum and reader.digest.hexdigest() != checksum[1]:
+            print("Checksum mismatch for %s: expected %s %s, got %s; nothing was extracted."
+                  % (desc, checksum[0], checksum[1], reader.digest.hexdigest()))
+            if tee:
+                os.remove(tmp_path)
+            sys.exit(1)
+        if path.isdir(dst):
+            _move_into(staging_dir, dst)
+        else:
+            os.rename(staging_dir, dst)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    if tee:
+        os.rename(tmp_path, tgz_file)
+        cache.store(src, tgz_file, validators(reader.headers))
+        os.remove(tgz_file)
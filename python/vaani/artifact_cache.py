@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import contextlib
+import errno
+import json
+import os
+import os.path as path
+import re
+import shutil
+import threading
+import time
+
+from vaani.download import file_hash
+from vaani.locks import FileLock
+
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(value):
+    """Parse a size such as 500M, 4GiB or a plain number of bytes."""
+    if isinstance(value, (int, long)):
+        return value
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: %s" % value)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def link_or_copy(src, dst):
+    """Hardlink `src` to `dst`, copying if the file system can't link."""
+    if path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
+
+
+class ArtifactCache(object):
+    """Downloaded artifacts, stored by the SHA-256 of their content and
+    looked up by the URL they were downloaded from.
+
+    The cache is bounded to `max_size` bytes; the least recently used
+    artifacts are evicted first. It also remembers what is needed to
+    revalidate an artifact with the server, and where redirecting URLs
+    such as that of a project's latest release led."""
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.dir = cache_dir
+        self.max_size = max_size
+        self.index_path = path.join(cache_dir, "index.json")
+        self.lock = threading.RLock()
+        self.index = self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        index.setdefault("urls", {})
+        index.setdefault("blobs", {})
+        # url: {"etag", "last_modified", "checked"}
+        index.setdefault("validators", {})
+        # url: {"target", "checked"}
+        index.setdefault("redirects", {})
+        return index
+
+    @contextlib.contextmanager
+    def _updating(self):
+        # Other mach processes share the cache; the index is read again
+        # under their common lock, so that what they stored is kept
+        with self.lock, FileLock(self.index_path + ".lock"):
+            self.index = self._load()
+            yield
+
+    def _save(self):
+        if not path.isdir(self.dir):
+            os.makedirs(self.dir)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def blob_path(self, digest):
+        return path.join(self.dir, "sha256", digest[:2], digest)
+
+    def lookup(self, url):
+        """Return the path of the cached artifact for `url`, or None."""
+        with self._updating():
+            digest = self.index["urls"].get(url)
+            if digest is None:
+                return None
+            blob = self.blob_path(digest)
+            if not path.exists(blob) or digest not in self.index["blobs"]:
+                self._drop(digest)
+                self._save()
+                return None
+            self.index["blobs"][digest]["last_used"] = time.time()
+            self._save()
+            return blob
+
+    def fetch(self, url, dst):
+        """Place the cached artifact for `url` at `dst`. Returns whether it
+        was cached."""
+        # Evicting it is left to other processes until it is linked
+        with self._updating():
+            blob = self.lookup(url)
+            if blob is None:
+                return False
+            link_or_copy(blob, dst)
+        return True
+
+    def validators(self, url):
+        """The ETag and Last-Modified `url` was downloaded with, and when
+        they were last checked."""
+        with self.lock:
+            self.index = self._load()
+            return dict(self.index["validators"].get(url, {}))
+
+    def revalidated(self, url, validators):
+        """Note that the server confirmed the artifact of `url` is current."""
+        with self._updating():
+            if self.index["urls"].get(url) is None:
+                return
+            self.index["validators"][url] = dict(validators, checked=time.time())
+            self._save()
+
+    def redirect(self, url, ttl=None):
+        """Where `url` was found to redirect to, if that is less than `ttl`
+        seconds ago, or with no `ttl`, however long ago."""
+        with self.lock:
+            self.index = self._load()
+            entry = self.index["redirects"].get(url)
+        if entry is None or (ttl is not None and time.time() - entry["checked"] >= ttl):
+            return None
+        return entry["target"]
+
+    def store_redirect(self, url, target):
+        with self._updating():
+            self.index["redirects"][url] = {"target": target, "checked": time.time()}
+            self._save()
+
+    def store(self, url, file_path, validators=None):
+        """Add the file downloaded from `url` to the cache, along with the
+        `validators` of the response it came in."""
+        if not self.max_size:
+            return None
+        digest = file_hash(file_path, "sha256")
+        size = path.getsize(file_path)
+        if size > self.max_size:
+            return None
+        blob = self.blob_path(digest)
+        with self._updating():
+            if not path.exists(blob):
+                if not path.isdir(path.dirname(blob)):
+                    os.makedirs(path.dirname(blob))
+                tmp_blob = blob + ".tmp"
+                link_or_copy(file_path, tmp_blob)
+                os.rename(tmp_blob, blob)
+            entry = self.index["blobs"].setdefault(digest, {"urls": []})
+            entry["size"] = size
+            entry["last_used"] = time.time()
+            if url not in entry["urls"]:
+                entry["urls"].append(url)
+            old_digest = self.index["urls"].get(url)
+            self.index["urls"][url] = digest
+            if validators:
+                self.index["validators"][url] = dict(validators, checked=time.time())
+            else:
+                self.index["validators"].pop(url, None)
+            if old_digest and old_digest != digest:
+                self._unlink_url(old_digest, url)
+            self._evict(self.max_size, keep=digest)
+            self._save()
+        return digest
+
+    def _unlink_url(self, digest, url):
+        entry = self.index["blobs"].get(digest)
+        if entry and url in entry["urls"]:
+            entry["urls"].remove(url)
+
+    def _drop(self, digest):
+        entry = self.index["blobs"].pop(digest, {"urls": []})
+        for url in entry["urls"]:
+            if self.index["urls"].get(url) == digest:
+                del self.index["urls"][url]
+                self.index["validators"].pop(url, None)
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return entry.get("size", 0)
+
+    def _evict(self, max_size, keep=None):
+        freed = 0
+        total = self.size()
+        by_age = sorted(self.index["blobs"].items(), key=lambda item: item[1]["last_used"])
+        for digest, entry in by_age:
+            if total <= max_size:
+                break
+            if digest == keep:
+                continue
+            size = self._drop(digest)
+            total -= size
+            freed += size
+        return freed
+
+    def size(self):
+        return sum(entry["size"] for entry in self.index["blobs"].values())
+
+    def prune(self, max_size=None):
+        """Evict least recently used artifacts until the cache fits in
+        `max_size` bytes. Returns the number of bytes freed."""
+        with self._updating():
+            freed = self._evict(self.max_size if max_size is None else max_size)
+            self._save()
+        return freed
+
+    def entries(self):
+        """Cached artifacts as `(digest, entry)` tuples, most recently used
+        first."""
+        return sorted(self.index["blobs"].items(),
+                      key=lambda item: item[1]["last_used"], reverse=True)
@@ -0,0 +1,349 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import BaseHTTPServer
+import email.utils
+import io
+import json
+import os
+import os.path as path
+import random
+import re
+import shutil
+import SocketServer
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import timeit
+import urllib
+
+# Bumped when results stop being comparable with earlier ones
+RESULTS_VERSION = 1
+
+FIXTURE_GROUP_ID = "org.mozilla.vaani.bench"
+
+POM_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<project xmlns="http://maven.apache.org/POM/4.0.0">
+  <modelVersion>4.0.0</modelVersion>
+  <groupId>%(group_id)s</groupId>
+  <artifactId>%(artifact_id)s</artifactId>
+  <version>1.0.0</version>
+  <packaging>%(packaging)s</packaging>
+%(modules)s</project>
+"""
+
+# Mimics the output mach parses: module headers and the reactor summary
+FAKE_MVN = """#!%(python)s
+import os, sys, time
+MODULES = %(modules)d
+MODULE_TIME = %(module_time)r
+repo = os.path.basename(os.getcwd())
+m2repo = None
+for arg in sys.argv[1:]:
+    if arg.startswith("-Dmaven.repo.local="):
+        m2repo = arg.split("=", 1)[1]
+names = [repo] + ["%%s-module-%%d" %% (repo, i) for i in range(MODULES)]
+for name in names:
+    print("[INFO] ------------------------------------------------------------------------")
+    print("[INFO] Building %%s 1.0.0" %% name)
+    sys.stdout.flush()
+    time.sleep(MODULE_TIME)
+    if "install" in sys.argv and m2repo:
+        target = os.path.join(m2repo, %(group_path)r, name, "1.0.0")
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        with open(os.path.join(target, name + "-1.0.0.jar"), "wb") as f:
+            f.write(b"jar" * 1024)
+print("[INFO] ------------------------------------------------------------------------")
+print("[INFO] Reactor Summary:")
+for name in names:
+    print("[INFO] %%s %%s SUCCESS [ %%.3f s]" %% (name, "." * max(3, 50 - len(name)), MODULE_TIME))
+print("[INFO] BUILD SUCCESS")
+"""
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the files of the server's directory with what the download
+    code relies on: single byte ranges, and ETag and Last-Modified along
+    with the conditional requests using them."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send(head=True)
+
+    def do_GET(self):
+        self.send(head=False)
+
+    def send(self, head):
+        rel_path = urllib.unquote(self.path.split("?", 1)[0]).lstrip("/")
+        file_path = path.join(self.server.root_dir, *rel_path.split("/"))
+        if ".." in rel_path.split("/") or not path.isfile(file_path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        st = os.stat(file_path)
+        etag = '"%x-%x"' % (st.st_size, int(st.st_mtime))
+        if_none_match = self.headers.getheader("If-None-Match")
+        if_modified_since = email.utils.parsedate_tz(self.headers.getheader("If-Modified-Since") or "")
+        # If-None-Match takes precedence, as with real servers
+        if (if_none_match == etag if if_none_match else
+                if_modified_since and int(st.st_mtime) <= email.utils.mktime_tz(if_modified_since)):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start, end = 0, st.st_size - 1
+        match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.getheader("Range") or "")
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % st.st_size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, st.st_size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))
+        self.end_headers()
+        if head:
+            return
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = f.read(min(remaining, 256 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server on a free local port serving `root_dir`, each request
+    in a thread of its own like a real server handling parallel range
+    requests."""
+
+    daemon_threads = True
+
+    def __init__(self, root_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, (b"127.0.0.1", 0), FixtureHandler)
+        self.root_dir = root_dir
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def write_tarball(tgz_path, root_name, files, file_size, seed=0):
+    """Write a gzipped tarball of `files` files of `file_size` bytes below
+    `root_name`, laid out like a Maven repository. The content is random
+    but the same for the same seed, and as incompressible as jars."""
+    rng = random.Random(seed)
+    pool = bytearray(rng.getrandbits(8) for _ in range(max(file_size * 4, 1024 * 1024)))
+    with tarfile.open(tgz_path, "w:gz") as tar:
+        for index in range(files):
+            name = "%s/org/example/group%d/artifact%d/1.0/artifact%d-1.0.jar" % (
+                root_name, index % 17, index, index)
+            offset = rng.randrange(len(pool) - file_size + 1)
+            info = tarfile.TarInfo(name)
+            info.size = file_size
+            info.mtime = 1500000000
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(bytes(pool[offset:offset + file_size])))
+    return path.getsize(tgz_path)
+
+
+def _git(args, cwd):
+    process = subprocess.Popen(["git"] + args, cwd=cwd,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError("git %s failed: %s" % (" ".join(args), out.strip()))
+
+
+def _write_pom(module_dir, artifact_id, modules=()):
+    if not path.isdir(module_dir):
+        os.makedirs(module_dir)
+    with open(path.join(module_dir, "pom.xml"), "w") as f:
+        f.write(POM_TEMPLATE % {
+            "group_id": FIXTURE_GROUP_ID,
+            "artifact_id": artifact_id,
+            "packaging": "pom" if modules else "jar",
+            "modules": "  <modules>\n%s  </modules>\n" % "".join(
+                "    <module>%s</module>\n" % module for module in modules) if modules else "",
+        })
+
+
+def create_remotes(remotes_dir, repos, modules, commits, files):
+    """Create a bare git repository in `remotes_dir` for each of `repos`,
+    a multi-module Maven project whose history has `commits` commits each
+    changing `files` source files."""
+    work_dir = path.join(remotes_dir, "work")
+    env_args = ["-c", "user.name=mach bench", "-c", "user.email=bench@localhost"]
+    for repo in repos:
+        repo_dir = path.join(work_dir, repo)
+        os.makedirs(repo_dir)
+        _git(["init", "-q"], repo_dir)
+        names = ["%s-module-%d" % (repo, i) for i in range(modules)]
+        _write_pom(repo_dir, repo, names)
+        for name in names:
+            _write_pom(path.join(repo_dir, name), name)
+        for commit in range(commits):
+            for index in range(files):
+                source_dir = path.join(repo_dir, names[index % len(names)] if names else "",
+                                       "src", "main", "java")
+                if not path.isdir(source_dir):
+                    os.makedirs(source_dir)
+                with open(path.join(source_dir, "Class%d.java" % index), "w") as f:
+                    f.write("class Class%d { int revision = %d; }\n" % (index, commit))
+            _git(["add", "-A"], repo_dir)
+            _git(env_args + ["commit", "-q", "-m", "Revision %d" % commit], repo_dir)
+        _git(["clone", "-q", "--bare", repo_dir, path.join(remotes_dir, repo)], remotes_dir)
+    shutil.rmtree(work_dir)
+
+
+def write_fake_mvn(bin_dir, modules, module_time):
+    """Write a `mvn` to `bin_dir` that takes `module_time` seconds per
+    module and installs a jar per module into -Dmaven.repo.local."""
+    if not path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    script = path.join(bin_dir, "mvn")
+    with open(script, "w") as f:
+        f.write(FAKE_MVN % {
+            "python": sys.executable,
+            "modules": modules,
+            "module_time": module_time,
+            "group_path": FIXTURE_GROUP_ID.replace(".", "/"),
+        })
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if sys.platform == "win32":
+        with open(script + ".cmd", "w") as f:
+            f.write('@"%s" "%s" %%*\r\n' % (sys.executable, script))
+    return script
+
+
+class Capture(object):
+    """Stand-in for sys.stdout keeping the output of a stage, which is
+    only shown when it fails. It has no fileno, so git runs quietly."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class StageFailed(Exception):
+    def __init__(self, message, output):
+        self.message = message
+        self.output = output
+
+    def __str__(self):
+        return self.message
+
+
+def time_stage(run, setup=None, runs=5, warmup=1):
+    """Time `run` over `runs` repetitions after `warmup` untimed ones,
+    calling `setup` untimed before each. A `run` returning non-zero or
+    raising fails the stage. Returns the seconds of each timed run."""
+    samples = []
+    for index in range(warmup + runs):
+        stdout = sys.stdout
+        sys.stdout = capture = Capture()
+        try:
+            if setup is not None:
+                setup()
+            start = timeit.default_timer()
+            result = run()
+            elapsed = timeit.default_timer() - start
+        except (Exception, SystemExit) as e:
+            raise StageFailed("%s: %s" % (type(e).__name__, e), capture.getvalue())
+        finally:
+            sys.stdout = stdout
+        if result:
+            raise StageFailed("exited with %s" % result, capture.getvalue())
+        if index >= warmup:
+            samples.append(elapsed)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    return {
+        "samples": samples,
+        "min": ordered[0],
+        "median": median,
+        "mean": sum(ordered) / len(ordered),
+        "max": ordered[-1],
+    }
+
+
+def write_results(results, output):
+    output_dir = path.dirname(path.abspath(output))
+    if not path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def read_results(results_path):
+    with open(results_path) as f:
+        results = json.load(f)
+    if results.get("version") != RESULTS_VERSION:
+        raise ValueError("%s has results of version %s, expected %d"
+                         % (results_path, results.get("version"), RESULTS_VERSION))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare the median of each stage timed in both `results` and
+    `baseline`. Returns `(stage, baseline median, median, change,
+    regressed)` tuples, where change is relative and a stage regressed if
+    it got slower by more than `threshold`."""
+    rows = []
+    for stage, summary in results["stages"].items():
+        before = baseline["stages"].get(stage)
+        if before is None:
+            continue
+        change = (summary["median"] - before["median"]) / before["median"] if before["median"] else 0.0
+        rows.append((stage, before["median"], summary["median"], change, change > threshold))
+    return rows
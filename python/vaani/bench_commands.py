@@ -0,0 +1,275 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import collections
+import json
+import os
+import os.path as path
+import platform
+import shutil
+import tarfile
+import tempfile
+import time
+
+from mach.decorators import (
+    CommandArgument,
+    CommandProvider,
+    Command,
+)
+
+from vaani.command_base import *
+from vaani import bench, gitutil
+from vaani.archive import extract, stream_extract
+from vaani.download import download_file, file_hash, format_size, DEFAULT_CONNECTIONS
+from vaani.repos import RepoGraph, DEFAULT_REPOS
+from vaani.resources import cpu_count
+
+# In the order they run; later stages reuse what earlier ones left
+STAGES = [
+    "download",
+    "download-segmented",
+    "stream-extract",
+    "extract",
+    "extract-incremental",
+    "bootstrap-git",
+    "build",
+    "build-parallel",
+]
+
+
+class BenchContext(object):
+    """Command context of the fixture workspace the build stages run in."""
+
+    def __init__(self, topdir, command_loader):
+        self.topdir = topdir
+        self.command_loader = command_loader
+        # The prerequisites are the fixtures, never real downloads
+        self.bootstrapped = True
+
+
+@CommandProvider
+class MachCommands(CommandBase):
+    @Command('bench',
+             description='Time the bootstrap and build stages against local fixtures',
+             category='testing')
+    @CommandArgument('stages',
+                     nargs='*', metavar='STAGE',
+                     help='Stages to time (default: all): ' + ", ".join(STAGES))
+    @CommandArgument('--runs', '-r',
+                     type=int, default=5,
+                     help='Timed runs of each stage (default: 5)')
+    @CommandArgument('--warmup',
+                     type=int, default=1,
+                     help='Untimed runs of each stage before the timed ones (default: 1)')
+    @CommandArgument('--output', '-o',
+                     default=None,
+                     help='File to write the results to (default: shared/bench/<date>-<time>.json)')
+    @CommandArgument('--compare',
+                     default=None, metavar='RESULTS',
+                     help='Compare the medians with those of an earlier results file')
+    @CommandArgument('--threshold',
+                     type=float, default=0.1,
+                     help='Relative slowdown of a median reported as a regression (default: 0.1)')
+    @CommandArgument('--label',
+                     default=None,
+                     help='Name of this run in the results, e.g. the branch being measured')
+    @CommandArgument('--files',
+                     type=int, default=500,
+                     help='Files in the synthetic Maven repository tarball (default: 500)')
+    @CommandArgument('--file-size',
+                     type=int, default=32 * 1024,
+                     help='Bytes of each file in the tarball (default: 32768)')
+    @CommandArgument('--commits',
+                     type=int, default=20,
+                     help='Commits in the history of each fixture repository (default: 20)')
+    @CommandArgument('--modules',
+                     type=int, default=3,
+                     help='Maven modules of each fixture repository (default: 3)')
+    @CommandArgument('--module-time',
+                     type=float, default=0.05,
+                     help='Seconds the fake mvn spends building each module (default: 0.05)')
+    @CommandArgument('--keep',
+                     action='store_true',
+                     help='Keep the fixtures instead of deleting them afterwards')
+    def bench(self, stages=None, runs=5, warmup=1, output=None, compare=None, threshold=0.1,
+              label=None, files=500, file_size=32 * 1024, commits=20, modules=3,
+              module_time=0.05, keep=False):
+        stages = stages or STAGES
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            print("Unknown stages: %s (known: %s)" % (", ".join(unknown), ", ".join(STAGES)))
+            return 1
+        stages = [stage for stage in STAGES if stage in stages]
+        baseline = None
+        if compare:
+            try:
+                baseline = bench.read_results(compare)
+            except (IOError, ValueError) as e:
+                print("Could not read %s: %s" % (compare, e))
+                return 1
+
+        bench_dir = path.join(self.context.shared_dir, "bench")
+        mkdir_p(bench_dir)
+        work_dir = tempfile.mkdtemp(prefix="fixtures-", dir=bench_dir)
+        repos = list(RepoGraph(DEFAULT_REPOS))
+        old_path = os.environ["PATH"]
+        server = None
+        try:
+            print("Creating fixtures in %s..." % work_dir)
+            www_dir = path.join(work_dir, "www")
+            remotes_dir = path.join(work_dir, "remotes")
+            topdir = path.join(work_dir, "topdir")
+            scratch_dir = path.join(work_dir, "scratch")
+            for fixture_dir in (www_dir, remotes_dir, topdir, scratch_dir):
+                os.makedirs(fixture_dir)
+            tarball = path.join(www_dir, "m2repository.tar.gz")
+            tarball_size = bench.write_tarball(tarball, "m2repository", files, file_size)
+            with open(tarball + ".sha1", "w") as f:
+                f.write(file_hash(tarball, "sha1") + "\n")
+            bench.create_remotes(remotes_dir, repos, modules, commits, files=8)
+            # Found first on the PATH of the build stages
+            bin_dir = path.join(work_dir, "bin")
+            bench.write_fake_mvn(bin_dir, modules, module_time)
+            os.environ["PATH"] = bin_dir + os.pathsep + old_path
+            with open(path.join(topdir, ".vaanibuild"), "w") as f:
+                f.write("[git]\nremote = %s\n\n" % json.dumps("file://" + remotes_dir + "/"))
+                f.write("[build]\nresource-profile = \"laptop\"\n\n")
+                f.write("[build-cache]\nenabled = false\n")
+            server = bench.FixtureServer(www_dir)
+            server.start()
+            print("Serving %s (%s) at %s" % (path.basename(tarball), format_size(tarball_size),
+                                             server.url))
+
+            workspace = CommandBase(BenchContext(topdir, getattr(self.context, "command_loader", None)))
+            url = server.url + "m2repository.tar.gz"
+            tgz_file = path.join(scratch_dir, "m2repository.tar.gz")
+            extract_dir = path.join(scratch_dir, "m2repo")
+
+            def remove(file_path):
+                for stale in (file_path, file_path + ".part", file_path + ".part.segments"):
+                    if path.exists(stale):
+                        os.remove(stale)
+
+            def fresh_extract_dir():
+                if path.isdir(extract_dir):
+                    shutil.rmtree(extract_dir)
+                os.makedirs(extract_dir)
+                shutil.copyfile(tarball, tgz_file)
+
+            def populated_extract_dir():
+                if not path.isdir(path.join(extract_dir, "m2repository")):
+                    fresh_extract_dir()
+                    with tarfile.open(tgz_file) as tar:
+                        tar.extractall(extract_dir)
+                shutil.copyfile(tarball, tgz_file)
+
+            def download(connections):
+                download_file("m2repository", url, tgz_file, checksum_url=url + ".sha1",
+                              connections=connections)
+
+            def wipe_mirrors():
+                mirrors_dir = path.join(workspace.context.cache_dir, "git")
+                if path.isdir(mirrors_dir):
+                    shutil.rmtree(mirrors_dir)
+
+            def cloned():
+                if not path.isdir(workspace.context.git_dir):
+                    workspace.dispatch("bootstrap-git", repository="all")
+
+            def build(jobs):
+                return workspace.dispatch("build", repository="all", jobs=jobs, force=True,
+                                          no_build_cache=True)
+
+            # name: (untimed setup, timed run)
+            definitions = {
+                "download": (lambda: remove(tgz_file), lambda: download(1)),
+                "download-segmented": (lambda: remove(tgz_file),
+                                       lambda: download(DEFAULT_CONNECTIONS)),
+                "stream-extract": (fresh_extract_dir,
+                                   lambda: stream_extract("m2repository", url, tgz_file,
+                                                          extract_dir, checksum_url=url + ".sha1",
+                                                          connections=1)),
+                "extract": (fresh_extract_dir, lambda: extract(tgz_file, extract_dir)),
+                "extract-incremental": (populated_extract_dir,
+                                        lambda: extract(tgz_file, extract_dir, incremental=True)),
+                "bootstrap-git": (wipe_mirrors,
+                                  lambda: workspace.dispatch("bootstrap-git", repository="all",
+                                                             force=True)),
+                "build": (cloned, lambda: build(1)),
+                "build-parallel": (cloned, lambda: build(len(repos))),
+            }
+
+            results = {
+                "version": bench.RESULTS_VERSION,
+                "label": label,
+                "time": time.time(),
+                "sdk": self.sdk_revision(),
+                "machine": {
+                    "platform": platform.platform(),
+                    "python": platform.python_version(),
+                    "cpus": cpu_count(),
+                },
+                "fixtures": {
+                    "files": files,
+                    "file-size": file_size,
+                    "tarball-size": tarball_size,
+                    "repos": len(repos),
+                    "commits": commits,
+                    "modules": modules,
+                    "module-time": module_time,
+                },
+                "runs": runs,
+                "warmup": warmup,
+                "stages": collections.OrderedDict(),
+                "failed": [],
+            }
+            width = max(len(stage) for stage in stages)
+            for stage in stages:
+                setup, run = definitions[stage]
+                try:
+                    samples = bench.time_stage(run, setup, runs, warmup)
+                except bench.StageFailed as e:
+                    print("%-*s  FAILED: %s" % (width, stage, e))
+                    for line in e.output.splitlines()[-10:]:
+                        print("    " + line)
+                    results["failed"].append(stage)
+                    continue
+                summary = results["stages"][stage] = bench.summarize(samples)
+                print("%-*s  median %7.3fs  min %7.3fs  max %7.3fs"
+                      % (width, stage, summary["median"], summary["min"], summary["max"]))
+        finally:
+            os.environ["PATH"] = old_path
+            if server is not None:
+                server.stop()
+            if keep:
+                print("Fixtures kept in %s" % work_dir)
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        output = output or path.join(bench_dir, time.strftime("%Y%m%d-%H%M%S") + ".json")
+        bench.write_results(results, output)
+        print("Results written to %s" % output)
+
+        regressed = False
+        if baseline is not None:
+            if baseline["fixtures"] != results["fixtures"]:
+                print("Warning: %s was measured with other fixtures; the times may not compare."
+                      % compare)
+            print()
+            print("%-*s  %9s  %9s  %7s" % (width, "stage", "baseline", "median", "change"))
+            for stage, before, after, change, slower in bench.compare(results, baseline, threshold):
+                regressed = regressed or slower
+                print("%-*s  %8.3fs  %8.3fs  %+6.1f%%%s" % (width, stage, before, after,
+                                                           change * 100,
+                                                           "  REGRESSION" if slower else ""))
+        return 1 if results["failed"] or regressed else 0
+
+    def sdk_revision(self):
+        """The commit of the SDK tooling being measured, if known."""
+        try:
+            return gitutil.head(self.context.topdir)
+        except gitutil.GitError:
+            return None
@@ -5,20 +5,27 @@
 from __future__ import print_function, unicode_literals
 
 import base64
+import datetime
 import json
 import os
 import os.path as path
 import re
 import shutil
+import socket
 import sys
-import StringIO
-import tarfile
 import urllib2
-import errno
 
 
 
 from vaani.command_base import *
+from vaani import gitutil, m2sync
+from vaani.archive import extract, stream_extract
+from vaani.artifact_cache import ArtifactCache, DEFAULT_MAX_SIZE, parse_size
+from vaani.build_manifest import BuildManifest
+from vaani.download import download_file, format_size, redirect_target, DEFAULT_CONNECTIONS, DEFAULT_TTL
+from vaani.locks import holding
+from vaani.parallel import parallel_map
+from vaani.tasks import report, run_tasks
 
 from mach.decorators import (
     CommandArgument,
@@ -27,143 +34,119 @@ from mach.decorators import (
     SubCommand
 )
 
-def download(desc, src, writer, start_byte=0):
-    if start_byte:
-        print("Resuming download of %s..." % desc)
-    else:
-        print("Downloading %s..." % desc)
-    dumb = (os.environ.get("TERM") == "dumb") or (not sys.stdout.isatty())
-
-    try:
-        if start_byte:
-            src = urllib2.Request(src, headers={'Range': 'bytes={}-'.format(start_byte)})
-        resp = urllib2.urlopen(src)
-
-        fsize = None
-        if resp.info().getheader('Content-Length'):
-            fsize = int(resp.info().getheader('Content-Length').strip()) + start_byte
-
-        recved = start_byte
-        chunk_size = 8192
-
-        while True:
-            chunk = resp.read(chunk_size)
-            if not chunk:
-                break
-            recved += len(chunk)
-            if not dumb:
-                if fsize is not None:
-                    pct = recved * 100.0 / fsize
-                    print("\rDownloading %s: %5.1f%%" % (desc, pct), end="")
-
-                sys.stdout.flush()
-            writer.write(chunk)
-
-        if not dumb:
-            print()
-    except urllib2.HTTPError, e:
-        print("Download failed (%d): %s - %s" % (e.code, e.reason, src))
-        if e.code == 403:
-            print("No maven compiler binary available for this platform. "
-                  "Please see https://github.com/mozilla/vaanisdk/#prerequisites")
-        sys.exit(1)
-    except urllib2.URLError:
-        print("Error downloading; are you connected to the internet?")
-        sys.exit(1)
-    except KeyboardInterrupt:
-        writer.flush()
-        raise
-
-
-def download_file(desc, src, dst):
-    tmp_path = dst + ".part"
-    try:
-        start_byte = os.path.getsize(tmp_path)
-        with open(tmp_path, 'ab') as fd:
-            download(desc, src, fd, start_byte=start_byte)
-    except os.error:
-        with open(tmp_path, 'wb') as fd:
-            download(desc, src, fd)
-    os.rename(tmp_path, dst)
-
-
-def download_bytes(desc, src):
-    content_writer = StringIO.StringIO()
-    download(desc, src, content_writer)
-    return content_writer.getvalue()
-
-
-def extract(src, dst, movedir=None):
-    tarfile.open(src).extractall(dst)
-
-    if movedir:
-        for f in os.listdir(movedir):
-            frm = path.join(movedir, f)
-            to = path.join(dst, f)
-            os.rename(frm, to)
-        os.rmdir(movedir)
-
-    os.remove(src)
-
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
+RELEASES_URL = "https://github.com/mozilla/openhab2-addons/releases"
+# Used when the latest release can't be found out
+FALLBACK_M2REPO_URL = RELEASES_URL + "/download/0.1.0t9/m2repository.tar.gz"
+
 
 @CommandProvider
 class MachCommands(CommandBase):
-    @Command('env',
-             description='Print environment setup commands',
-             category='bootstrap')
-    def env(self):
-        env = self.build_env()
-        print("export PATH=%s" % env["PATH"])
-        if sys.platform == "darwin":
-            print("export DYLD_LIBRARY_PATH=%s" % env["DYLD_LIBRARY_PATH"])
-        else:
-            print("export LD_LIBRARY_PATH=%s" % env["LD_LIBRARY_PATH"])
+    def download_connections(self):
+        return self.config.get("download", {}).get("connections", DEFAULT_CONNECTIONS)
+
+    def download_ttl(self):
+        """Seconds cached downloads and resolved releases are used without
+        asking the server whether they changed."""
+        return self.config.get("download", {}).get("ttl", DEFAULT_TTL)
+
+    def stream_downloads(self, stream):
+        return stream or self.config.get("download", {}).get("stream", False)
+
+    def artifact_cache(self):
+        # Shared by the commands of this process, which may run concurrently
+        if not hasattr(self.context, "artifact_cache"):
+            max_size = self.config.get("cache", {}).get("max-size", DEFAULT_MAX_SIZE)
+            self.context.artifact_cache = ArtifactCache(path.join(self.context.cache_dir, "artifacts"),
+                                                        parse_size(max_size))
+        return self.context.artifact_cache
 
     @Command('wipe-all',
              description='Wipe everything that was bootstrapped (including clones of all git repositories)',
              category='bootstrap')
-    def wipe_all(self):
-        if path.isdir(self.context.shared_dir):
-            shutil.rmtree(self.context.shared_dir)
-        if path.isdir(self.context.git_dir):
-            shutil.rmtree(self.context.git_dir)
+    @CommandArgument('--keep-cache',
+                     action='store_true',
+                     help='Keep the download and git mirror caches')
+    def wipe_all(self, keep_cache=False):
+        with holding([self.lock("bootstrap", local=True), self.lock("maven"), self.lock("m2repo")]):
+            if path.isdir(self.context.shared_dir):
+                for name in os.listdir(self.context.shared_dir):
+                    entry = path.join(self.context.shared_dir, name)
+                    # The locks are held, and waited for, by other processes
+                    if name == "locks" or keep_cache and entry == self.context.cache_dir:
+                        continue
+                    if path.isdir(entry):
+                        shutil.rmtree(entry)
+                    else:
+                        os.remove(entry)
+            if path.isdir(self.context.git_dir):
+                shutil.rmtree(self.context.git_dir)
         print("Unbootstrapping done.")
 
+    @Command('cache',
+             description='Show statistics of the local download cache',
+             category='bootstrap')
+    def cache(self):
+        cache = self.artifact_cache()
+        entries = cache.entries()
+        print("Download cache: %s" % cache.dir)
+        print("%d artifacts, %s of %s" % (len(entries), format_size(cache.size()),
+                                         format_size(cache.max_size)))
+        for digest, entry in entries:
+            print("  %10s  %s  %s" % (format_size(entry["size"]),
+                                      datetime.datetime.fromtimestamp(entry["last_used"]).strftime("%Y-%m-%d %H:%M"),
+                                      ", ".join(entry["urls"]) or digest))
+
+    @SubCommand('cache', 'prune',
+                description='Evict least recently used artifacts from the download cache')
+    @CommandArgument('--max-size',
+                     default=None,
+                     help='Size to shrink the cache to, e.g. 500M (default: the configured cache size)')
+    def cache_prune(self, max_size=None):
+        cache = self.artifact_cache()
+        freed = cache.prune(None if max_size is None else parse_size(max_size))
+        print("Freed %s; the download cache now holds %s." % (format_size(freed), format_size(cache.size())))
+
     @Command('bootstrap-maven',
              description='Download the Maven build tool',
              category='bootstrap')
     @CommandArgument('--force', '-f',
                      action='store_true')
+    @CommandArgument('--stream',
+                     action='store_true',
+                     help='Extract the archive while it downloads')
     @CommandArgument('--verbosity', '-v',
                      default=2)
-    def bootstrap_maven(self, force=False, verbosity=2):
+    def bootstrap_maven(self, force=False, stream=False, verbosity=2):
         print_header(verbosity, 'Bootstrapping Maven')
         maven_dir = self.context.maven_dir
 
-        if not force and path.exists(maven_dir):
-            print("Maven already downloaded.", end=" ")
-            print("Use |bootstrap-maven --force| to download again.")
-        else:
-            if path.isdir(maven_dir):
-                shutil.rmtree(maven_dir)
-
-            maven_url = "http://www-eu.apache.org/dist/maven/maven-3/3.3.9/binaries/apache-maven-3.3.9-bin.tar.gz"
-            mkdir_p(self.context.shared_dir)
-            tgz_file = path.join(self.context.shared_dir, "maven.tar.gz")
-
-            download_file("Maven", maven_url, tgz_file)
-
-            print("Extracting Maven...")
-            extract(tgz_file, self.context.shared_dir)
-            os.rename(path.join(self.context.shared_dir, 'apache-maven-3.3.9'), maven_dir)
+        # Other mach processes needing Maven wait for this one to download
+        # it, and then find it there
+        with self.lock("maven"):
+            if not force and path.exists(maven_dir):
+                print("Maven already downloaded.", end=" ")
+                print("Use |bootstrap-maven --force| to download again.")
+            else:
+                if path.isdir(maven_dir):
+                    shutil.rmtree(maven_dir)
+
+                maven_url = "http://www-eu.apache.org/dist/maven/maven-3/3.3.9/binaries/apache-maven-3.3.9-bin.tar.gz"
+                mkdir_p(self.context.shared_dir)
+                tgz_file = path.join(self.context.shared_dir, "maven.tar.gz")
+
+                if self.stream_downloads(stream):
+                    stream_extract("Maven", maven_url, tgz_file, self.context.shared_dir,
+                                   checksum_url=maven_url + ".sha1",
+                                   connections=self.download_connections(), cache=self.artifact_cache(),
+                                   ttl=self.download_ttl())
+                else:
+                    download_file("Maven", maven_url, tgz_file, checksum_url=maven_url + ".sha1",
+                                  connections=self.download_connections(), cache=self.artifact_cache(),
+                                  ttl=self.download_ttl())
+
+                    print("Extracting Maven...")
+                    extract(tgz_file, self.context.shared_dir)
+                os.rename(path.join(self.context.shared_dir, 'apache-maven-3.3.9'), maven_dir)
         print_footer(verbosity)
 
     @Command('bootstrap-m2repo',
@@ -171,49 +154,163 @@ class MachCommands(CommandBase):
              category='bootstrap')
     @CommandArgument('--force', '-f',
                      action='store_true')
+    @CommandArgument('--stream',
+                     action='store_true',
+                     help='Extract the archive while it downloads')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Number of threads writing extracted files')
+    @CommandArgument('--compare-content',
+                     action='store_true',
+                     help='Compare files by content instead of size and mtime when refreshing')
+    @CommandArgument('--delta',
+                     action='store_true',
+                     help='Only fetch the artifacts that changed, as listed by the release manifest')
+    @CommandArgument('--manifest-url',
+                     default=None,
+                     help='URL of the artifact manifest used by --delta')
     @CommandArgument('--verbosity', '-v',
                      default=2)
-    def bootstrap_m2repo(self, force=False, verbosity=2):
+    def bootstrap_m2repo(self, force=False, stream=False, jobs=None, compare_content=False,
+                         delta=False, manifest_url=None, verbosity=2):
         print_header(verbosity, 'Bootstrapping local maven repository')
-        m2repo_dir = self.context.m2repo_dir
-
-        if not force and path.exists(m2repo_dir):
-            print("Maven repository already prepopulated.", end=" ")
-            print("Use |bootstrap-m2repo --force| to download again.")
-        else:
-            if path.isdir(m2repo_dir):
-                shutil.rmtree(m2repo_dir)
-            os.makedirs(m2repo_dir)
-
-            latestPage = urllib2.urlopen('https://github.com/mozilla/openhab2-addons/releases/latest').read()
-            m2repo_url = 'https://github.com/mozilla/openhab2-addons/releases/download/0.1.0t9/m2repository.tar.gz'
-            result = re.search('(/mozilla/openhab2-addons/releases/download/.*/m2repository.tar.gz)', latestPage, re.IGNORECASE)
-            if result:
-                m2repo_url = 'https://github.com' + result.group(1)
-                print (m2repo_url)
-            tgz_file = path.join(self.context.shared_dir, "m2repository.tar.gz")
-
-            download_file("Maven repository", m2repo_url, tgz_file)
-
-            print("Extracting Maven repository...")
-            extract(tgz_file, m2repo_dir)
+        m2repo_dir = self.context.shared_m2repo_dir
+        compare = "hash" if compare_content else "mtime"
+
+        # Also waits for the builds using the repository to finish
+        with self.lock("m2repo"):
+            if not force and not delta and path.exists(m2repo_dir):
+                print("Maven repository already prepopulated.", end=" ")
+                print("Use |bootstrap-m2repo --force| to download again.")
+            else:
+                # An existing repository is refreshed in place: only new or
+                # changed files of the archive are written.
+                mkdir_p(m2repo_dir)
+                # The refresh may replace artifacts installed by previous builds
+                # of the main checkout, which installs into the shared repository
+                BuildManifest.remove(path.join(self.context.shared_dir, "build-manifest.json"))
+
+                # Looking up the latest release takes a request, only made
+                # when its archive or the manifest next to it is needed
+                m2repo_url = None
+                if delta:
+                    manifest_url = manifest_url or self.config.get("m2repo", {}).get("manifest-url")
+                    if not manifest_url:
+                        m2repo_url = self.m2repo_url()
+                        manifest_url = m2repo_url.rsplit("/", 1)[0] + "/" + m2sync.MANIFEST_NAME
+                    try:
+                        synced = m2sync.sync(manifest_url, m2repo_dir, jobs=jobs or m2sync.DEFAULT_JOBS)
+                    except (urllib2.URLError, ValueError) as e:
+                        print("No usable artifact manifest at %s (%s); downloading the whole repository."
+                              % (manifest_url, e))
+                    else:
+                        self.link_workspaces()
+                        print_footer(verbosity)
+                        return 0 if synced else 1
+                m2repo_url = m2repo_url or self.m2repo_url()
+                tgz_file = path.join(self.context.shared_dir, "m2repository.tar.gz")
+
+                if self.stream_downloads(stream):
+                    stream_extract("Maven repository", m2repo_url, tgz_file, m2repo_dir,
+                                   connections=self.download_connections(), cache=self.artifact_cache(),
+                                   incremental=True, jobs=jobs, compare=compare, ttl=self.download_ttl())
+                else:
+                    download_file("Maven repository", m2repo_url, tgz_file,
+                                  connections=self.download_connections(), cache=self.artifact_cache(),
+                                  ttl=self.download_ttl())
+
+                    print("Extracting Maven repository...")
+                    extract(tgz_file, m2repo_dir, incremental=True, jobs=jobs, compare=compare)
+                self.link_workspaces()
         print_footer(verbosity)
 
+    def link_workspaces(self):
+        """Bring the overlay of the current workspace up to date with the
+        refreshed shared Maven repository, and tell how to do so for the
+        others, which keep the artifacts they had until then."""
+        if self.context.workspace and path.exists(self.context.m2repo_dir):
+            self.update_overlay()
+        others = [name for name in self.workspaces() if name != self.context.workspace]
+        if others:
+            print("Use |workspace refresh| to update the workspaces %s as well." % ", ".join(others))
+
+    def m2repo_url(self):
+        url = self.config.get("m2repo", {}).get("url")
+        if url:
+            return url
+        latest_url = RELEASES_URL + "/latest"
+        cache = self.artifact_cache()
+        m2repo_url = cache.redirect(latest_url, self.download_ttl())
+        if m2repo_url:
+            return m2repo_url
+        try:
+            # The latest release page redirects to that of its tag, which
+            # is all there is to know; the page itself is not needed
+            target = redirect_target(latest_url)
+            match = re.search(r"/releases/tag/([^/?#]+)$", target or "")
+            if match:
+                m2repo_url = RELEASES_URL + "/download/" + match.group(1) + "/m2repository.tar.gz"
+            else:
+                latestPage = urllib2.urlopen(latest_url).read()
+                result = re.search('(/mozilla/openhab2-addons/releases/download/.*/m2repository.tar.gz)', latestPage, re.IGNORECASE)
+                if result:
+                    m2repo_url = 'https://github.com' + result.group(1)
+        except (urllib2.URLError, socket.error) as e:
+            m2repo_url = cache.redirect(latest_url) or FALLBACK_M2REPO_URL
+            print("Could not look up the latest release (%s); using %s" % (e, m2repo_url))
+            return m2repo_url
+        if not m2repo_url:
+            return FALLBACK_M2REPO_URL
+        print("Latest release: %s" % m2repo_url)
+        cache.store_redirect(latest_url, m2repo_url)
+        return m2repo_url
+
+    @Command('m2repo-manifest',
+             description='Write the artifact manifest of the local Maven repository used by |bootstrap-m2repo --delta|',
+             category='bootstrap')
+    @CommandArgument('output',
+                     help='File to write the manifest to, usually ' + m2sync.MANIFEST_NAME)
+    @CommandArgument('--base',
+                     default=None,
+                     help='URL the artifacts are published under, relative to the manifest '
+                          '(default: ' + m2sync.DEFAULT_BASE + ')')
+    def m2repo_manifest(self, output, base=None):
+        manifest = m2sync.create_manifest(self.context.shared_m2repo_dir, base)
+        with open(output, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        print("Wrote %d artifacts to %s." % (len(manifest["artifacts"]), output))
+
     @Command('bootstrap-git',
              description='Clone and prepare git repositories',
              category='bootstrap')
     @CommandArgument('repository')
     @CommandArgument('--force', '-f',
                      action='store_true')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Number of repositories to clone concurrently (default: all)')
+    @CommandArgument('--depth',
+                     type=int, default=None,
+                     help='Create shallow clones with the given history depth')
+    @CommandArgument('--filter',
+                     default=None,
+                     help='Create partial clones, e.g. --filter=blob:none')
+    @CommandArgument('--no-mirror',
+                     action='store_true',
+                     help='Clone straight from the remote, bypassing the local mirror cache')
     @CommandArgument('--verbosity', '-v',
                      default=2)
-    def bootstrap_git(self, repository='all', force=False, verbosity=2):
+    def bootstrap_git(self, repository='all', force=False, jobs=None, depth=None,
+                      filter=None, no_mirror=False, verbosity=2):
         print_header(verbosity, 'Bootstrapping git repositories')
         show_force = False
         if repository == 'all':
             repos = self.context.repos
         else:
             repos = [repository]
+        remote = self.config.get("git", {}).get("remote", "https://github.com/mozilla/")
+        mirrors_dir = path.join(self.context.cache_dir, "git")
+        to_clone = []
         for repo in repos:
             repo_dir = path.join(self.context.git_dir, repo)
             if not force and path.exists(repo_dir):
@@ -224,14 +321,83 @@ class MachCommands(CommandBase):
                     else:
                         show_force = True
             else:
+                to_clone.append(repo)
+
+        # Output of concurrent clones would interleave, and git can only
+        # write to sys.stdout if it is a real file
+        quiet = (len(to_clone) > 1 and jobs != 1) or not hasattr(sys.stdout, "fileno")
+        env = self.build_env()
+
+        def clone(repo):
+            url = remote + repo
+            repo_dir = path.join(self.context.git_dir, repo)
+            mirror_dir = None
+            if not no_mirror:
+                mirror_dir = path.join(mirrors_dir, repo + ".git")
+                mkdir_p(mirrors_dir)
+                print("Updating mirror of %s..." % repo)
+                # Shared by the workspaces, which may clone at the same time
+                with self.lock("mirror-" + repo):
+                    gitutil.update_mirror(url, mirror_dir, env=env, quiet=quiet)
+            with self.lock("repo-" + repo, local=True):
                 if path.isdir(repo_dir):
                     shutil.rmtree(repo_dir)
-                os.makedirs(repo_dir)
-                call(["git", "clone", "https://github.com/mozilla/" + repo],
-                            env=self.build_env(), cwd=self.context.git_dir)
+                mkdir_p(self.context.git_dir)
+                print("Cloning %s..." % repo)
+                gitutil.clone(url, repo_dir, mirror_dir=mirror_dir, depth=depth,
+                              filter=filter, env=env, quiet=quiet)
+            print("Cloned %s." % repo)
+
+        failed = False
+        for repo, _, exc_info in parallel_map(clone, to_clone, jobs=jobs or len(to_clone)):
+            if exc_info is not None:
+                failed = True
+                print("Could not clone %s: %s" % (repo, exc_info[1]))
         if show_force and show_help(verbosity):
             print("Some repository directories were already existing. You can use |bootstrap-git --force| to also wipe, clone and prepare those.")
         print_footer(verbosity)
+        return 1 if failed else 0
+
+    @Command('update',
+             description='Fetch all git repositories and fast-forward the clean ones',
+             category='bootstrap')
+    @CommandArgument('repository',
+                     nargs='?', default='all')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Number of repositories to update concurrently (default: all)')
+    def update(self, repository='all', jobs=None):
+        if repository == 'all':
+            repos = list(self.context.repos)
+        elif repository in self.context.repos:
+            repos = [repository]
+        else:
+            print("Unknown repository: %s" % repository)
+            return 1
+        missing = [repo for repo in repos
+                   if not path.isdir(path.join(self.context.git_dir, repo, ".git"))]
+        repos = [repo for repo in repos if repo not in missing]
+        env = self.build_env()
+
+        def update(repo):
+            repo_dir = path.join(self.context.git_dir, repo)
+            gitutil.fetch(repo_dir, env=env)
+            # Not under a build of the repository
+            with self.lock("repo-" + repo, local=True):
+                return gitutil.fast_forward(repo_dir, env=env)
+
+        print("Fetching %s..." % ", ".join(repos))
+        failed = False
+        for repo, outcome, exc_info in parallel_map(update, repos, jobs=jobs or len(repos)):
+            if exc_info is not None:
+                failed = True
+                print("  %-16s failed: %s" % (repo, exc_info[1]))
+            else:
+                status, detail = outcome
+                print("  %-16s %s: %s" % (repo, status, detail))
+        for repo in missing:
+            print("  %-16s not cloned; use |bootstrap-git %s|." % (repo, repo))
+        return 1 if failed else 0
 
     @Command('bootstrap',
              description='Bootstrap the whole project',
@@ -241,6 +407,13 @@ class MachCommands(CommandBase):
     @CommandArgument('--verbosity', '-v',
                      default=2)
     def bootstrap(self, force=False, verbosity=2):
-        self.bootstrap_git(force=force, verbosity=verbosity)
-        self.bootstrap_maven(force=force)
-        self.bootstrap_m2repo(force=force)
+        # The steps are independent, so the whole takes as long as the
+        # slowest of them
+        with self.lock("bootstrap", local=True):
+            results = run_tasks([
+                ("git", lambda: self.bootstrap_git(force=force, verbosity=verbosity)),
+                ("maven", lambda: self.bootstrap_maven(force=force)),
+                ("m2repo", lambda: self.bootstrap_m2repo(force=force)),
+            ])
+        print_header(verbosity, "Bootstrap summary")
+        return 0 if report(results) else 1
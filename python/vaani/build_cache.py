@@ -0,0 +1,219 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import hashlib
+import httplib
+import os
+import os.path as path
+import shutil
+import tarfile
+import urllib2
+
+from vaani.archive import extract_members
+from vaani.artifact_cache import DEFAULT_MAX_SIZE, link_or_copy, parse_size
+
+# Part of every key, to be bumped when what is stored changes
+CACHE_VERSION = 1
+
+# What a failing store or a broken archive raise
+CACHE_ERRORS = (EnvironmentError, tarfile.TarError, httplib.HTTPException)
+
+
+def cache_key(repo, commit, upstream_keys, options):
+    """Key of the artifacts installed by building `repo` at `commit`
+    against upstreams with `upstream_keys`, a `{repo: key}` dictionary,
+    with the Maven arguments `options` that affect them."""
+    digest = hashlib.sha256(b"vaani-build-cache %d\0" % CACHE_VERSION)
+    digest.update(b"%s\0%s\0" % (repo.encode("utf-8"), commit.encode("ascii")))
+    for upstream in sorted(upstream_keys):
+        digest.update(b"%s=%s\0" % (upstream.encode("utf-8"), upstream_keys[upstream].encode("ascii")))
+    for option in options:
+        digest.update(option.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+def installed_paths(modules, m2repo_dir):
+    """The directories of the local repository holding what installing
+    `modules` put there, relative to it, or None if some module's
+    coordinates can't be known without Maven."""
+    paths = []
+    for module in modules:
+        rel_path = module.repository_path
+        if rel_path is None:
+            return None
+        if path.isdir(path.join(m2repo_dir, *rel_path.split("/"))):
+            paths.append(rel_path)
+    return paths
+
+
+class LocalStore(object):
+    """Build archives in a directory, e.g. on a shared file system, of at
+    most `max_size` bytes. The modification time of an archive is when it
+    was last used, and the least recently used are evicted first."""
+
+    def __init__(self, store_dir, max_size=DEFAULT_MAX_SIZE):
+        self.dir = store_dir
+        self.max_size = max_size
+
+    def __str__(self):
+        return self.dir
+
+    def _path(self, key):
+        return path.join(self.dir, key[:2], key + ".tar.gz")
+
+    def get(self, key, dst):
+        try:
+            link_or_copy(self._path(key), dst)
+            os.utime(self._path(key), None)
+        except EnvironmentError as e:
+            # Also when another process evicted it meanwhile
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def put(self, key, src):
+        target = self._path(key)
+        if not path.isdir(path.dirname(target)):
+            os.makedirs(path.dirname(target))
+        # Other processes, maybe of other hosts, may store the same key
+        tmp_path = "%s.tmp%d" % (target, os.getpid())
+        link_or_copy(src, tmp_path)
+        os.rename(tmp_path, target)
+        os.utime(target, None)
+        self.prune(keep=key)
+
+    def entries(self):
+        """Stored archives as `(key, size, last used)` tuples, most
+        recently used first."""
+        entries = []
+        if not path.isdir(self.dir):
+            return entries
+        for root, dirs, files in os.walk(self.dir):
+            for name in files:
+                if not name.endswith(".tar.gz"):
+                    continue
+                try:
+                    st = os.stat(path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((name[:-len(".tar.gz")], st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2], reverse=True)
+
+    def size(self):
+        return sum(size for key, size, last_used in self.entries())
+
+    def prune(self, max_size=None, keep=None):
+        """Evict least recently used archives, but for that of `keep`,
+        until the store fits in `max_size` bytes. Returns the number of
+        bytes freed."""
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(size for key, size, last_used in entries)
+        freed = 0
+        for key, size, last_used in reversed(entries):
+            if total <= max_size:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                # Evicted by another process
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+            freed += size
+        return freed
+
+
+class HttpStore(object):
+    """Build archives on a plain HTTP server: fetched with GET, where 404
+    is a miss, and uploaded with PUT. Limiting their size is up to the
+    server."""
+
+    def __init__(self, url):
+        self.url = url if url.endswith("/") else url + "/"
+
+    def __str__(self):
+        return self.url
+
+    def get(self, key, dst):
+        try:
+            resp = urllib2.urlopen(self.url + key + ".tar.gz")
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        with open(dst, "wb") as f:
+            shutil.copyfileobj(resp, f, 1024 * 1024)
+        return True
+
+    def put(self, key, src):
+        with open(src, "rb") as f:
+            # Byte strings throughout, or httplib fails to join the request
+            # line and headers with the binary body
+            request = urllib2.Request((self.url + key + ".tar.gz").encode("utf-8"), data=f.read(),
+                                      headers={b"Content-Type": b"application/gzip"})
+        request.get_method = lambda: b"PUT"
+        urllib2.urlopen(request).close()
+
+
+def open_store(config, default_dir):
+    """The store configured by the [build-cache] table of .vaanibuild: an
+    HTTP server for a "url", else a "dir", by default `default_dir`, of at
+    most "max-size". Returns None if the cache is disabled."""
+    settings = config.get("build-cache", {})
+    if not settings.get("enabled", True):
+        return None
+    if settings.get("url"):
+        return HttpStore(settings["url"])
+    return LocalStore(settings.get("dir", default_dir),
+                      parse_size(settings.get("max-size", DEFAULT_MAX_SIZE)))
+
+
+class BuildCache(object):
+    """Artifacts installed into the local Maven repository by builds of a
+    repository, stored as one archive per cache key."""
+
+    def __init__(self, store, m2repo_dir, tmp_dir):
+        self.store = store
+        self.m2repo_dir = m2repo_dir
+        self.tmp_dir = tmp_dir
+
+    def _tmp_path(self, key):
+        if not path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        return path.join(self.tmp_dir, key + ".tar.gz")
+
+    def restore(self, key):
+        """Unpack the artifacts stored under `key` into the local Maven
+        repository. Returns whether there were any."""
+        archive_path = self._tmp_path(key)
+        try:
+            if not self.store.get(key, archive_path):
+                return False
+            with tarfile.open(archive_path) as tar:
+                extract_members(tar, self.m2repo_dir)
+            return True
+        finally:
+            if path.exists(archive_path):
+                os.remove(archive_path)
+
+    def save(self, key, rel_paths):
+        """Store the directories `rel_paths` of the local Maven repository
+        under `key`. Returns the size of the archive."""
+        archive_path = self._tmp_path(key)
+        try:
+            with tarfile.open(archive_path, "w:gz") as tar:
+                for rel_path in rel_paths:
+                    tar.add(path.join(self.m2repo_dir, *rel_path.split("/")), rel_path)
+            self.store.put(key, archive_path)
+            return path.getsize(archive_path)
+        finally:
+            if path.exists(archive_path):
+                os.remove(archive_path)
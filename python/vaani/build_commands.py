@@ -4,6 +4,7 @@
 
 from __future__ import print_function, unicode_literals
 
+import contextlib
 import datetime
 import os
 import os.path as path
@@ -17,9 +18,35 @@ from mach.decorators import (
     CommandArgument,
     CommandProvider,
     Command,
+    SubCommand
 )
 
 from vaani.command_base import *
+from vaani.buildlog import BuildLog, MODULE_START
+from vaani.build_history import BuildHistory, ReactorSummaryParser, regressions, series, median
+from vaani.artifact_cache import parse_size
+from vaani.build_cache import (BuildCache, CACHE_ERRORS, LocalStore, cache_key, installed_paths,
+                               open_store)
+from vaani.build_manifest import BuildManifest, fingerprint
+from vaani import gitutil, overlay, testshard, trace
+from vaani.pom import read_modules, write_aggregator, PomError
+from vaani.download import format_size
+from vaani.locks import holding
+from vaani.parallel import default_jobs, parallel_map, run_graph, FAILED, CANCELLED
+from vaani.repos import RepoGraph
+from vaani.tasks import task_display
+
+def tree_size(root_dir):
+    """Bytes taken by the files below `root_dir`."""
+    size = 0
+    for root, dirs, files in os.walk(root_dir):
+        for name in files:
+            try:
+                size += os.lstat(path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
 
 def notify_linux(title, text):
     try:
@@ -111,36 +138,873 @@ class MachCommands(CommandBase):
              description='Clean repositories',
              category='build')
     @CommandArgument('repository')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Number of build directories to remove concurrently, or with --maven, '
+                          'of repositories to clean concurrently')
+    @CommandArgument('--maven',
+                     action='store_true',
+                     help='Run mvn clean instead of removing the build directories directly')
+    @CommandArgument('--dry-run', '-n',
+                     action='store_true',
+                     help='Only show what would be removed')
+    @CommandArgument('--resource-profile',
+                     default=None,
+                     help='Resource profile sizing the Maven JVMs, e.g. laptop or ci')
+    @CommandArgument('--capture-logs',
+                     action='store_true',
+                     help='Write the Maven output to compressed logs in shared/logs and only show '
+                          'a status line per repository (always on with --jobs above 1)')
     @CommandArgument('--verbosity', '-v',
                      default=2)
-    def clean(self, repository='all', verbosity=2):
-        self.maven(repository, "clean", "Cleaning", verbosity)
+    def clean(self, repository='all', jobs=None, maven=False, dry_run=False, resource_profile=None,
+              capture_logs=False, verbosity=2):
+        self.resource_profile_name = resource_profile
+        self.capture_logs_option = capture_logs
+        if maven:
+            if dry_run:
+                print("--dry-run can't be combined with --maven.")
+                return 1
+            return self.maven(repository, "clean", "Cleaning", verbosity, jobs=jobs or 1)
+        return self.clean_native(repository, jobs or default_jobs(), dry_run, verbosity)
+
+    def clean_native(self, repository, jobs, dry_run=False, verbosity=2):
+        """Remove the build directories of all modules found in the POM
+        module tree with a pool of threads, without starting Maven.
+
+        Repositories configuring the maven-clean-plugin, which may clean
+        more than that, are cleaned with mvn clean."""
+        if repository == 'all':
+            repos = self.checked_out_repos()
+        elif repository in self.context.repos:
+            repos = [repository]
+        else:
+            print("Unknown repository: %s" % repository)
+            return 1
+
+        targets = []
+        custom = []
+        failed = []
+        for repo in repos:
+            try:
+                modules = list(read_modules(path.join(self.context.git_dir, repo)).walk())
+            except PomError as e:
+                print("%s; try clean --maven." % e)
+                failed.append(repo)
+                continue
+            if any(module.custom_clean for module in modules):
+                custom.append(repo)
+                continue
+            targets += [(repo, module.build_dir) for module in modules if path.isdir(module.build_dir)]
+
+        def remove(target):
+            size = tree_size(target[1])
+            if not dry_run:
+                shutil.rmtree(target[1])
+            return size
+
+        reclaimed = dict((repo, [0, 0]) for repo in repos)
+        for (repo, build_dir), size, exc_info in parallel_map(remove, targets, jobs=jobs):
+            if exc_info is not None:
+                print("Could not remove %s: %s" % (build_dir, exc_info[1]))
+                if repo not in failed:
+                    failed.append(repo)
+                continue
+            reclaimed[repo][0] += 1
+            reclaimed[repo][1] += size
+            if dry_run and show_help(verbosity):
+                print("Would remove %s (%s)" % (build_dir, format_size(size)))
+
+        manifest = BuildManifest(self.context.build_manifest_path)
+        for repo in repos:
+            if repo in custom or repo in failed and not reclaimed[repo][0]:
+                continue
+            count, size = reclaimed[repo]
+            print("%s: %s %d build directories, %s." % (repo, "would remove" if dry_run else "removed",
+                                                       count, format_size(size)))
+            if not dry_run:
+                # The recorded builds no longer match what is on disk
+                manifest.forget(repo)
+        if not dry_run:
+            for repo in custom:
+                print("%s configures the maven-clean-plugin; running mvn clean." % repo)
+                if self.maven(repo, "clean", "Cleaning", verbosity):
+                    failed.append(repo)
+        elif custom:
+            print("Would run mvn clean in %s (maven-clean-plugin configured)." % ", ".join(custom))
+        if len(repos) > 1:
+            print("%s %s in total." % ("Would reclaim" if dry_run else "Reclaimed",
+                                      format_size(sum(size for _, size in reclaimed.values()))))
+        return 1 if failed else 0
 
     @Command('build',
-             description='Build one repository by specifying its name ("smarthome", "openhab-core", "openhab", "openhab2-addons", "openhab-distro") or all repositories in the right order by keyword "all".',
+             description='Build one repository by specifying its name ("smarthome", "openhab-core", "openhab", "openhab2-addons", "openhab-distro") or all repositories in the right order by keyword "all". Keyword "changed" rebuilds only the modules changed since the last successful build and the modules depending on them.',
              category='build')
     @CommandArgument('repository')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=1,
+                     help='Number of repositories to build concurrently once their upstreams are installed')
+    @CommandArgument('--force', '-f',
+                     action='store_true',
+                     help='Build even if nothing changed since the last build')
+    @CommandArgument('--no-build-cache',
+                     action='store_true',
+                     help='Build even if the build cache has the artifacts of a repository, '
+                          'and do not store them there')
+    @CommandArgument('--aggregate',
+                     action='store_true',
+                     help='Build all repositories in a single Maven reactor')
+    @CommandArgument('--threads', '-T',
+                     default=None,
+                     help='Maven module build threads, e.g. 4 or 1C')
+    @CommandArgument('--resource-profile',
+                     default=None,
+                     help='Resource profile sizing the Maven JVMs, e.g. laptop or ci')
+    @CommandArgument('--capture-logs',
+                     action='store_true',
+                     help='Write the Maven output to compressed logs in shared/logs and only show '
+                          'a status line per repository (always on with --jobs above 1)')
     @CommandArgument('--verbosity', '-v',
                      default=2)
-    def build(self, repository='all', verbosity=2):
-        self.maven(repository, "install", "Building", verbosity)
+    def build(self, repository='all', jobs=1, force=False, no_build_cache=False, aggregate=False,
+              threads=None, resource_profile=None, capture_logs=False, verbosity=2):
+        self.resource_profile_name = resource_profile
+        self.capture_logs_option = capture_logs
+        if repository == 'changed':
+            return self.maven_changed(verbosity, threads=threads, use_cache=not no_build_cache)
+        if aggregate:
+            if repository != 'all':
+                print("--aggregate always builds all repositories.")
+                return 1
+            return self.maven_aggregate(verbosity, threads=threads, force=force,
+                                        use_cache=not no_build_cache)
+        return self.maven(repository, "install", "Building", verbosity, jobs=jobs, force=force,
+                          threads=threads, use_cache=not no_build_cache)
 
-    def maven(self, repository, command, verb, verbosity=2):
-        self.ensure_bootstrapped()
+    def maven_setup(self, verbosity, jobs=1, threads=None):
+        """Return the environment and the options of the Maven processes."""
+        profile = self.resource_profile()
+        env = self.build_env(jobs)
+        threads = threads or profile.threads(jobs)
+        if show_help(verbosity):
+            print("Resource profile %s: MAVEN_OPTS=\"%s\"%s" % (profile.name, env['MAVEN_OPTS'],
+                                                               " -T " + threads if threads else ""))
         opts = ["-Dmaven.repo.local=" + self.context.m2repo_dir]
         if not verbosity:
             opts += ["-q"]
+        if threads:
+            opts += ["-T", threads]
+        return env, opts
+
+    def capture_logs(self, jobs=1):
+        """Whether Maven's output goes to logs instead of the terminal; the
+        output of concurrent builds would interleave."""
+        return (getattr(self, "capture_logs_option", False) or jobs > 1 or
+                self.config.get("build", {}).get("capture-logs", False))
+
+    @contextlib.contextmanager
+    def build_display(self, names, capture):
+        """A TaskDisplay for `names` when capturing logs, else None."""
+        if not capture:
+            yield None
+            return
+        mkdir_p(self.context.logs_dir)
+        with task_display(names) as display:
+            yield display
+
+    @trace.traced("maven", "name")
+    def call_maven(self, name, args, env, cwd, parser, verbosity, display=None):
+        """Run Maven, feeding its output to `parser`.
+
+        With a display, the output goes to a compressed log in the logs
+        directory instead of the terminal, and the display shows the module
+        being built. Only if Maven fails are the last lines of the log
+        printed. Reading the output happens in the calling thread, which
+        for concurrent builds is a worker of its own per repository."""
+        if display is None:
+            return call_lines(args, env=env, cwd=cwd, verbose=verbosity > 2, on_line=parser.feed)
+
+        log = BuildLog(path.join(self.context.logs_dir, name + ".log.gz"))
+        modules = []
+
+        def on_line(line):
+            parser.feed(line)
+            log.write(line)
+            match = MODULE_START.match(line.rstrip())
+            if match:
+                modules.append(match.group(1))
+                display.set_status(name, "%d. %s" % (len(modules), match.group(1)))
+
+        try:
+            result = call_lines(args, env=env, cwd=cwd, verbose=verbosity > 2, on_line=on_line,
+                                echo=False)
+        finally:
+            log.close()
+        if result:
+            print("The last %d of %d lines of %s:" % (len(log.tail), log.lines, log.path))
+            for line in log.tail:
+                print("  " + line)
+        print("%s after %d modules; log in %s" % ("Failed" if result else "Done", len(modules),
+                                                  log.path))
+        return result
+
+    def maven_aggregate(self, verbosity=2, threads=None, force=False, use_cache=False):
+        """Build all checked out repositories in one reactor through a
+        generated aggregator POM. This saves a JVM start and plugin
+        resolution per repository, and with --threads Maven can build
+        modules of different repositories in parallel."""
+        self.ensure_bootstrapped()
+        repos = self.checked_out_repos()
+        if not repos:
+            print("No repositories checked out in %s." % self.context.git_dir)
+            return 1
+
+        manifest = BuildManifest(self.context.build_manifest_path)
+        states = self.reactor_states(repos, manifest)
+        if not force and all(states[repo][0] and states[repo][0] == manifest.fingerprint(repo)
+                             for repo in repos):
+            print("Skipping the aggregate build: no repository changed since its last build.")
+            return 0
+        return self.maven_reactor("aggregate", repos, [], states, manifest,
+                                  "Building " + ", ".join(repos) + " in one reactor",
+                                  verbosity, threads, use_cache=use_cache)
+
+    def dirty_files(self, repo, head, dirty):
+        """The files of `repo` with uncommitted changes, if it has any."""
+        if not dirty:
+            return None
+        try:
+            return gitutil.changed_files(path.join(self.context.git_dir, repo), head)
+        except gitutil.GitError:
+            return None
+
+    def checked_out_repos(self):
+        return [repo for repo in self.context.repos
+                if path.exists(path.join(self.context.git_dir, repo, "pom.xml"))]
+
+    def reactor_states(self, repos, manifest):
+        """Fingerprint `repos` for a build in one reactor, in which
+        upstreams get the fingerprint they will be recorded with."""
+        states = {}
+        fingerprints = {}
+        for repo in repos:
+            upstreams = dict((upstream, fingerprints.get(upstream, manifest.fingerprint(upstream)))
+                             for upstream in self.context.repos.upstreams(repo))
+            states[repo] = fingerprint(path.join(self.context.git_dir, repo), upstreams) + (upstreams,)
+            fingerprints[repo] = states[repo][0]
+        return states
+
+    def maven_reactor(self, name, repos, args, states, manifest, title, verbosity, threads,
+                      forget_on_failure=True, use_cache=False):
+        """Install `repos` in one reactor through a generated aggregator POM,
+        passing `args` to Maven, and record the build under `name`. What
+        it installed is recorded under the build cache keys a build of
+        each repository on its own would have, so that later builds of
+        them and their downstreams can use the build cache."""
+        mkdir_p(self.context.local_dir)
+        pom_path = write_aggregator(path.join(self.context.local_dir, "aggregate", "pom.xml"),
+                                    [path.join(self.context.git_dir, repo) for repo in repos])
+        env, opts = self.maven_setup(verbosity, threads=threads)
+        print_header(verbosity, title)
+        locks = [self.lock("repo-" + repo, local=True) for repo in repos]
+        locks.append(self.lock("m2repo", shared=True, local=True))
+        parser = ReactorSummaryParser()
+        start_time = time()
+        with holding(locks), self.build_display([name], self.capture_logs()) as display:
+            self.detach_installs(repos)
+            if display is not None:
+                display.register(name)
+            result = self.call_maven(name, ["mvn", "-f", pom_path, "install"] + args + opts,
+                                     env, self.context.topdir, parser, verbosity, display)
+            if display is not None:
+                display.register(None)
+        elapsed = time() - start_time
+        print_footer(verbosity)
+        BuildHistory(self.context.build_history_path).append({
+            "build": start_time,
+            "time": start_time,
+            "command": "install",
+            "repo": name,
+            "repos": repos,
+            "elapsed": elapsed,
+            "result": result,
+            "threads": threads,
+            "modules": parser.modules,
+        })
+        cache = self.build_cache() if use_cache and not result else None
+        keys = {}
+        for repo in repos:
+            current, head, dirty, upstreams = states[repo]
+            if not result and current:
+                if head and not dirty:
+                    upstream_keys = dict((upstream, keys.get(upstream, manifest.cache_key(upstream)))
+                                         for upstream in upstreams)
+                    if all(upstream_keys.values()):
+                        keys[repo] = cache_key(repo, head, upstream_keys, ["install"])
+                # A repository the reactor left alone is stored already
+                if cache is not None and repo in keys and keys[repo] != manifest.cache_key(repo):
+                    self.save_build(cache, repo, keys[repo])
+                manifest.record(repo, current, head, dirty, upstreams, keys.get(repo),
+                                dirty_files=self.dirty_files(repo, head, dirty))
+            elif forget_on_failure or not current:
+                manifest.forget(repo)
+
+        if result:
+            print_header(verbosity, "Failed")
+        print_header(verbosity, "Completed in %s" % str(datetime.timedelta(seconds=elapsed)))
+        if show_result(verbosity):
+            notify_build_done(elapsed)
+        return result
+
+    def maven_changed(self, verbosity=2, threads=None, use_cache=False):
+        """Rebuild the modules changed since the last successful build of
+        their repository, by commits or in the working tree, and everything
+        depending on them, across repositories, in one reactor."""
+        self.ensure_bootstrapped()
+        repos = self.checked_out_repos()
+        if not repos:
+            print("No repositories checked out in %s." % self.context.git_dir)
+            return 1
+
+        manifest = BuildManifest(self.context.build_manifest_path)
+        states = self.reactor_states(repos, manifest)
+        selected = []
+        for repo in repos:
+            repo_dir = path.join(self.context.git_dir, repo)
+            entry = manifest.get(repo)
+            _, head, dirty, _ = states[repo]
+            if entry and head and (entry.get("head"), entry.get("dirty")) == (head, dirty):
+                # Same commit and same local changes as last built
+                continue
+            try:
+                root = read_modules(repo_dir)
+            except PomError as e:
+                print(e)
+                return 1
+            files = None
+            # What a dirty build installed of uncommitted changes differs
+            # from the tree even once they are undone; if it is unknown
+            # which files those were, the whole repository is rebuilt
+            dirty_files = entry.get("dirty_files") if entry else None
+            if entry and entry.get("head") and (dirty_files is not None or
+                                                not entry.get("dirty")):
+                try:
+                    files = sorted(set(gitutil.changed_files(repo_dir, entry["head"])) |
+                                   set(dirty_files or []))
+                except gitutil.GitError:
+                    # e.g. the commit is gone after a rebase
+                    pass
+            if files is None:
+                print("%s: no successful build to compare with; rebuilding all of it." % repo)
+                modules = list(root.walk())
+            else:
+                modules = []
+                for name in files:
+                    module = root.owner(path.join(repo_dir, name))
+                    if module is not None and module not in modules:
+                        modules.append(module)
+                if modules:
+                    print("%s: %d changed files in %s." % (repo, len(files),
+                                                          ", ".join(module.artifact_id for module in modules)))
+            selected += modules
+        if not selected:
+            print("Nothing changed since the last successful builds.")
+            return 0
+
+        return self.maven_reactor("changed", repos,
+                                  ["--projects", ",".join(module.id for module in selected),
+                                   "--also-make-dependents"],
+                                  states, manifest,
+                                  "Building %d changed modules and their dependents" % len(selected),
+                                  verbosity, threads,
+                                  # The changes are still found against the
+                                  # last successful builds next time
+                                  forget_on_failure=False, use_cache=use_cache)
+
+    def detach_installs(self, repos):
+        """In a workspace, make sure installing `repos` writes to files of
+        the overlay only, not to ones it shares with the shared Maven
+        repository."""
+        if not self.context.workspace:
+            return
+        modules = []
+        for repo in repos:
+            try:
+                modules += read_modules(path.join(self.context.git_dir, repo)).walk()
+            except PomError:
+                # Maven will tell
+                pass
+        overlay.detach(self.context.m2repo_dir, overlay.owned_dirs(modules))
+
+    def build_cache(self):
+        store = open_store(self.config, path.join(self.context.cache_dir, "builds"))
+        if store is None:
+            return None
+        return BuildCache(store, self.context.m2repo_dir, path.join(self.context.local_dir, "tmp"))
+
+    def restore_build(self, cache, repo, key):
+        """Restore the artifacts of `repo` from the build cache. Returns
+        whether they were there."""
+        try:
+            restored = cache.restore(key)
+        except CACHE_ERRORS as e:
+            print("Could not restore %s from the build cache: %s" % (repo, e))
+            return False
+        if restored:
+            print("Restored %s from the build cache %s (key %s)." % (repo, cache.store, key[:12]))
+        return restored
+
+    def save_build(self, cache, repo, key):
+        """Store the artifacts `repo` installed in the build cache."""
+        try:
+            modules = list(read_modules(path.join(self.context.git_dir, repo)).walk())
+        except PomError as e:
+            print("Not caching %s: %s" % (repo, e))
+            return
+        rel_paths = installed_paths(modules, self.context.m2repo_dir)
+        if not rel_paths:
+            print("Not caching %s: its artifacts can't be located without Maven." % repo)
+            return
+        try:
+            size = cache.save(key, rel_paths)
+        except CACHE_ERRORS as e:
+            print("Could not store %s in the build cache: %s" % (repo, e))
+            return
+        print("Stored %s in the build cache (%s)." % (repo, format_size(size)))
+
+    def maven(self, repository, command, verb, verbosity=2, jobs=1, force=False, threads=None,
+              use_cache=False):
+        self.ensure_bootstrapped()
+        env, opts = self.maven_setup(verbosity, jobs=min(jobs, len(self.context.repos)), threads=threads)
         if repository == 'all':
-            repos = self.context.repos
-        else:
+            repos = list(self.context.repos)
+        elif repository in self.context.repos:
             repos = [repository]
+        else:
+            print("Unknown repository: %s" % repository)
+            return 1
+
+        graph = self.context.repos
+        if command != "install":
+            # Only installing needs the artifacts of the upstream repositories
+            graph = RepoGraph([(repo, []) for repo in repos])
+
+        manifest = BuildManifest(self.context.build_manifest_path)
+        mkdir_p(self.context.local_dir)
+        history = BuildHistory(self.context.build_history_path)
         start_time = time()
-        for repo in repos:
-            print_header(verbosity, verb + " " + repo)
+        capture = self.capture_logs(jobs)
+        # Only installs put artifacts into the local repository
+        cache = self.build_cache() if use_cache and command == "install" else None
+
+        # `display` is bound by the with statement below
+        def run(repo):
+            if display is not None:
+                display.register(repo)
+            try:
+                # A build of the repository by another process is waited for,
+                # and may leave nothing to do
+                with self.lock("repo-" + repo, local=True):
+                    manifest.reload()
+                    return build(repo, display)
+            finally:
+                if display is not None:
+                    display.register(None)
+
+        def build(repo, display):
             repo_dir = path.join(self.context.git_dir, repo)
-            call(["mvn", command] + opts, env=self.build_env(), cwd=repo_dir, verbose=verbosity > 2)
-            print_footer(verbosity)
+            key = None
+            if command == "install":
+                upstreams = dict((upstream, manifest.fingerprint(upstream))
+                                 for upstream in self.context.repos.upstreams(repo))
+                current, head, dirty = fingerprint(repo_dir, upstreams)
+                if not force and current and current == manifest.fingerprint(repo):
+                    print("Skipping %s: unchanged since its last build (HEAD %s%s, same upstream builds)."
+                          % (repo, head[:12], " with the same local changes" if dirty else ""))
+                    if display is not None:
+                        display.set_status(repo, "unchanged")
+                    return 0
+                if cache is not None and head and not dirty:
+                    # Only committed states can be shared
+                    upstream_keys = dict((upstream, manifest.cache_key(upstream))
+                                         for upstream in upstreams)
+                    if all(upstream_keys.values()):
+                        key = cache_key(repo, head, upstream_keys, [command])
+                if key and self.restore_build(cache, repo, key):
+                    manifest.record(repo, current, head, dirty, upstreams, key)
+                    if display is not None:
+                        display.set_status(repo, "restored from the build cache")
+                    return 0
+            # Multi-line headers of concurrent repositories would interleave
+            if jobs > 1 or display is not None:
+                print("%s %s..." % (verb, repo))
+            else:
+                print_header(verbosity, verb + " " + repo)
+            if command == "install":
+                self.detach_installs([repo])
+            parser = ReactorSummaryParser()
+            repo_start = time()
+            result = self.call_maven(repo, ["mvn", command] + opts, env, repo_dir, parser,
+                                     verbosity, display)
+            history.append({
+                "build": start_time,
+                "time": repo_start,
+                "command": command,
+                "repo": repo,
+                "elapsed": time() - repo_start,
+                "result": result,
+                "jobs": jobs,
+                "modules": parser.modules,
+            })
+            if display is None:
+                if jobs > 1:
+                    print("%s %s %s." % (verb, repo, "failed" if result else "done"))
+                else:
+                    print_footer(verbosity)
+            if command == "install" and not result and current:
+                if key:
+                    self.save_build(cache, repo, key)
+                manifest.record(repo, current, head, dirty, upstreams, key,
+                                dirty_files=self.dirty_files(repo, head, dirty))
+            else:
+                # A failed install or a clean may leave the installed
+                # artifacts out of sync with the recorded state
+                manifest.forget(repo)
+            return result
+
+        def skip(repo, upstream):
+            print("Skipping %s because %s failed." % (repo, upstream))
+            if display is not None:
+                display.set_status(repo, "skipped, %s failed" % upstream)
+
+        # Maven also reads the local repository to clean; a refresh of it
+        # waits for the builds to finish
+        with self.lock("m2repo", shared=True, local=True):
+            with self.build_display(repos, capture) as display:
+                results = run_graph(graph, repos, run, jobs=jobs, on_cancel=skip)
         elapsed = time() - start_time
+        failed = [repo for repo, state in results if state == FAILED]
+        cancelled = [repo for repo, state in results if state == CANCELLED]
+        if failed:
+            print_header(verbosity, "Failed: %s" % ", ".join(failed))
+            if cancelled:
+                print("Not %s: %s" % (verb.lower(), ", ".join(cancelled)))
         print_header(verbosity, "Completed in %s" % str(datetime.timedelta(seconds=elapsed)))
         if show_result(verbosity):
             notify_build_done(elapsed)
+        return 1 if failed else 0
+
+    @Command('build-stats',
+             description='Show build time trends, the slowest modules and regressions',
+             category='build')
+    @CommandArgument('--repository', '-r',
+                     default=None,
+                     help='Only show this repository')
+    @CommandArgument('--last', '-n',
+                     type=int, default=10,
+                     help='Number of past builds making up trends and the regression baseline')
+    @CommandArgument('--top',
+                     type=int, default=10,
+                     help='Number of slowest modules to show')
+    @CommandArgument('--threshold',
+                     type=float, default=20,
+                     help='Percentage above the baseline that counts as a regression')
+    @CommandArgument('--min-seconds',
+                     type=float, default=5,
+                     help='Ignore regressions of fewer seconds')
+    def build_stats(self, repository=None, last=10, top=10, threshold=20, min_seconds=5):
+        records = BuildHistory(self.context.build_history_path).records()
+        if repository:
+            records = [record for record in records if record["repo"] == repository]
+        if not records:
+            print("No builds recorded yet.")
+            return 0
+        repo_times, module_times = series(records)
+
+        def fmt(seconds):
+            return "%d:%02d" % divmod(int(round(seconds)), 60)
+
+        print("Build times of the last %d successful builds, oldest first:" % last)
+        # Aggregate builds are recorded under a name of their own
+        others = sorted(repo for repo in repo_times if repo not in self.context.repos)
+        for repo in list(self.context.repos) + others:
+            if repo in repo_times:
+                values = repo_times[repo][-last:]
+                print("  %-16s median %6s  %s" % (repo, fmt(median(values)),
+                                                  " ".join(fmt(value) for value in values)))
+
+        print()
+        print("Slowest modules, by median of the last %d builds:" % last)
+        slowest = sorted(((median(values[-last:]), key) for key, values in module_times.items()),
+                         reverse=True)[:top]
+        for seconds, (repo, module) in slowest:
+            print("  %6s  %s / %s" % (fmt(seconds), repo, module))
+        if not slowest:
+            print("  No module timings; they are read from the Maven reactor summary.")
+
+        print()
+        found = regressions(dict(((repo,), values) for repo, values in repo_times.items()),
+                            last, threshold / 100.0, min_seconds)
+        found += regressions(module_times, last, threshold / 100.0, min_seconds)
+        if not found:
+            print("No regressions against the median of the previous %d builds." % last)
+            return 0
+        print("Regressions against the median of the previous %d builds:" % last)
+        for key, latest, baseline in found:
+            print("  %s: %s instead of %s (+%d%%)" % (" / ".join(key), fmt(latest), fmt(baseline),
+                                                     (latest - baseline) * 100 / max(baseline, 0.001)))
+        return 0
+
+    def local_build_store(self):
+        """The build cache store, or None, after saying why, if it is not a
+        directory of this machine."""
+        store = open_store(self.config, path.join(self.context.cache_dir, "builds"))
+        if store is None:
+            print("The build cache is disabled.")
+            return None
+        if not isinstance(store, LocalStore):
+            print("The build cache is at %s; its server limits its size." % store)
+            return None
+        return store
+
+    @Command('build-cache',
+             description='Show statistics of the build cache',
+             category='build')
+    def build_cache_stats(self):
+        store = self.local_build_store()
+        if store is None:
+            return 0
+        entries = store.entries()
+        print("Build cache: %s" % store)
+        print("%d builds, %s of %s" % (len(entries), format_size(sum(entry[1] for entry in entries)),
+                                      format_size(store.max_size)))
+        for key, size, last_used in entries:
+            print("  %10s  %s  %s" % (format_size(size),
+                                      datetime.datetime.fromtimestamp(last_used).strftime("%Y-%m-%d %H:%M"),
+                                      key))
+
+    @SubCommand('build-cache', 'prune',
+                description='Evict least recently used builds from the build cache')
+    @CommandArgument('--max-size',
+                     default=None,
+                     help='Size to shrink the cache to, e.g. 500M (default: the configured cache size)')
+    def build_cache_prune(self, max_size=None):
+        store = self.local_build_store()
+        if store is None:
+            return 1
+        freed = store.prune(None if max_size is None else parse_size(max_size))
+        print("Freed %s; the build cache now holds %s." % (format_size(freed), format_size(store.size())))
+
+    @Command('test',
+             description='Run the tests of the repositories, split into shards of about equal '
+                         'duration that run as concurrent Maven processes',
+             category='testing')
+    @CommandArgument('repository',
+                     nargs='?', default='all')
+    @CommandArgument('--shard-count', '-n',
+                     type=int, default=None,
+                     help='Shards to split the test classes into (default: half the CPUs)')
+    @CommandArgument('--shard-index',
+                     type=int, default=None,
+                     help='Only run this shard, counting from 1, e.g. in one job of a CI matrix; '
+                          'all jobs must use the same --shard-count and times file')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Shards to run concurrently (default: all)')
+    @CommandArgument('--times',
+                     default=None,
+                     help='JSON file of the durations of the test classes, read to balance the '
+                          'shards and updated from the reports (default: test-times.json next to '
+                          'the build manifest)')
+    @CommandArgument('--merge-times',
+                     nargs='+', default=None, metavar='FILE',
+                     help='Only merge the durations written by --shard-index runs, e.g. of all '
+                          'jobs of a CI matrix, into the times file')
+    @CommandArgument('--no-compile',
+                     action='store_true',
+                     help='Run the tests compiled by an earlier run')
+    @CommandArgument('--list',
+                     action='store_true', dest='list_shards',
+                     help='Only print the shards and their estimated durations')
+    @CommandArgument('--resource-profile',
+                     default=None,
+                     help='Resource profile sizing the Maven JVMs, e.g. laptop or ci')
+    @CommandArgument('--verbosity', '-v',
+                     default=2)
+    def test(self, repository='all', shard_count=None, shard_index=None, jobs=None, times=None,
+             merge_times=None, no_compile=False, list_shards=False, resource_profile=None,
+             verbosity=2):
+        self.resource_profile_name = resource_profile
+        times = times or path.join(self.context.local_dir, "test-times.json")
+        if merge_times:
+            merged = {}
+            for times_file in merge_times:
+                try:
+                    merged.update(testshard.read_times(times_file))
+                except (IOError, ValueError) as e:
+                    print("Could not read %s: %s" % (times_file, e))
+                    return 1
+            testshard.TestTimes(times).update(merged)
+            print("Merged the durations of %d test classes into %s." % (len(merged), times))
+            return 0
+        if repository == 'all':
+            repos = self.checked_out_repos()
+        elif repository in self.context.repos:
+            repos = [repository]
+        else:
+            print("Unknown repository: %s" % repository)
+            return 1
+        shard_count = shard_count or max(1, default_jobs() // 2)
+        if shard_index is not None and not 1 <= shard_index <= shard_count:
+            print("--shard-index must be between 1 and %d." % shard_count)
+            return 1
+
+        tests = []
+        for repo in repos:
+            try:
+                tests += testshard.discover(repo, read_modules(path.join(self.context.git_dir, repo)))
+            except PomError as e:
+                print(e)
+                return 1
+        if not tests:
+            print("No test classes found in %s." % ", ".join(repos))
+            return 0
+        test_times = testshard.TestTimes(times)
+        shards = testshard.split(tests, shard_count, test_times)
+        selected = range(shard_count) if shard_index is None else [shard_index - 1]
+        print("%d test classes in %d shards, by the durations in %s:"
+              % (len(tests), shard_count, test_times.path))
+        for index in selected:
+            shard_tests, estimate = shards[index]
+            print("  shard %d/%d: %4d classes, about %s" % (index + 1, shard_count, len(shard_tests),
+                                                           datetime.timedelta(seconds=int(estimate))))
+            if list_shards and show_help(verbosity):
+                for test in shard_tests:
+                    print("    %s (%.1fs)" % (test.name, test_times.estimate(test.name)))
+        selected = [index for index in selected if shards[index][0]]
+        if list_shards or not selected:
+            return 0
+
+        self.ensure_bootstrapped()
+        jobs = min(jobs or len(selected), len(selected))
+        env, opts = self.maven_setup(verbosity, jobs=jobs)
+        test_dir = path.join(self.context.local_dir, "test")
+        pom_path = write_aggregator(path.join(test_dir, "pom.xml"),
+                                    [path.join(self.context.git_dir, repo) for repo in repos])
+        selected_tests = [test for index in selected for test in shards[index][0]]
+        # Reports of earlier runs would pass for those of this one
+        for test in selected_tests:
+            if path.exists(testshard.report_path(test)):
+                os.remove(testshard.report_path(test))
+
+        def projects(tests):
+            return ",".join(sorted(set(test.module.id for test in tests)))
+
+        names = ["test-%d-of-%d" % (index + 1, shard_count) for index in selected]
+        locks = [self.lock("repo-" + repo, local=True) for repo in repos]
+        locks.append(self.lock("m2repo", shared=True, local=True))
+        start_time = time()
+        with holding(locks):
+            if not no_compile:
+                # Once for all shards, which then only run tests
+                print_header(verbosity, "Compiling the tests of " + ", ".join(repos))
+                with self.build_display(["test-compile"], self.capture_logs()) as display:
+                    if display is not None:
+                        display.register("test-compile")
+                    result = self.call_maven("test-compile",
+                                             ["mvn", "-f", pom_path, "test-compile",
+                                              "--projects", projects(selected_tests),
+                                              "--also-make"] + opts,
+                                             env, self.context.topdir, ReactorSummaryParser(),
+                                             verbosity, display)
+                print_footer(verbosity)
+                if result:
+                    print("Compiling the tests failed.")
+                    return result
+
+            def run(index):
+                shard_tests = shards[index][0]
+                name = names[selected.index(index)]
+                if display is not None:
+                    display.register(name)
+                try:
+                    shard_start = time()
+                    result = self.call_maven(name,
+                                             ["mvn", "-f", pom_path, "surefire:test", "--fail-at-end",
+                                              "--projects", projects(shard_tests),
+                                              "-Dtest=" + ",".join(test.name for test in shard_tests),
+                                              "-DfailIfNoTests=false",
+                                              "-Dsurefire.failIfNoSpecifiedTests=false"] + opts,
+                                             env, self.context.topdir, ReactorSummaryParser(),
+                                             verbosity, display)
+                    return result, time() - shard_start
+                finally:
+                    if display is not None:
+                        display.register(None)
+
+            print_header(verbosity, "Running %d shards" % len(selected))
+            with self.build_display(names, self.capture_logs(jobs)) as display:
+                outcomes = parallel_map(run, selected, jobs=jobs)
+        elapsed = time() - start_time
+
+        suites = []
+        missing = []
+        failed_tests = []
+        recorded = {}
+        for test in selected_tests:
+            suite = testshard.read_report(testshard.report_path(test))
+            if suite is None:
+                missing.append(test)
+                continue
+            suites.append(suite)
+            try:
+                recorded[test.name] = float(suite.get("time", 0))
+            except ValueError:
+                pass
+            if int(suite.get("failures", 0)) or int(suite.get("errors", 0)):
+                failed_tests.append(test)
+        if shard_index is None:
+            test_times.update(recorded)
+        else:
+            # Left to |test --merge-times| once all shards ran
+            shard_times = testshard.shard_times_path(times, shard_index, shard_count)
+            testshard.write_times(shard_times, recorded)
+            print("Durations written to %s." % shard_times)
+        report_name = "results.xml" if shard_index is None else "results-%d-of-%d.xml" % (shard_index,
+                                                                                          shard_count)
+        totals = testshard.merge_reports(suites, path.join(test_dir, report_name))
+
+        print_header(verbosity, "Test summary")
+        failed_shards = []
+        for index, outcome, exc_info in outcomes:
+            if exc_info is not None:
+                print("  shard %d/%d: %s" % (index + 1, shard_count, exc_info[1]))
+                failed_shards.append(index)
+                continue
+            result, shard_elapsed = outcome
+            if result:
+                failed_shards.append(index)
+            print("  shard %d/%d: %s in %s (estimated %s)"
+                  % (index + 1, shard_count, "failed" if result else "passed",
+                     datetime.timedelta(seconds=int(shard_elapsed)),
+                     datetime.timedelta(seconds=int(shards[index][1]))))
+        print("%(tests)d tests, %(failures)d failures, %(errors)d errors, %(skipped)d skipped" % totals)
+        for test in failed_tests:
+            print("  failed: %s (%s)" % (test.name, test.repo))
+        # Classes of a shard whose Maven run failed may never have run, e.g.
+        # because its JVM died; those of a passing shard have no report when
+        # Surefire doesn't run them, e.g. helpers or excluded tests
+        failed_shard_tests = set(test for index in failed_shards for test in shards[index][0])
+        not_run = [test for test in missing if test in failed_shard_tests]
+        if not_run:
+            print("No report of %d test classes of failed shards:" % len(not_run))
+            for test in not_run:
+                print("  not run: %s (%s)" % (test.name, test.repo))
+        skipped = [test for test in missing if test not in failed_shard_tests]
+        if skipped:
+            print("Warning: no report of %d test classes Surefire did not run:" % len(skipped))
+            for test in skipped:
+                print("  no report: %s (%s)" % (test.name, test.repo))
+        print("Merged report: %s" % path.join(test_dir, report_name))
+        print_header(verbosity, "Completed in %s" % str(datetime.timedelta(seconds=elapsed)))
+        return 1 if failed_shards or failed_tests or not_run else 0
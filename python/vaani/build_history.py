@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import json
+import re
+import threading
+
+# e.g. "[INFO] Eclipse SmartHome Core ........ SUCCESS [01:02 min]"
+REACTOR_LINE = re.compile(r"^\[INFO\] (.+?)[ .]*\s(SUCCESS|FAILURE|SKIPPED)"
+                          r"(?: \[\s*([\d:.]+) (s|min|h)\])?\s*$")
+
+
+def parse_duration(value, unit):
+    """Seconds of a reactor summary duration such as "0.528 s",
+    "01:02 min" or "01:02 h"."""
+    parts = [float(part) for part in value.split(":")]
+    if unit == "s":
+        return parts[-1]
+    if unit == "min":
+        return parts[0] * 60 + (parts[1] if len(parts) > 1 else 0)
+    return parts[0] * 3600 + (parts[1] * 60 if len(parts) > 1 else 0)
+
+
+class ReactorSummaryParser(object):
+    """Collect the per-module results of Maven's reactor summary from
+    lines of build output."""
+
+    def __init__(self):
+        self.in_summary = False
+        self.modules = []
+
+    def feed(self, line):
+        line = line.rstrip()
+        if "] Reactor Summary" in line:
+            self.in_summary = True
+            self.modules = []
+            return
+        if not self.in_summary:
+            return
+        match = REACTOR_LINE.match(line)
+        if match:
+            name, status, value, unit = match.groups()
+            self.modules.append({
+                "name": name,
+                "status": status,
+                "seconds": parse_duration(value, unit) if value else None,
+            })
+        elif line.startswith("[INFO] ---"):
+            self.in_summary = bool(not self.modules)
+
+
+class BuildHistory(object):
+    """Timings of past builds, one JSON record per repository and build in
+    a JSON lines file."""
+
+    def __init__(self, history_path):
+        self.path = history_path
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def records(self, command="install"):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # e.g. a line cut short by an interrupted build
+                continue
+            if command is None or record.get("command") == command:
+                records.append(record)
+        return records
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def series(records):
+    """Durations of successful runs per repository and per module, oldest
+    first: `({repo: [seconds]}, {(repo, module): [seconds]})`."""
+    repos = {}
+    modules = {}
+    for record in records:
+        if record.get("result"):
+            continue
+        repos.setdefault(record["repo"], []).append(record["elapsed"])
+        for module in record.get("modules", []):
+            if module["status"] == "SUCCESS" and module["seconds"] is not None:
+                modules.setdefault((record["repo"], module["name"]), []).append(module["seconds"])
+    return repos, modules
+
+
+def regressions(durations, window, threshold, min_seconds):
+    """Entries whose latest duration exceeds the median of the `window`
+    runs before it by more than `threshold` (a fraction) and `min_seconds`.
+
+    Returns `(key, latest, baseline)` tuples, worst first."""
+    found = []
+    for key, values in durations.items():
+        if len(values) < 2:
+            continue
+        latest = values[-1]
+        baseline = median(values[-window - 1:-1])
+        if latest - baseline > min_seconds and latest > baseline * (1 + threshold):
+            found.append((key, latest, baseline))
+    return sorted(found, key=lambda item: item[1] - item[2], reverse=True)
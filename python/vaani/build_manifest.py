@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import json
+import os
+import os.path as path
+import threading
+import time
+
+from vaani import gitutil
+from vaani.locks import FileLock
+
+
+def fingerprint(repo_dir, upstream_fingerprints):
+    """Fingerprint the state of a repository for an install.
+
+    Covers the commit of HEAD, the uncommitted changes and the fingerprints
+    of the upstream repositories the build would be done against. Returns
+    a `(fingerprint, head, dirty)` tuple; fingerprint is None if the
+    repository state can't be determined."""
+    try:
+        commit = gitutil.head(repo_dir)
+        dirty = gitutil.dirty_hash(repo_dir)
+    except (gitutil.GitError, OSError, IOError):
+        return None, None, None
+    digest = hashlib.sha1(commit)
+    digest.update(b"\0" + (dirty or b"").encode("ascii"))
+    for upstream in sorted(upstream_fingerprints):
+        digest.update(b"\0%s=%s" % (upstream.encode("utf-8"),
+                                    (upstream_fingerprints[upstream] or "-").encode("ascii")))
+    return digest.hexdigest(), commit, dirty
+
+
+class BuildManifest(object):
+    """Record of the last successful install of each repository, stored as
+    JSON in the shared directory."""
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Read the manifest again, for what other processes recorded."""
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def _locked(self):
+        # Other processes may be recording builds of other repositories;
+        # the manifest is read again under the lock so as to keep them
+        return FileLock(self.path + ".lock")
+
+    def get(self, repo):
+        return self.entries.get(repo)
+
+    def fingerprint(self, repo):
+        return self.entries.get(repo, {}).get("fingerprint")
+
+    def cache_key(self, repo):
+        return self.entries.get(repo, {}).get("cache_key")
+
+    def record(self, repo, fingerprint, head, dirty, upstreams, cache_key=None, dirty_files=None):
+        """Record a successful install. `dirty_files` lists, of a `dirty`
+        build, the files that differed from `head`: what was installed of
+        them differs from the tree even once their changes are undone."""
+        with self.lock, self._locked():
+            self.reload()
+            self.entries[repo] = {
+                "fingerprint": fingerprint,
+                "head": head,
+                "dirty": dirty,
+                "dirty_files": dirty_files,
+                "upstreams": upstreams,
+                "cache_key": cache_key,
+                "time": time.time(),
+            }
+            self._save()
+
+    def forget(self, repo):
+        with self.lock, self._locked():
+            self.reload()
+            if self.entries.pop(repo, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def remove(manifest_path):
+        """Forget all builds, e.g. because the Maven repository holding
+        their artifacts was replaced."""
+        if path.exists(manifest_path):
+            os.remove(manifest_path)
@@ -0,0 +1,41 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import collections
+import gzip
+import os
+import re
+
+# Lines of a failed build shown on the terminal
+TAIL_LINES = 50
+
+# e.g. "[INFO] Building Eclipse SmartHome Core 0.9.0-SNAPSHOT", but not
+# "[INFO] Building jar: /path/to/core.jar"
+MODULE_START = re.compile(r"^\[INFO\] Building ([^:]+?)(?: \[\d+/\d+\])?$")
+
+
+class BuildLog(object):
+    """Output of a build, written gzip-compressed to `log_path`, of which
+    the last `tail_lines` lines are also kept in memory.
+
+    The log is written to a temporary file and only replaces the previous
+    log of the same name once closed."""
+
+    def __init__(self, log_path, tail_lines=TAIL_LINES):
+        self.path = log_path
+        self.tmp_path = log_path + ".tmp"
+        self.file = gzip.open(self.tmp_path, "wb")
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lines = 0
+
+    def write(self, line):
+        self.file.write(line.encode("utf-8"))
+        self.tail.append(line.rstrip("\r\n"))
+        self.lines += 1
+
+    def close(self):
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
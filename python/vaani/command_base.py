@@ -5,18 +5,21 @@
 import os
 from os import path
 import contextlib
+import errno
+import functools
 import subprocess
 from subprocess import PIPE
 import sys
 import platform
-import collections
 
 from os.path import expanduser
 
-import toml
-
 from mach.registrar import Registrar
 
+from vaani.locks import FileLock
+from vaani.repos import RepoGraph
+from vaani.resources import ResourceProfile, DEFAULT_PROFILE
+
 BIN_SUFFIX = ".exe" if sys.platform == "win32" else ""
 CMD_SUFFIX = ".cmd" if sys.platform == "win32" else ""
 
@@ -30,6 +33,15 @@ def cd(new_path):
     finally:
         os.chdir(previous_path)
 
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
 def call(*args, **kwargs):
     """Wrap `subprocess.call`, printing the command if verbose=True."""
     verbose = kwargs.pop('verbose', False)
@@ -40,6 +52,32 @@ def call(*args, **kwargs):
     return subprocess.call(*args, shell=sys.platform == 'win32', **kwargs)
 
 
+def call_lines(*args, **kwargs):
+    """Like `call`, but also hand each line of output, decoded, to the
+    `on_line` callback while printing it, or with echo=False, instead of
+    printing it."""
+    on_line = kwargs.pop('on_line')
+    verbose = kwargs.pop('verbose', False)
+    echo = kwargs.pop('echo', True)
+    if verbose:
+        print(' '.join(args[0]))
+    process = subprocess.Popen(*args, stdout=PIPE, stderr=subprocess.STDOUT,
+                               shell=sys.platform == 'win32', **kwargs)
+    try:
+        for line in iter(process.stdout.readline, b''):
+            # Echoed as is: a piped stdout can't encode what isn't ASCII
+            if echo:
+                sys.stdout.write(line)
+            on_line(line.decode('utf-8', 'replace'))
+    except BaseException:
+        # Or the process would go on writing into a pipe nobody reads
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        raise
+    return process.wait()
+
+
 def normalize_env(env):
     # There is a bug in subprocess where it doesn't like unicode types in
     # environment variables. Here, ensure all unicode are converted to
@@ -110,6 +148,14 @@ def print_footer(verbosity):
         print_line()
 
 
+def read_config(config_path):
+    if not path.exists(config_path):
+        return {}
+    import toml
+    with open(config_path) as f:
+        return toml.loads(f.read())
+
+
 class BuildNotFound(Exception):
     def __init__(self, message):
         self.message = message
@@ -145,33 +191,57 @@ class CommandBase(object):
         if not hasattr(self.context, "shared_dir"):
             self.context.shared_dir = path.join(context.topdir, "shared")
 
+        if not hasattr(self.context, "cache_dir"):
+            self.context.cache_dir = path.join(context.shared_dir, "cache")
+
         if not hasattr(self.context, "maven_dir"):
             self.context.maven_dir = path.join(context.shared_dir, "maven")
 
+        if not hasattr(self.context, "shared_m2repo_dir"):
+            self.context.shared_m2repo_dir = path.join(context.shared_dir, "m2repo")
+
+        if not hasattr(self.context, "ws_dir"):
+            self.context.ws_dir = path.join(context.topdir, "ws")
+
+        # A workspace is a checkout of its own in ws/<name>, building into
+        # an overlay of the shared Maven repository
+        if not hasattr(self.context, "workspace"):
+            self.context.workspace = os.environ.get("VAANI_WORKSPACE") or None
+
+        if not hasattr(self.context, "local_dir"):
+            if self.context.workspace:
+                self.context.local_dir = path.join(context.ws_dir, self.context.workspace)
+            else:
+                self.context.local_dir = context.shared_dir
+
         if not hasattr(self.context, "m2repo_dir"):
-            self.context.m2repo_dir = path.join(context.shared_dir, "m2repo")
+            if self.context.workspace:
+                self.context.m2repo_dir = path.join(context.local_dir, "m2repo")
+            else:
+                self.context.m2repo_dir = context.shared_m2repo_dir
+
+        if not hasattr(self.context, "build_manifest_path"):
+            self.context.build_manifest_path = path.join(context.local_dir, "build-manifest.json")
+
+        if not hasattr(self.context, "build_history_path"):
+            self.context.build_history_path = path.join(context.local_dir, "build-history.jsonl")
+
+        if not hasattr(self.context, "logs_dir"):
+            self.context.logs_dir = path.join(context.local_dir, "logs")
 
         if not hasattr(self.context, "git_dir"):
-            self.context.git_dir = path.join(context.topdir, "git")
+            if self.context.workspace:
+                self.context.git_dir = path.join(context.local_dir, "git")
+            else:
+                self.context.git_dir = path.join(context.topdir, "git")
 
-        if not hasattr(self.context, "ws_dir"):
-            self.context.ws_dir = path.join(context.topdir, "ws")
+        # Parsed once per mach invocation, however many commands it runs
+        if not hasattr(self.context, "config"):
+            self.context.config = read_config(path.join(context.topdir, ".vaanibuild"))
+        self.config = self.context.config
 
         if not hasattr(self.context, "repos"):
-            self.context.repos = collections.OrderedDict([
-                ( "smarthome",          "eclipse" ),
-                ( "openhab-core",       "kaikreuzer" ),
-                ( "openhab",            "openhab" ),
-                ( "openhab2-addons",    "openhab" ),
-                ( "openhab-distro",     "owner" )
-            ])
-
-        config_path = path.join(context.topdir, ".vaanibuild")
-        if path.exists(config_path):
-            with open(config_path) as f:
-                self.config = toml.loads(f.read())
-        else:
-            self.config = {}
+            self.context.repos = RepoGraph.from_config(self.config)
 
         # Handle missing/default items
         # self.config.setdefault("tools", {})
@@ -184,8 +254,26 @@ class CommandBase(object):
         # self.config["tools"].setdefault("maven-root", maven_root)
         # resolverelative("tools", "maven-root")
 
-    def build_env(self):
-        """Return an extended environment dictionary."""
+    def resource_profile(self):
+        """The resource profile sizing Maven: chosen by the command line, the
+        VAANI_RESOURCE_PROFILE environment variable or the build.resource-profile
+        setting of .vaanibuild, in that order. Exits if it is invalid, as
+        any command running git or Maven would fail for it."""
+        name = (getattr(self, "resource_profile_name", None) or
+                os.environ.get("VAANI_RESOURCE_PROFILE") or
+                self.config.get("build", {}).get("resource-profile", DEFAULT_PROFILE))
+        if getattr(self, "_resource_profile", None) is None or self._resource_profile.name != name:
+            try:
+                self._resource_profile = ResourceProfile.load(name, self.config)
+            except ValueError as e:
+                sys.exit(e.args[0])
+        return self._resource_profile
+
+    def build_env(self, jobs=1):
+        """Return an extended environment dictionary.
+
+        `jobs` is the number of Maven processes that will run at once,
+        which share the memory of the machine."""
         env = os.environ.copy()
         if sys.platform == "win32" and type(env['PATH']) == unicode:
             # On win32, the virtualenv's activate_this.py script sometimes ends up
@@ -195,25 +283,89 @@ class CommandBase(object):
             # have unicode stuff in your path, all this PATH munging would have broken
             # it in any case.
             env['PATH'] = env['PATH'].encode('ascii', 'ignore')
-        env['MAVEN_OPTS'] = '-Dmaven.artifact.threads=4 -Xmx2469m'
+        env['MAVEN_OPTS'] = self.resource_profile().maven_opts(jobs)
         env['MAVEN_SKIP_RC'] = 'true'
 
         return env
 
+    def dispatch(self, name, **kwargs):
+        """Run mach command `name`, loading the module providing it first."""
+        loader = getattr(self.context, "command_loader", None)
+        if loader is not None:
+            loader.load(name)
+        return Registrar.dispatch(name, context=self.context, **kwargs)
+
     def ensure_bootstrapped(self, target=None):
         if self.context.bootstrapped:
             return
 
-        if not (path.exists(self.context.maven_dir)):
-            print("Installing Maven")
-            Registrar.dispatch("bootstrap-maven", context=self.context)
-
-        if not (path.exists(self.context.m2repo_dir)):
-            print("Preparing local Maven repository")
-            Registrar.dispatch("bootstrap-m2repo", context=self.context)
-
-        if not (path.exists(self.context.git_dir)):
-            print("Fetching git repositories")
-            Registrar.dispatch("bootstrap-git", context=self.context)
+        # Another mach process may be bootstrapping this checkout; what is
+        # missing is only known once it is done
+        with self.lock("bootstrap", local=True):
+            steps = []
+            if not (path.exists(self.context.maven_dir)):
+                steps.append(("maven", "bootstrap-maven", []))
+
+            if not (path.exists(self.context.shared_m2repo_dir)):
+                steps.append(("m2repo", "bootstrap-m2repo", []))
+
+            if not (path.exists(self.context.git_dir)):
+                steps.append(("git", "bootstrap-git", ["all"]))
+
+            if steps:
+                from vaani.tasks import report, run_tasks
+
+                print("Bootstrapping " + ", ".join(name for name, _, _ in steps))
+                loader = getattr(self.context, "command_loader", None)
+                for _, command, _ in steps:
+                    # Modules are loaded before the steps run concurrently
+                    if loader is not None:
+                        loader.load(command)
+                results = run_tasks([(name, functools.partial(Registrar.dispatch, command,
+                                                              context=self.context, argv=argv))
+                                     for name, command, argv in steps])
+                if not report(results):
+                    sys.exit("Bootstrapping failed.")
+
+            if self.context.workspace and not path.exists(self.context.m2repo_dir):
+                self.update_overlay()
 
         self.context.bootstrapped = True
+
+    def lock(self, name, shared=False, local=False):
+        """Advisory lock `name`, kept with the shared directory or, with
+        `local`, with the state of this checkout, taken by the mach
+        processes changing what it guards."""
+        locks_dir = path.join(self.context.local_dir if local else self.context.shared_dir, "locks")
+        return FileLock(path.join(locks_dir, name + ".lock"), shared=shared,
+                        wait_message="Waiting for another mach process holding the %s lock..." % name)
+
+    def workspaces(self):
+        """The names of the workspaces in ws/."""
+        if not path.isdir(self.context.ws_dir):
+            return []
+        return sorted(name for name in os.listdir(self.context.ws_dir)
+                      if path.isdir(path.join(self.context.ws_dir, name, "git")))
+
+    def update_overlay(self):
+        """Link the shared Maven repository into the overlay of the
+        workspace, copying what its repositories install."""
+        # Imported here, as most commands never need them
+        from vaani import overlay
+        from vaani.pom import read_modules, PomError
+
+        modules = []
+        for repo in self.context.repos:
+            repo_dir = path.join(self.context.git_dir, repo)
+            if path.exists(path.join(repo_dir, "pom.xml")):
+                try:
+                    modules += read_modules(repo_dir).walk()
+                except PomError as e:
+                    print(e)
+        print("Updating the Maven repository overlay of workspace %s..." % self.context.workspace)
+        with self.lock("m2repo", local=True), self.lock("m2repo", shared=True):
+            stats = overlay.build_overlay(self.context.shared_m2repo_dir, self.context.m2repo_dir,
+                                          overlay.owned_dirs(modules))
+        print("%(linked)d files linked, %(reflinked)d reflinked, %(copied)d copied, "
+              "%(unchanged)d unchanged." % stats)
+        return stats
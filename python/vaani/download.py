@@ -0,0 +1,455 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import json
+import os
+import os.path as path
+import re
+import socket
+import StringIO
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+
+from vaani import trace
+from vaani.locks import FileLock
+from vaani.parallel import parallel_map
+
+DEFAULT_CONNECTIONS = 4
+# Segments smaller than this are not worth an extra connection
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.25
+STATE_INTERVAL = 1.0
+# Seconds a cached artifact or a resolved release is trusted before the
+# server is asked again whether it changed
+DEFAULT_TTL = 60 * 60
+
+# Hash algorithms of published checksums, by length of their hex digest
+CHECKSUM_ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024 or unit == "GiB":
+            break
+        size /= 1024.0
+    if unit == "B":
+        return "%d %s" % (size, unit)
+    return "%.1f %s" % (size, unit)
+
+
+class Progress(object):
+    """Progress line of a download, printed at most every
+    PROGRESS_INTERVAL seconds however small the chunks are."""
+
+    def __init__(self, desc, total=None, received=0):
+        self.desc = desc
+        self.total = total
+        self.received = received
+        self.initial = received
+        self.dumb = (os.environ.get("TERM") == "dumb") or (not sys.stdout.isatty())
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last = 0
+
+    def update(self, size):
+        with self.lock:
+            self.received += size
+            now = time.time()
+            if self.dumb or now - self.last < PROGRESS_INTERVAL:
+                return
+            self.last = now
+            self._print(now)
+
+    def _print(self, now):
+        rate = (self.received - self.initial) / max(now - self.start, 0.001)
+        if self.total:
+            pct = self.received * 100.0 / self.total
+            print("\rDownloading %s: %5.1f%% (%s/s)   " % (self.desc, pct, format_size(rate)), end="")
+        else:
+            print("\rDownloading %s: %s (%s/s)   " % (self.desc, format_size(self.received),
+                                                     format_size(rate)), end="")
+        sys.stdout.flush()
+
+    def finish(self):
+        if not self.dumb:
+            self._print(time.time())
+            print()
+
+
+class ChunkSizer(object):
+    """Adapt the read size to the connection: grow while reads return
+    quickly, shrink when they start to block."""
+
+    def __init__(self, size=64 * 1024):
+        self.size = size
+
+    def read(self, resp, limit=None):
+        size = self.size if limit is None else min(self.size, limit)
+        start = time.time()
+        chunk = resp.read(size)
+        elapsed = time.time() - start
+        if len(chunk) == size == self.size:
+            if elapsed < 0.05:
+                self.size = min(self.size * 2, MAX_CHUNK_SIZE)
+            elif elapsed > 0.5:
+                self.size = max(self.size // 2, MIN_CHUNK_SIZE)
+        return chunk
+
+
+class RangeNotSatisfied(Exception):
+    pass
+
+
+def _report_failure(e, src):
+    if isinstance(e, urllib2.HTTPError):
+        print("Download failed (%d): %s - %s" % (e.code, e.reason, src))
+        if e.code == 403:
+            print("No maven compiler binary available for this platform. "
+                  "Please see https://github.com/mozilla/vaanisdk/#prerequisites")
+    else:
+        print("Error downloading; are you connected to the internet?")
+    sys.exit(1)
+
+
+@trace.traced("network", "desc")
+def download(desc, src, writer, start_byte=0):
+    if start_byte:
+        print("Resuming download of %s..." % desc)
+    else:
+        print("Downloading %s..." % desc)
+
+    try:
+        if start_byte:
+            src = urllib2.Request(src, headers={'Range': 'bytes={}-'.format(start_byte)})
+        resp = urllib2.urlopen(src)
+        if start_byte and resp.getcode() != 206:
+            # The server ignored the range and sends everything again
+            writer.seek(0)
+            writer.truncate()
+            start_byte = 0
+
+        fsize = None
+        if resp.info().getheader('Content-Length'):
+            fsize = int(resp.info().getheader('Content-Length').strip()) + start_byte
+
+        progress = Progress(desc, fsize, start_byte)
+        sizer = ChunkSizer()
+        while True:
+            chunk = sizer.read(resp)
+            if not chunk:
+                break
+            writer.write(chunk)
+            progress.update(len(chunk))
+        progress.finish()
+        return resp.info()
+    except (urllib2.URLError, socket.error) as e:
+        _report_failure(e, src)
+    except KeyboardInterrupt:
+        writer.flush()
+        raise
+
+
+def probe(src):
+    """Resolve redirects of `src` and find out whether the server can
+    serve byte ranges of it.
+
+    Returns `(url, size, headers)`, where size is None if ranges are not
+    supported."""
+    resp = urllib2.urlopen(urllib2.Request(src, headers={'Range': 'bytes=0-0'}))
+    try:
+        if resp.getcode() == 206:
+            match = re.match(r"bytes\s+0-0/(\d+)", resp.info().getheader('Content-Range') or "")
+            if match:
+                return resp.geturl(), int(match.group(1)), resp.info()
+        return resp.geturl(), None, resp.info()
+    finally:
+        resp.close()
+
+
+def validators(headers):
+    """The ETag and Last-Modified of a response, which later conditional
+    requests send to find out whether the content changed."""
+    found = {}
+    if headers is not None and headers.getheader('ETag'):
+        found['etag'] = headers.getheader('ETag').strip()
+    if headers is not None and headers.getheader('Last-Modified'):
+        found['last_modified'] = headers.getheader('Last-Modified').strip()
+    return found
+
+
+def revalidate(url, known):
+    """Ask with a conditional request whether the content at `url` is still
+    what the validators `known` describe. Returns whether it is, and the
+    validators to keep."""
+    headers = {}
+    if known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+    if not headers:
+        return False, {}
+    try:
+        resp = urllib2.urlopen(urllib2.Request(url, headers=headers))
+    except urllib2.HTTPError as e:
+        if e.code != 304:
+            raise
+        current = dict(known)
+        current.update(validators(e.info()))
+        return True, current
+    # Changed; the new content is downloaded the usual way
+    resp.close()
+    return False, validators(resp.info())
+
+
+def cached(desc, src, cache, ttl=DEFAULT_TTL):
+    """The path of the artifact `cache` has for `src`, or None if it has
+    none or the server has changed it.
+
+    Artifacts whose validators were checked less than `ttl` seconds ago
+    are used without asking the server; older ones are revalidated with a
+    conditional request. Artifacts cached without validators are trusted,
+    as their URLs are versioned."""
+    blob = cache.lookup(src)
+    if blob is None:
+        return None
+    known = cache.validators(src)
+    if not known or ttl is None or time.time() - known.get('checked', 0) < ttl:
+        return blob
+    try:
+        unchanged, current = revalidate(src, known)
+    except (urllib2.URLError, socket.error) as e:
+        print("Could not check whether %s changed (%s); using the cached one." % (desc, e))
+        return blob
+    if not unchanged:
+        print("%s changed on the server." % desc)
+        return None
+    cache.revalidated(src, current)
+    return blob
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def redirect_target(url):
+    """Where `url` redirects to, asked with a HEAD request without
+    following the redirect, or None if it doesn't redirect."""
+    request = urllib2.Request(url)
+    request.get_method = lambda: b"HEAD"
+    try:
+        urllib2.build_opener(_NoRedirect).open(request).close()
+    except urllib2.HTTPError as e:
+        if e.code in (301, 302, 303, 307, 308) and e.info().getheader('Location'):
+            return urlparse.urljoin(url, e.info().getheader('Location'))
+        raise
+    return None
+
+
+class SegmentState(object):
+    """Progress of a segmented download, kept next to the partial file so
+    an interrupted download resumes every segment where it stopped."""
+
+    def __init__(self, state_path, size, segments):
+        self.path = state_path
+        self.size = size
+        # [start, end (inclusive), bytes done]
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.last_save = 0
+
+    @classmethod
+    def create(cls, state_path, size, count):
+        step = size // count
+        segments = []
+        for index in range(count):
+            start = index * step
+            end = size - 1 if index == count - 1 else start + step - 1
+            segments.append([start, end, 0])
+        return cls(state_path, size, segments)
+
+    @classmethod
+    def load(cls, state_path, size):
+        try:
+            with open(state_path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get("size") != size:
+            return None
+        return cls(state_path, size, data["segments"])
+
+    @property
+    def done(self):
+        return sum(segment[2] for segment in self.segments)
+
+    def save(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.last_save < STATE_INTERVAL:
+                return
+            self.last_save = now
+            with open(self.path, "w") as f:
+                json.dump({"size": self.size, "segments": self.segments}, f)
+
+    def remove(self):
+        if path.exists(self.path):
+            os.remove(self.path)
+
+
+@trace.traced("network", "desc")
+def download_segments(desc, url, tmp_path, size, connections):
+    """Download `url` into `tmp_path` over up to `connections` parallel
+    HTTP range requests."""
+    state_path = tmp_path + ".segments"
+    state = SegmentState.load(state_path, size) if path.exists(tmp_path) else None
+    if state is None:
+        count = max(1, min(connections, size // MIN_SEGMENT_SIZE))
+        state = SegmentState.create(state_path, size, count)
+        with open(tmp_path, "wb") as f:
+            f.truncate(size)
+        state.save(force=True)
+        print("Downloading %s over %d connections..." % (desc, count))
+    else:
+        print("Resuming download of %s over %d connections..." % (desc, len(state.segments)))
+
+    progress = Progress(desc, size, state.done)
+
+    def fetch(segment):
+        start, end, done = segment
+        pos = start + done
+        if pos > end:
+            return
+        resp = urllib2.urlopen(urllib2.Request(url, headers={'Range': 'bytes=%d-%d' % (pos, end)}))
+        if resp.getcode() != 206:
+            raise RangeNotSatisfied()
+        sizer = ChunkSizer()
+        # Unbuffered, so the saved state never claims bytes that were not written
+        with open(tmp_path, "r+b", 0) as f:
+            f.seek(pos)
+            while pos <= end:
+                chunk = sizer.read(resp, end - pos + 1)
+                if not chunk:
+                    break
+                f.write(chunk)
+                pos += len(chunk)
+                segment[2] += len(chunk)
+                progress.update(len(chunk))
+                state.save()
+        if pos <= end:
+            raise socket.error("Connection closed after %d of %d bytes" % (pos - start, end - start + 1))
+
+    try:
+        results = parallel_map(fetch, state.segments, jobs=len(state.segments))
+    finally:
+        state.save(force=True)
+    for _, _, exc_info in results:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    progress.finish()
+    state.remove()
+
+
+def fetch_checksum(url):
+    """Return `(algorithm, hexdigest)` published at `url`, or None."""
+    try:
+        words = urllib2.urlopen(url).read().split()
+    except (urllib2.URLError, IOError):
+        return None
+    if not words:
+        return None
+    digest = words[0].lower()
+    algorithm = CHECKSUM_ALGORITHMS.get(len(digest))
+    if algorithm is None or not re.match(r"^[0-9a-f]+$", digest):
+        return None
+    return algorithm, digest
+
+
+def file_hash(file_path, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@trace.traced("disk", "desc")
+def verify_checksum(desc, file_path, checksum_url):
+    checksum = fetch_checksum(checksum_url)
+    if checksum is None:
+        print("No checksum published at %s; not verifying %s." % (checksum_url, desc))
+        return True
+    algorithm, expected = checksum
+    actual = file_hash(file_path, algorithm)
+    if actual != expected:
+        print("Checksum mismatch for %s: expected %s %s, got %s."
+              % (desc, algorithm, expected, actual))
+        return False
+    return True
+
+
+@trace.traced("network", "desc")
+def download_file(desc, src, dst, checksum_url=None, connections=DEFAULT_CONNECTIONS, cache=None,
+                  ttl=DEFAULT_TTL):
+    # Processes downloading to `dst` take turns; those that waited find the
+    # download in the cache, or resume what was left of it
+    with FileLock(dst + ".lock", "Waiting for another process downloading %s..." % desc):
+        _download_file(desc, src, dst, checksum_url, connections, cache, ttl)
+
+
+def _download_file(desc, src, dst, checksum_url, connections, cache, ttl):
+    if cache is not None and cached(desc, src, cache, ttl) and cache.fetch(src, dst):
+        print("Using cached %s." % desc)
+        return
+
+    tmp_path = dst + ".part"
+    state_path = tmp_path + ".segments"
+    segmented = False
+    headers = None
+    # A partial file without segment state comes from a single stream
+    # download, which is resumed as such.
+    if connections > 1 and (path.exists(state_path) or not path.exists(tmp_path)):
+        try:
+            url, size, headers = probe(src)
+            if size is not None and size >= 2 * MIN_SEGMENT_SIZE:
+                download_segments(desc, url, tmp_path, size, connections)
+                segmented = True
+        except RangeNotSatisfied:
+            print("Server stopped serving ranges; downloading %s in one piece." % desc)
+        except (urllib2.URLError, socket.error) as e:
+            # The segment state is kept to resume from
+            _report_failure(e, src)
+        if not segmented and path.exists(state_path):
+            os.remove(state_path)
+            os.remove(tmp_path)
+
+    if not segmented:
+        try:
+            start_byte = os.path.getsize(tmp_path)
+            with open(tmp_path, 'ab') as fd:
+                headers = download(desc, src, fd, start_byte=start_byte)
+        except os.error:
+            with open(tmp_path, 'wb') as fd:
+                headers = download(desc, src, fd)
+
+    if checksum_url and not verify_checksum(desc, tmp_path, checksum_url):
+        os.remove(tmp_path)
+        sys.exit(1)
+    os.rename(tmp_path, dst)
+    if cache is not None:
+        cache.store(src, dst, validators(headers))
+
+
+def download_bytes(desc, src):
+    content_writer = StringIO.StringIO()
+    download(desc, src, content_writer)
+    return content_writer.getvalue()
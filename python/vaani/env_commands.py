@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import sys
+
+from mach.decorators import (
+    CommandProvider,
+    Command,
+)
+
+from vaani.command_base import *
+
+
+# Kept apart from the bootstrap commands, whose imports would make up most
+# of the time of a command that is run in loops by scripts
+@CommandProvider
+class MachCommands(CommandBase):
+    @Command('env',
+             description='Print environment setup commands',
+             category='bootstrap')
+    def env(self):
+        env = self.build_env()
+        print("export PATH=%s" % env["PATH"])
+        if sys.platform == "darwin":
+            print("export DYLD_LIBRARY_PATH=%s" % env["DYLD_LIBRARY_PATH"])
+        else:
+            print("export LD_LIBRARY_PATH=%s" % env["LD_LIBRARY_PATH"])
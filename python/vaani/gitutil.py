@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+import os.path as path
+import shutil
+import subprocess
+import sys
+
+from vaani import trace
+
+# What git prints file names in, as it takes them from the file system
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+
+class GitError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def git_output(args, cwd):
+    """Run git with `args` in `cwd` and return its standard output."""
+    process = subprocess.Popen(["git"] + args, cwd=cwd,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode:
+        raise GitError("git %s failed in %s: %s"
+                       % (" ".join(args), cwd, err.strip()))
+    return out
+
+
+def head(repo_dir):
+    """Commit id of HEAD."""
+    return git_output(["rev-parse", "HEAD"], repo_dir).strip()
+
+
+def _file_names(out):
+    """The file names of the NUL separated output of git, as bytes."""
+    return sorted(f for f in out.split(b"\0") if f)
+
+
+def _decoded(names):
+    return sorted(name.decode(FS_ENCODING, "replace") for name in names)
+
+
+def _untracked(repo_dir):
+    return _file_names(git_output(["ls-files", "--others", "--exclude-standard", "-z"], repo_dir))
+
+
+def untracked_files(repo_dir):
+    return _decoded(_untracked(repo_dir))
+
+
+def dirty_hash(repo_dir):
+    """Hash of all uncommitted changes, including untracked files that are
+    not ignored, or None when the working tree is clean."""
+    diff = git_output(["diff", "HEAD", "--binary"], repo_dir)
+    # As bytes, to open whatever the file system allows
+    untracked = _untracked(repo_dir)
+    if not diff and not untracked:
+        return None
+    digest = hashlib.sha1(diff)
+    for name in untracked:
+        digest.update(b"\0" + name + b"\0")
+        with open(path.join(repo_dir.encode(FS_ENCODING), name), "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def changed_files(repo_dir, since):
+    """Files that differ between commit `since` and the working tree, by
+    committed or uncommitted changes, including untracked files that are
+    not ignored. Renamed files are listed under both names."""
+    out = git_output(["diff", "--name-only", "--no-renames", "-z", since, "--"], repo_dir)
+    return sorted(set(_decoded(_file_names(out)) + untracked_files(repo_dir)))
+
+
+def _run(args, cwd=None, env=None, quiet=False):
+    if quiet:
+        process = subprocess.Popen(args, cwd=cwd, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = process.communicate()[0]
+    else:
+        out = ""
+        process = subprocess.Popen(args, cwd=cwd, env=env)
+        process.wait()
+    if process.returncode:
+        raise GitError("%s failed: %s" % (" ".join(args), out.strip()))
+
+
+@trace.traced("git", "url")
+def update_mirror(url, mirror_dir, env=None, quiet=False):
+    """Create or refresh a bare mirror of `url` in `mirror_dir`."""
+    if path.isdir(mirror_dir):
+        _run(["git", "remote", "update", "--prune"], cwd=mirror_dir, env=env, quiet=quiet)
+    else:
+        tmp_dir = mirror_dir + ".tmp"
+        if path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        _run(["git", "clone", "--mirror", url, tmp_dir], env=env, quiet=quiet)
+        # Allow partial clones from the mirror
+        _run(["git", "config", "uploadpack.allowFilter", "true"], cwd=tmp_dir, env=env)
+        os.rename(tmp_dir, mirror_dir)
+
+
+@trace.traced("git", "url")
+def clone(url, repo_dir, mirror_dir=None, depth=None, filter=None, env=None, quiet=False):
+    """Clone `url` into `repo_dir`.
+
+    With a mirror, the clone is made locally from it and its origin is then
+    pointed at `url`. A full local clone hardlinks the mirror's objects;
+    shallow and partial clones go through the file:// transport, which is
+    needed for --depth and --filter to apply."""
+    source = url
+    if mirror_dir:
+        source = mirror_dir
+        if depth or filter:
+            source = "file://" + path.abspath(mirror_dir)
+    args = ["git", "clone"]
+    if quiet:
+        args += ["--quiet"]
+    if depth:
+        args += ["--depth", str(depth), "--no-single-branch"]
+    if filter:
+        args += ["--filter", filter]
+    _run(args + [source, repo_dir], env=env, quiet=quiet)
+    if source != url:
+        _run(["git", "remote", "set-url", "origin", url], cwd=repo_dir, env=env)
+
+
+# Outcomes of fast_forward
+UP_TO_DATE = "up to date"
+FAST_FORWARDED = "fast-forwarded"
+AHEAD = "ahead"
+DIVERGED = "diverged"
+DIRTY = "dirty"
+NO_UPSTREAM = "no upstream"
+
+
+@trace.traced("git", "repo_dir")
+def fetch(repo_dir, env=None):
+    """Fetch what is new on origin."""
+    _run(["git", "fetch", "--quiet", "--prune", "origin"], cwd=repo_dir, env=env, quiet=True)
+
+
+@trace.traced("git", "repo_dir")
+def fast_forward(repo_dir, env=None):
+    """Fast-forward the checked out branch to its upstream branch, unless
+    it has commits of its own or uncommitted changes to tracked files.
+
+    Returns a `(status, detail)` tuple with status one of the outcomes
+    above."""
+    try:
+        upstream = git_output(["rev-parse", "--abbrev-ref", "--symbolic-full-name", "@{u}"],
+                              repo_dir).strip()
+    except GitError:
+        # Detached HEAD, or a branch that doesn't track anything
+        return NO_UPSTREAM, "nothing to fast-forward to"
+    ahead, behind = [int(count) for count in git_output(
+        ["rev-list", "--left-right", "--count", "HEAD...@{u}"], repo_dir).split()]
+    if not behind:
+        if ahead:
+            return AHEAD, "%d local commits not on %s" % (ahead, upstream)
+        return UP_TO_DATE, upstream
+    if ahead:
+        return DIVERGED, "%d local and %d new commits on %s" % (ahead, behind, upstream)
+    if git_output(["status", "--porcelain", "--untracked-files=no"], repo_dir).strip():
+        return DIRTY, "uncommitted changes; %d new commits on %s" % (behind, upstream)
+    old = head(repo_dir)
+    _run(["git", "merge", "--ff-only", "--quiet", "@{u}"], cwd=repo_dir, env=env, quiet=True)
+    return FAST_FORWARDED, "%d commits from %s (%s..%s)" % (behind, upstream, old[:12],
+                                                            head(repo_dir)[:12])
+
+
+def checkout(repo_dir, branch, env=None):
+    """Check out `branch`, which may also be one only known on origin."""
+    _run(["git", "checkout", "--quiet", branch], cwd=repo_dir, env=env, quiet=True)
+
+
+def current_branch(repo_dir):
+    """Name of the checked out branch, or None with a detached HEAD."""
+    name = git_output(["rev-parse", "--abbrev-ref", "HEAD"], repo_dir).strip()
+    return None if name == b"HEAD" else name
@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import contextlib
+import errno
+import os
+import os.path as path
+import sys
+import threading
+import time
+
+from vaani import trace
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+# The locks each thread holds, by path, so that taking one again while
+# holding it doesn't wait for itself
+_held = threading.local()
+
+
+def _held_locks():
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    return _held.locks
+
+
+class FileLock(object):
+    """Advisory lock on the file `lock_path`, which keeps other processes,
+    and other threads, that take it from doing the same at the same time.
+
+    The lock is exclusive or, with `shared`, held along with other shared
+    holders; Windows only has exclusive locks. A thread holding the lock
+    already takes it again at once, unless it holds it shared and asks
+    for it exclusively, which would never end. `wait_message` is printed
+    when the lock is taken by someone else."""
+
+    def __init__(self, lock_path, wait_message=None, shared=False):
+        self.path = path.abspath(lock_path)
+        self.wait_message = wait_message
+        self.shared = shared
+        self.fd = None
+        self.nested = False
+
+    def _lock(self, blocking):
+        if sys.platform == "win32":
+            while True:
+                try:
+                    msvcrt.locking(self.fd, msvcrt.LK_NBLCK, 1)
+                    return True
+                except IOError:
+                    if not blocking:
+                        return False
+                    time.sleep(0.1)
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.fd, flags if blocking else flags | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+    def acquire(self):
+        held = _held_locks()
+        if self.path in held and (held[self.path] == "exclusive" or self.shared):
+            self.nested = True
+            return
+        lock_dir = path.dirname(self.path)
+        if not path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                if not path.isdir(lock_dir):
+                    raise
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        if not self._lock(blocking=False):
+            if self.wait_message:
+                print(self.wait_message)
+            with trace.span("wait for " + path.basename(self.path), "lock"):
+                self._lock(blocking=True)
+        held[self.path] = "shared" if self.shared else "exclusive"
+
+    def release(self):
+        if self.nested:
+            self.nested = False
+            return
+        del _held_locks()[self.path]
+        if sys.platform == "win32":
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+@contextlib.contextmanager
+def holding(locks):
+    """Hold all of `locks`, taken in order of their paths so that holders
+    of overlapping sets can't wait for each other."""
+    taken = []
+    try:
+        for lock in sorted(locks, key=lambda lock: lock.path):
+            lock.acquire()
+            taken.append(lock)
+        yield
+    finally:
+        for lock in reversed(taken):
+            lock.release()
@@ -0,0 +1,182 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import json
+import os
+import os.path as path
+import urllib
+import urllib2
+import urlparse
+
+from vaani import trace
+from vaani.download import format_size
+from vaani.parallel import parallel_map
+
+MANIFEST_NAME = "m2repository.manifest.json"
+# Where the artifacts listed in a manifest live, relative to the manifest,
+# unless the manifest has a "base" entry
+DEFAULT_BASE = "m2repository/"
+# The last manifest applied to a repository, with the size and mtime each
+# file had then, so unchanged files don't need to be hashed again
+STATE_NAME = ".vaani-manifest.json"
+DEFAULT_JOBS = 8
+
+# Files of a local repository that are not release artifacts
+IGNORED_NAMES = set([STATE_NAME, "_remote.repositories", "resolver-status.properties"])
+
+
+def file_sha1(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_manifest(m2repo_dir, base=None):
+    """Describe every artifact of `m2repo_dir` by its relative path, size
+    and SHA-1."""
+    artifacts = {}
+    for root, dirs, files in os.walk(m2repo_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name in IGNORED_NAMES or name.endswith(".lastUpdated"):
+                continue
+            file_path = path.join(root, name)
+            rel_path = path.relpath(file_path, m2repo_dir).replace(os.sep, "/")
+            artifacts[rel_path] = {"sha1": file_sha1(file_path), "size": path.getsize(file_path)}
+    manifest = {"artifacts": artifacts}
+    if base:
+        manifest["base"] = base
+    return manifest
+
+
+def fetch_manifest(manifest_url):
+    """Return the artifacts listed at `manifest_url` and the URL they are
+    to be fetched from. Raises ValueError if it is not a manifest as
+    written by `create_manifest`."""
+    manifest = json.loads(urllib2.urlopen(manifest_url).read())
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("artifacts"), dict):
+        raise ValueError("No artifacts listed")
+    for rel_path, artifact in manifest["artifacts"].items():
+        if not (isinstance(artifact, dict) and isinstance(artifact.get("sha1"), basestring) and
+                isinstance(artifact.get("size"), (int, long))):
+            raise ValueError("Invalid manifest entry: %s" % rel_path)
+    base = urlparse.urljoin(manifest_url, manifest.get("base", DEFAULT_BASE))
+    if not base.endswith("/"):
+        base += "/"
+    return manifest["artifacts"], base
+
+
+def _local_path(m2repo_dir, rel_path):
+    target = path.normpath(path.join(m2repo_dir, *rel_path.split("/")))
+    if not target.startswith(path.normpath(m2repo_dir) + os.sep):
+        raise ValueError("Manifest entry outside of the repository: %s" % rel_path)
+    return target
+
+
+def _up_to_date(target, artifact, recorded):
+    try:
+        st = os.stat(target)
+    except OSError:
+        return False
+    if st.st_size != artifact["size"]:
+        return False
+    if (recorded and recorded["sha1"] == artifact["sha1"] and
+            recorded["size"] == st.st_size and recorded["mtime"] == st.st_mtime):
+        return True
+    return file_sha1(target) == artifact["sha1"]
+
+
+def _fetch(url, target, artifact):
+    parent = path.dirname(target)
+    if not path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not path.isdir(parent):
+                raise
+    tmp_path = target + ".part"
+    digest = hashlib.sha1()
+    resp = urllib2.urlopen(url)
+    with open(tmp_path, "wb") as f:
+        for block in iter(lambda: resp.read(65536), b""):
+            digest.update(block)
+            f.write(block)
+    if digest.hexdigest() != artifact["sha1"]:
+        os.remove(tmp_path)
+        raise IOError("Checksum mismatch for %s" % url)
+    os.rename(tmp_path, target)
+
+
+def _remove_empty_parents(file_path, m2repo_dir):
+    parent = path.dirname(file_path)
+    while parent != m2repo_dir and parent.startswith(m2repo_dir):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            return
+        parent = path.dirname(parent)
+
+
+@trace.traced("network", "manifest_url")
+def sync(manifest_url, m2repo_dir, jobs=DEFAULT_JOBS):
+    """Bring `m2repo_dir` in line with the manifest at `manifest_url`.
+
+    Fetches the artifacts that are missing or differ, and deletes those
+    listed by the previously applied manifest that are gone from this one.
+    Files the manifests never listed, like artifacts installed by local
+    builds, are left alone. Returns whether all artifacts were synced."""
+    m2repo_dir = path.normpath(m2repo_dir)
+    artifacts, base = fetch_manifest(manifest_url)
+    state_path = path.join(m2repo_dir, STATE_NAME)
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+
+    print("Checking %d artifacts..." % len(artifacts))
+    missing = [rel_path for rel_path in sorted(artifacts)
+               if not _up_to_date(_local_path(m2repo_dir, rel_path),
+                                  artifacts[rel_path], state.get(rel_path))]
+    stale = [rel_path for rel_path in sorted(state) if rel_path not in artifacts]
+    size = sum(artifacts[rel_path]["size"] for rel_path in missing)
+    print("Fetching %d changed artifacts (%s), removing %d stale ones."
+          % (len(missing), format_size(size), len(stale)))
+
+    def fetch(rel_path):
+        url = base + urllib.quote(rel_path.encode("utf-8"))
+        _fetch(url, _local_path(m2repo_dir, rel_path), artifacts[rel_path])
+
+    failed = set()
+    for rel_path, _, exc_info in parallel_map(fetch, missing, jobs=jobs):
+        if exc_info is not None:
+            failed.add(rel_path)
+            print("Could not fetch %s: %s" % (rel_path, exc_info[1]))
+
+    for rel_path in stale:
+        target = _local_path(m2repo_dir, rel_path)
+        if path.exists(target):
+            os.remove(target)
+            _remove_empty_parents(target, m2repo_dir)
+
+    new_state = {}
+    for rel_path, artifact in artifacts.items():
+        if rel_path in failed:
+            # What is there is what the previous manifest had, if it had
+            # it, and is removed once no manifest lists it anymore
+            if rel_path in state:
+                new_state[rel_path] = state[rel_path]
+            continue
+        st = os.stat(_local_path(m2repo_dir, rel_path))
+        new_state[rel_path] = {"sha1": artifact["sha1"], "size": st.st_size, "mtime": st.st_mtime}
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(new_state, f)
+    os.rename(tmp_path, state_path)
+    return not failed
@@ -0,0 +1,153 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import os
+import os.path as path
+import re
+import shutil
+import sys
+
+from vaani import trace
+
+# Files Maven rewrites in place, which an overlay must never share with
+# the shared repository: repository metadata, resolution bookkeeping and
+# anything of a snapshot version
+MUTABLE = re.compile(r"(^|/)(maven-metadata[^/]*\.xml(\.sha1|\.md5)?|_remote\.repositories|"
+                     r"_maven\.repositories|resolver-status\.properties|[^/]*\.lastUpdated)$"
+                     r"|SNAPSHOT")
+
+# Leftovers of interrupted writes and bookkeeping of the tools filling the
+# shared repository, which have no place in an overlay
+IGNORED = re.compile(r"(\.part|\.tmp\d*)$|^\.vaani-")
+
+# ioctl of Linux copying a file by sharing its extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except (IOError, OSError):
+                return False
+
+
+def clone_file(src, dst):
+    """Copy `src` to `dst` as a reflink where the file system can, so the
+    copy takes no space until either is changed. Returns whether it was."""
+    tmp_path = dst + ".tmp"
+    reflinked = _reflink(src, tmp_path)
+    if not reflinked:
+        shutil.copyfile(src, tmp_path)
+    shutil.copystat(src, tmp_path)
+    os.rename(tmp_path, dst)
+    return reflinked
+
+
+def link_file(src, dst):
+    """Hardlink `src` to `dst`, replacing it. Falls back to `clone_file`
+    across file systems or where there are no hardlinks. Returns whether
+    it linked."""
+    tmp_path = dst + ".tmp"
+    try:
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.link(src, tmp_path)
+    except (OSError, AttributeError):
+        clone_file(src, dst)
+        return False
+    os.rename(tmp_path, dst)
+    return True
+
+
+def owned_dirs(modules):
+    """The directories, relative to a Maven repository, of the group ids
+    of `modules`: what building them installs into an overlay."""
+    dirs = set()
+    for module in modules:
+        if module.group_id and "${" not in module.group_id:
+            dirs.add("/".join(module.group_id.split(".")))
+    return sorted(dirs)
+
+
+def _is_owned(rel_path, owned):
+    return any(rel_path.startswith(rel_dir + "/") for rel_dir in owned)
+
+
+@trace.traced("disk")
+def build_overlay(shared_dir, overlay_dir, owned=()):
+    """Bring the overlay repository `overlay_dir` in line with the shared
+    repository `shared_dir`.
+
+    Immutable artifacts are hardlinked, so they take no space of their own.
+    Mutable files and those below the `owned` directories, which the
+    workspace installs into, are copied, as reflinks where possible, once;
+    what the workspace has since changed of them is kept. Links to files
+    that were since replaced in the shared repository are renewed, and
+    what only the overlay has is left alone.
+
+    Returns a dictionary counting the files "linked", "copied",
+    "reflinked" and "unchanged"."""
+    stats = dict.fromkeys(["linked", "copied", "reflinked", "unchanged"], 0)
+    shared_dir = path.normpath(shared_dir)
+    for root, dirs, files in os.walk(shared_dir):
+        rel_root = path.relpath(root, shared_dir).replace(os.sep, "/")
+        rel_root = "" if rel_root == "." else rel_root + "/"
+        target_root = path.join(overlay_dir, *rel_root.split("/"))
+        if not path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            rel_path = rel_root + name
+            if IGNORED.search(rel_path):
+                continue
+            src = path.join(root, name)
+            dst = path.join(target_root, name)
+            if MUTABLE.search(rel_path) or _is_owned(rel_path, owned):
+                if path.exists(dst):
+                    stats["unchanged"] += 1
+                elif clone_file(src, dst):
+                    stats["reflinked"] += 1
+                else:
+                    stats["copied"] += 1
+            elif path.exists(dst) and path.samefile(src, dst):
+                stats["unchanged"] += 1
+            elif link_file(src, dst):
+                stats["linked"] += 1
+            else:
+                stats["copied"] += 1
+    return stats
+
+
+def detach(overlay_dir, rel_dirs):
+    """Replace the files below `rel_dirs` of `overlay_dir` that are still
+    hardlinked elsewhere by copies of their own, so that Maven rewriting
+    them in place can't change the shared repository. Returns how many
+    there were."""
+    detached = 0
+    for rel_dir in rel_dirs:
+        for root, dirs, files in os.walk(path.join(overlay_dir, *rel_dir.split("/"))):
+            for name in files:
+                file_path = path.join(root, name)
+                if os.lstat(file_path).st_nlink > 1:
+                    clone_file(file_path, file_path)
+                    detached += 1
+    return detached
+
+
+def private_size(overlay_dir):
+    """Bytes of the files of `overlay_dir` not hardlinked elsewhere."""
+    size = 0
+    for root, dirs, files in os.walk(overlay_dir):
+        for name in files:
+            st = os.lstat(path.join(root, name))
+            if st.st_nlink == 1:
+                size += st.st_size
+    return size
@@ -0,0 +1,181 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import multiprocessing
+import Queue
+import sys
+import threading
+import traceback
+
+SUCCESS = "success"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _worker(tasks, done):
+    while True:
+        item = tasks.get()
+        if item is None:
+            return
+        key, func, args = item
+        try:
+            done.put((key, func(*args), None))
+        except BaseException:
+            done.put((key, None, sys.exc_info()))
+
+
+def _wait(done):
+    # Queue.get() without a timeout cannot be interrupted by Ctrl-C on
+    # Python 2, so poll instead.
+    while True:
+        try:
+            return done.get(timeout=0.5)
+        except Queue.Empty:
+            pass
+
+
+def _start_workers(count, tasks, done):
+    for _ in range(count):
+        worker = threading.Thread(target=_worker, args=(tasks, done))
+        worker.daemon = True
+        worker.start()
+
+
+def parallel_map(func, items, jobs=None):
+    """Call `func` on every item using up to `jobs` threads.
+
+    Returns a list of `(item, result, exc_info)` tuples in the order of
+    `items`; `exc_info` is None unless `func` raised."""
+    items = list(items)
+    if not items:
+        return []
+    jobs = max(1, min(jobs or default_jobs(), len(items)))
+    tasks = Queue.Queue()
+    done = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, func, (item,)))
+    for _ in range(jobs):
+        tasks.put(None)
+    _start_workers(jobs, tasks, done)
+
+    results = [None] * len(items)
+    for _ in items:
+        index, result, exc_info = _wait(done)
+        results[index] = (items[index], result, exc_info)
+    return results
+
+
+def run_graph(graph, repos, func, jobs=1, on_cancel=None):
+    """Run `func(repo)` for each of `repos` with up to `jobs` at a time.
+
+    A repository starts as soon as all of its upstreams in `repos` have
+    succeeded; upstreams not in `repos` are assumed to be installed
+    already. `func` returns an exit code. When a repository fails, only
+    its downstream repositories are cancelled; `on_cancel(repo, upstream)`
+    is called for each of them.
+
+    Returns an ordered list of `(repo, state)` tuples, where state is one
+    of SUCCESS, FAILED or CANCELLED."""
+    repos = graph.subset(repos)
+    pending = {}
+    for repo in repos:
+        pending[repo] = set(u for u in graph.upstreams(repo) if u in repos)
+    states = {}
+    running = set()
+    jobs = max(1, jobs or 1)
+
+    tasks = Queue.Queue()
+    done = Queue.Queue()
+    _start_workers(min(jobs, len(repos)), tasks, done)
+
+    def cancel(failed):
+        for repo in graph.all_downstreams(failed):
+            if repo in pending:
+                del pending[repo]
+                states[repo] = CANCELLED
+                if on_cancel:
+                    on_cancel(repo, failed)
+
+    try:
+        while pending or running:
+            ready = [repo for repo in repos
+                     if repo in pending and not pending[repo]]
+            for repo in ready[:jobs - len(running)]:
+                del pending[repo]
+                running.add(repo)
+                tasks.put((repo, func, (repo,)))
+
+            repo, result, exc_info = _wait(done)
+            running.discard(repo)
+            if exc_info is not None:
+                if issubclass(exc_info[0], KeyboardInterrupt):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if not issubclass(exc_info[0], SystemExit):
+                    traceback.print_exception(*exc_info)
+                result = 1
+            if result:
+                states[repo] = FAILED
+                cancel(repo)
+            else:
+                states[repo] = SUCCESS
+                for waiting in pending.values():
+                    waiting.discard(repo)
+    finally:
+        for _ in range(jobs):
+            tasks.put(None)
+
+    return [(repo, states[repo]) for repo in repos]
+
+
+class WorkerPool(object):
+    """Threads running submitted calls as they come in.
+
+    `submit` blocks while `backlog` calls are waiting, which bounds the
+    memory held by a fast producer."""
+
+    def __init__(self, jobs=None, backlog=None):
+        self.jobs = max(1, jobs or default_jobs())
+        self.tasks = Queue.Queue(backlog or self.jobs * 4)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(self.jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                return
+            func, args = item
+            try:
+                func(*args)
+            except BaseException:
+                with self.lock:
+                    self.errors.append(sys.exc_info())
+
+    def submit(self, func, *args):
+        self.tasks.put((func, args))
+
+    def join(self):
+        """Wait for all submitted calls and return the exc_info of those
+        that raised."""
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        return self.errors
@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import os
+import os.path as path
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+POM_NAMESPACE = "{http://maven.apache.org/POM/4.0.0}"
+
+AGGREGATOR_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- Generated by mach; builds all Vaani repositories in one reactor. -->
+<project xmlns="http://maven.apache.org/POM/4.0.0"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://maven.apache.org/POM/4.0.0 http://maven.apache.org/xsd/maven-4.0.0.xsd">
+  <modelVersion>4.0.0</modelVersion>
+  <groupId>org.mozilla.vaani</groupId>
+  <artifactId>vaani-aggregate</artifactId>
+  <version>1.0.0-SNAPSHOT</version>
+  <packaging>pom</packaging>
+  <modules>
+%s
+  </modules>
+</project>
+"""
+
+
+def write_aggregator(pom_path, module_dirs):
+    """Write a POM at `pom_path` with `module_dirs` as its modules, so a
+    single Maven reactor plans and builds all of them."""
+    pom_dir = path.dirname(path.abspath(pom_path))
+    if not path.isdir(pom_dir):
+        os.makedirs(pom_dir)
+    modules = "\n".join("    <module>%s</module>"
+                        % escape(path.relpath(module_dir, pom_dir).replace(os.sep, "/"))
+                        for module_dir in module_dirs)
+    content = AGGREGATOR_TEMPLATE % modules
+    # Keep the file untouched when nothing changed, so Maven and IDEs don't
+    # see a new project each time
+    try:
+        with open(pom_path) as f:
+            if f.read() == content:
+                return pom_path
+    except IOError:
+        pass
+    with open(pom_path, "w") as f:
+        f.write(content)
+    return pom_path
+
+
+class PomError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class Module(object):
+    """A Maven project and the modules it aggregates."""
+
+    def __init__(self, module_dir, group_id, artifact_id, parent=None, version=None):
+        self.dir = module_dir
+        self.group_id = group_id
+        self.artifact_id = artifact_id
+        self.version = version
+        self.parent = parent
+        self.children = []
+        # Where the module's build output goes
+        self.build_dir = path.join(module_dir, "target")
+        # Whether the maven-clean-plugin is configured, e.g. to delete
+        # more than the build directory
+        self.custom_clean = False
+
+    @property
+    def id(self):
+        """The project's id as Maven's --projects option takes it."""
+        return "%s:%s" % (self.group_id, self.artifact_id)
+
+    @property
+    def repository_path(self):
+        """Where Maven installs the module's artifacts, relative to the local
+        repository, or None if the coordinates use properties."""
+        coordinates = (self.group_id, self.artifact_id, self.version)
+        if not all(coordinates) or any("${" in part for part in coordinates):
+            return None
+        return "/".join(self.group_id.split(".") + [self.artifact_id, self.version])
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for module in child.walk():
+                yield module
+
+    def owner(self, file_path):
+        """The innermost module whose directory holds `file_path`, or None
+        if it is outside of this module."""
+        file_path = path.abspath(file_path)
+        if not (file_path + os.sep).startswith(path.abspath(self.dir) + os.sep):
+            return None
+        for child in self.children:
+            owner = child.owner(file_path)
+            if owner is not None:
+                return owner
+        return self
+
+
+def _find(element, *tags):
+    for tag in tags:
+        if element is None:
+            return None
+        found = element.find(POM_NAMESPACE + tag)
+        element = found if found is not None else element.find(tag)
+    return element
+
+
+def _text(element, *tags):
+    found = _find(element, *tags)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip()
+
+
+def read_modules(module_dir, parent=None):
+    """Read the module tree rooted at the POM in `module_dir` by following
+    its <modules>. Modules only listed in profiles are left out, since
+    they are not part of a default reactor."""
+    pom_path = path.join(module_dir, "pom.xml")
+    try:
+        root = ElementTree.parse(pom_path).getroot()
+    except (IOError, ElementTree.ParseError) as e:
+        raise PomError("Could not read %s: %s" % (pom_path, e))
+    artifact_id = _text(root, "artifactId")
+    if not artifact_id:
+        raise PomError("%s has no artifactId" % pom_path)
+    group_id = _text(root, "groupId") or _text(root, "parent", "groupId")
+    version = _text(root, "version") or _text(root, "parent", "version")
+    module = Module(module_dir, group_id, artifact_id, parent, version)
+    build_dir = _text(root, "build", "directory")
+    if build_dir:
+        for variable in ("${project.basedir}", "${basedir}"):
+            build_dir = build_dir.replace(variable, module_dir)
+        # Other properties would need the effective POM
+        if "${" not in build_dir:
+            module.build_dir = path.normpath(path.join(module_dir, build_dir))
+    plugins = _find(root, "build", "plugins")
+    for plugin in plugins if plugins is not None else []:
+        if (_text(plugin, "artifactId") == "maven-clean-plugin" and
+                _find(plugin, "configuration") is not None):
+            module.custom_clean = True
+    modules = _find(root, "modules")
+    for element in modules if modules is not None else []:
+        if not element.text:
+            continue
+        child_dir = path.normpath(path.join(module_dir, element.text.strip()))
+        if child_dir.endswith(".xml"):
+            child_dir = path.dirname(child_dir)
+        if path.isfile(path.join(child_dir, "pom.xml")):
+            module.children.append(read_modules(child_dir, module))
+    return module
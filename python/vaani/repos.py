@@ -0,0 +1,101 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import collections
+
+
+# Upstream repositories each repository needs installed before it can be
+# built. Listed in a valid build order.
+DEFAULT_REPOS = [
+    ("smarthome",       []),
+    ("openhab-core",    ["smarthome"]),
+    ("openhab",         ["openhab-core"]),
+    ("openhab2-addons", ["smarthome", "openhab-core"]),
+    ("openhab-distro",  ["openhab", "openhab2-addons"]),
+]
+
+
+class RepoGraph(object):
+    """Dependency graph of the git repositories making up Vaani.
+
+    Iterating over a graph yields the repository names in a valid build
+    order, so it can be used wherever a plain list of repositories is
+    expected."""
+
+    def __init__(self, repos):
+        self._upstreams = collections.OrderedDict()
+        for name, upstreams in repos:
+            self._upstreams[name] = list(upstreams)
+        for name, upstreams in self._upstreams.items():
+            for upstream in upstreams:
+                if upstream not in self._upstreams:
+                    raise ValueError("Repository %s depends on unknown repository %s"
+                                     % (name, upstream))
+        self._order = self._sort()
+
+    def _sort(self):
+        order = []
+        state = {}
+
+        def visit(name, trail):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("Dependency cycle between repositories: %s"
+                                 % " -> ".join(trail + [name]))
+            state[name] = "visiting"
+            for upstream in self._upstreams[name]:
+                visit(upstream, trail + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self._upstreams:
+            visit(name, [])
+        return order
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, name):
+        return name in self._upstreams
+
+    def upstreams(self, name):
+        """Direct upstream repositories of `name`."""
+        return list(self._upstreams[name])
+
+    def downstreams(self, name):
+        """Direct downstream repositories of `name`."""
+        return [repo for repo in self._order if name in self._upstreams[repo]]
+
+    def all_downstreams(self, name):
+        """All repositories depending on `name`, directly or transitively,
+        in build order."""
+        found = set([name])
+        for repo in self._order:
+            if any(upstream in found for upstream in self._upstreams[repo]):
+                found.add(repo)
+        found.discard(name)
+        return [repo for repo in self._order if repo in found]
+
+    def subset(self, names):
+        """Return `names` sorted into build order."""
+        for name in names:
+            if name not in self._upstreams:
+                raise KeyError(name)
+        return [repo for repo in self._order if repo in names]
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the graph from the `[repos]` table of .vaanibuild, mapping
+        each repository name to the list of its upstream repositories, or
+        fall back to the default Vaani repositories."""
+        repos = config.get("repos")
+        if not repos:
+            return cls(DEFAULT_REPOS)
+        return cls(sorted(repos.items()))
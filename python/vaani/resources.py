@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import multiprocessing
+import re
+import subprocess
+import sys
+
+MIN_HEAP = 512 * 1024 * 1024
+# Used when the amount of memory can't be detected
+FALLBACK_HEAP = 2469 * 1024 * 1024
+
+GC_OPTIONS = {
+    "g1": "-XX:+UseG1GC",
+    "parallel": "-XX:+UseParallelGC",
+    "serial": "-XX:+UseSerialGC",
+}
+
+# Settings of a profile, all optional:
+#   heap              -- heap of each Maven JVM, e.g. "4g"
+#   heap-fraction     -- otherwise, the share of the machine's memory all
+#                        concurrent Maven JVMs get together
+#   max-heap          -- upper bound of a derived heap
+#   gc                -- "g1", "parallel" or "serial"; JVM default if unset
+#   artifact-threads  -- concurrent artifact downloads of each Maven JVM
+#   threads           -- Maven -T; "auto" shares the cores between the
+#                        concurrent Maven JVMs
+BUILTIN_PROFILES = {
+    "auto": {
+        "heap-fraction": 0.5,
+        "max-heap": "8g",
+        "artifact-threads": "auto",
+    },
+    "laptop": {
+        "heap-fraction": 0.25,
+        "max-heap": "2g",
+        "gc": "serial",
+        "artifact-threads": 4,
+        "threads": 1,
+    },
+    "ci": {
+        "heap-fraction": 0.6,
+        "max-heap": "16g",
+        "gc": "parallel",
+        "artifact-threads": "auto",
+        "threads": "auto",
+    },
+}
+DEFAULT_PROFILE = "auto"
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def memory_size():
+    """Physical memory in bytes, or None if it can't be found out."""
+    try:
+        if sys.platform.startswith("linux"):
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemTotal:"):
+                        return int(line.split()[1]) * 1024
+        elif sys.platform == "darwin":
+            return int(subprocess.check_output(["sysctl", "-n", "hw.memsize"]).strip())
+        elif sys.platform == "win32":
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong),
+                            ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong),
+                            ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong),
+                            ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong),
+                            ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("sullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullTotalPhys
+    except (IOError, OSError, ValueError, subprocess.CalledProcessError):
+        pass
+    return None
+
+
+def parse_memory(value):
+    """Bytes of a JVM style memory size such as 512m or 4g."""
+    if isinstance(value, (int, long)):
+        return value
+    match = re.match(r"^\s*(\d+)\s*([kmgt]?)b?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid memory size: %s" % value)
+    return int(match.group(1)) * 1024 ** " kmgt".index(match.group(2).lower() or " ")
+
+
+class ResourceProfile(object):
+    """JVM and Maven settings sized for the machine and for the number of
+    Maven processes running at once."""
+
+    def __init__(self, name, settings, cpus=None, memory=None):
+        self.name = name
+        self.settings = settings
+        self.cpus = cpus or cpu_count()
+        self.memory = memory if memory is not None else memory_size()
+
+    @classmethod
+    def load(cls, name, config):
+        """Look up profile `name` in the [profiles] table of .vaanibuild,
+        whose entries extend or override the built-in profiles. Raises
+        ValueError if there is no such profile or a setting is invalid."""
+        settings = dict(BUILTIN_PROFILES.get(name, {}))
+        user = config.get("profiles", {}).get(name)
+        if user is None and name not in BUILTIN_PROFILES:
+            raise ValueError("Unknown resource profile: %s (known: %s)"
+                             % (name, ", ".join(sorted(set(BUILTIN_PROFILES) |
+                                                       set(config.get("profiles", {}))))))
+        settings.update(user or {})
+        gc = settings.get("gc")
+        if gc and gc.lower() not in GC_OPTIONS:
+            raise ValueError("Unknown gc of resource profile %s: %s (known: %s)"
+                             % (name, gc, ", ".join(sorted(GC_OPTIONS))))
+        for key in ["heap", "max-heap"]:
+            if settings.get(key):
+                parse_memory(settings[key])
+        return cls(name, settings)
+
+    def heap(self, jobs=1):
+        if self.settings.get("heap"):
+            return parse_memory(self.settings["heap"])
+        if not self.memory:
+            return FALLBACK_HEAP
+        heap = int(self.memory * self.settings.get("heap-fraction", 0.5) / max(1, jobs))
+        if self.settings.get("max-heap"):
+            heap = min(heap, parse_memory(self.settings["max-heap"]))
+        return max(heap, MIN_HEAP)
+
+    def artifact_threads(self, jobs=1):
+        threads = self.settings.get("artifact-threads", 4)
+        if threads == "auto":
+            return max(2, min(16, self.cpus * 2 // max(1, jobs)))
+        return int(threads)
+
+    def threads(self, jobs=1):
+        """Maven -T value, or None for Maven's default."""
+        threads = self.settings.get("threads")
+        if threads == "auto":
+            return str(max(1, self.cpus // max(1, jobs)))
+        if threads is None:
+            return None
+        return str(threads)
+
+    def maven_opts(self, jobs=1):
+        opts = ["-Dmaven.artifact.threads=%d" % self.artifact_threads(jobs),
+                "-Xmx%dm" % (self.heap(jobs) // (1024 * 1024))]
+        gc = self.settings.get("gc")
+        if gc:
+            opts.append(GC_OPTIONS[gc.lower()])
+        return " ".join(opts)
@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Lines of output kept per task for the error report
+TAIL_LINES = 10
+
+
+class TaskResult(object):
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.exc_info = None
+        self.elapsed = 0
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+
+    @property
+    def failed(self):
+        return self.exc_info is not None or bool(self.result)
+
+    @property
+    def error(self):
+        """One line saying why the task failed."""
+        if self.exc_info is not None:
+            exc = self.exc_info[1]
+            if not isinstance(exc, SystemExit):
+                return "%s: %s" % (type(exc).__name__, exc)
+            if isinstance(exc.code, basestring):
+                return exc.code
+        if self.tail:
+            return self.tail[-1]
+        return "no output"
+
+
+class TaskDisplay(object):
+    """Stand-in for sys.stdout while tasks run in threads.
+
+    Complete lines are printed prefixed with the name of the task that
+    wrote them. On a terminal, a status line per task showing its latest
+    output, such as download progress, stays below them."""
+
+    def __init__(self, stream, names, live):
+        self.stream = stream
+        self.live = live
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.pending = {}
+        self.status = collections.OrderedDict((name, "waiting") for name in names)
+        self.tails = dict((name, collections.deque(maxlen=TAIL_LINES)) for name in names)
+        self.width = max(len(name) for name in names)
+        self.columns = int(os.environ.get("COLUMNS", 80)) - 1
+        self.shown = 0
+
+    def register(self, name):
+        """Attribute what the calling thread writes to task `name`, or with
+        None, to no task."""
+        with self.lock:
+            if name is None:
+                self.threads.pop(threading.current_thread().ident, None)
+            else:
+                self.threads[threading.current_thread().ident] = name
+
+    def isatty(self):
+        # Progress lines are worth writing when there are status lines to
+        # show them in
+        return self.live
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def write(self, text):
+        with self.lock:
+            name = self.threads.get(threading.current_thread().ident)
+            lines = (self.pending.get(name, "") + text).split("\n")
+            # Only the text after the last carriage return is still visible
+            self.pending[name] = lines.pop().rsplit("\r", 1)[-1]
+            self._clear()
+            for line in lines:
+                line = line.rsplit("\r", 1)[-1].rstrip()
+                # Also skip the rulers of headers, which only add noise
+                # when the output of several tasks is mixed
+                if not line.strip("*"):
+                    continue
+                if name is None:
+                    self.stream.write(line + "\n")
+                    continue
+                self.stream.write("%-*s | %s\n" % (self.width, name, line))
+                self.tails[name].append(line)
+                self.status[name] = line
+            if name is not None and self.pending[name].strip():
+                self.status[name] = self.pending[name].strip()
+            self._draw()
+
+    def set_status(self, name, status):
+        with self.lock:
+            self._clear()
+            self.status[name] = status
+            self._draw()
+
+    def _clear(self):
+        if self.shown:
+            # Back to the first status line and erase to the end
+            self.stream.write("\x1b[%dA\x1b[J" % self.shown)
+            self.shown = 0
+
+    def _draw(self):
+        if not self.live:
+            return
+        for name, status in self.status.items():
+            self.stream.write(("%-*s : %s" % (self.width, name, status))[:self.columns] + "\n")
+        self.shown = len(self.status)
+        self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self._clear()
+            for name, rest in self.pending.items():
+                if rest.strip():
+                    self.stream.write(rest.strip() + "\n" if name is None else
+                                      "%-*s | %s\n" % (self.width, name, rest.strip()))
+            self.pending = {}
+            self.stream.flush()
+
+
+def is_live(stream):
+    """Whether status lines can be redrawn on `stream`."""
+    return stream.isatty() and os.environ.get("TERM") != "dumb"
+
+
+@contextlib.contextmanager
+def task_display(names):
+    """Replace sys.stdout with a TaskDisplay for tasks `names` while in the
+    block."""
+    stdout = sys.stdout
+    display = TaskDisplay(stdout, names, live=is_live(stdout))
+    sys.stdout = display
+    try:
+        yield display
+    finally:
+        display.close()
+        sys.stdout = stdout
+
+
+def run_tasks(tasks):
+    """Run `tasks`, `(name, func)` pairs, each in a thread of its own while
+    showing their output through a TaskDisplay.
+
+    Returns a TaskResult per task, in the order of `tasks`."""
+    results = collections.OrderedDict((name, TaskResult(name)) for name, _ in tasks)
+
+    def run(display, name, func):
+        display.register(name)
+        display.set_status(name, "running")
+        task = results[name]
+        start = time.time()
+        try:
+            task.result = func()
+        except BaseException:
+            # Including SystemExit: a task calling sys.exit() must not end
+            # the process while the others are half done
+            task.exc_info = sys.exc_info()
+        task.elapsed = time.time() - start
+        task.tail = display.tails[name]
+        display.set_status(name, "%s after %.1fs" % ("failed" if task.failed else "done",
+                                                    task.elapsed))
+
+    with task_display(list(results)) as display:
+        threads = [threading.Thread(target=run, args=(display,) + task) for task in tasks]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Joining with a timeout keeps Ctrl+C working
+            while thread.is_alive():
+                thread.join(0.5)
+    return list(results.values())
+
+
+def report(results):
+    """Print how each task went and the last output of those that failed.
+    Returns whether all succeeded."""
+    width = max(len(task.name) for task in results)
+    for task in results:
+        print("%-*s  %s after %.1fs" % (width, task.name, "FAILED" if task.failed else "done",
+                                        task.elapsed))
+    failed = [task for task in results if task.failed]
+    for task in failed:
+        print()
+        print("%s failed: %s" % (task.name, task.error))
+        for line in task.tail:
+            print("    " + line)
+    return not failed
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import collections
+import json
+import os
+import os.path as path
+import re
+import xml.etree.ElementTree as ElementTree
+
+from vaani.locks import FileLock
+
+# Test classes Surefire runs by default
+TEST_CLASS_FILE = re.compile(r"^(Test\w*|\w+Test|\w+Tests|\w+TestCase)\.java$")
+
+# Seconds assumed for a test class that never ran, if no class ever did
+DEFAULT_TEST_TIME = 1.0
+
+TestClass = collections.namedtuple("TestClass", ["repo", "module", "name"])
+
+
+def discover(repo, root_module):
+    """The test classes Surefire would run in the module tree of `repo`
+    rooted at `root_module`, sorted by name."""
+    tests = []
+    for module in root_module.walk():
+        test_dir = path.join(module.dir, "src", "test", "java")
+        for root, dirs, files in os.walk(test_dir):
+            for name in files:
+                if not TEST_CLASS_FILE.match(name):
+                    continue
+                file_path = path.join(root, name)
+                with open(file_path) as f:
+                    source = f.read()
+                if re.search(r"\babstract\s+class\s+%s\b" % re.escape(name[:-5]), source):
+                    continue
+                rel_path = path.relpath(file_path, test_dir)[:-5]
+                tests.append(TestClass(repo, module, rel_path.replace(os.sep, ".")))
+    return sorted(tests, key=lambda test: test.name)
+
+
+def report_path(test):
+    """Where Surefire writes the report of `test`."""
+    return path.join(test.module.build_dir, "surefire-reports", "TEST-%s.xml" % test.name)
+
+
+class TestTimes(object):
+    """Seconds each test class took when it last ran, by class name,
+    stored as JSON."""
+
+    def __init__(self, times_path):
+        self.path = times_path
+        self.reload()
+
+    def reload(self):
+        try:
+            self.times = read_times(self.path)
+        except (IOError, ValueError):
+            self.times = {}
+        known = sorted(self.times.values())
+        # What a class that never ran is expected to take
+        self.default = known[len(known) // 2] if known else DEFAULT_TEST_TIME
+
+    def estimate(self, name):
+        return self.times.get(name, self.default)
+
+    def update(self, times):
+        # Other processes may record the times of other classes
+        with FileLock(self.path + ".lock"):
+            self.reload()
+            self.times.update(times)
+            write_times(self.path, self.times)
+
+
+def write_times(times_path, times):
+    times_dir = path.dirname(path.abspath(times_path))
+    if not path.isdir(times_dir):
+        os.makedirs(times_dir)
+    tmp_path = times_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(times, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, times_path)
+
+
+def shard_times_path(times_path, index, count):
+    """Where a run of shard `index` of `count` writes the times it
+    measured, e.g. test-times-2-of-4.json next to test-times.json. The
+    times the shards were planned with must not change until all of them
+    ran, or they would not agree on which shard runs which class."""
+    root, ext = path.splitext(times_path)
+    return "%s-%d-of-%d%s" % (root, index, count, ext or ".json")
+
+
+def read_times(times_path):
+    """The times of a file written by `write_times`."""
+    with open(times_path) as f:
+        times = json.load(f)
+    if not isinstance(times, dict):
+        raise ValueError("%s is not a JSON object" % times_path)
+    return times
+
+
+def split(tests, count, times):
+    """Deal `tests` into `count` shards taking about as long: the longest
+    test class first, each onto the shard with the least estimated time
+    so far. The same tests and times always give the same shards, so that
+    separate invocations can each run one of them.
+
+    Returns a list of `(tests, estimated seconds)` tuples."""
+    shards = [([], [0.0]) for _ in range(count)]
+    for test in sorted(tests, key=lambda test: (-times.estimate(test.name), test.name)):
+        shard_tests, load = min(shards, key=lambda shard: shard[1][0])
+        shard_tests.append(test)
+        load[0] += times.estimate(test.name)
+    return [(sorted(shard_tests, key=lambda test: test.name), load[0])
+            for shard_tests, load in shards]
+
+
+def read_report(report_file):
+    """The <testsuite> element of a Surefire report, or None if there is
+    no readable report."""
+    try:
+        return ElementTree.parse(report_file).getroot()
+    except (IOError, ElementTree.ParseError):
+        return None
+
+
+def merge_reports(suites, output_path):
+    """Write the <testsuite> elements `suites` into one JUnit XML file.
+    Returns the totals, as a dictionary of "tests", "failures", "errors",
+    "skipped" and "time"."""
+    totals = collections.OrderedDict((key, 0) for key in ["tests", "failures", "errors", "skipped"])
+    totals["time"] = 0.0
+    root = ElementTree.Element("testsuites")
+    for suite in suites:
+        for key in totals:
+            try:
+                totals[key] += (float if key == "time" else int)(suite.get(key, 0))
+            except ValueError:
+                pass
+        root.append(suite)
+    for key, value in totals.items():
+        root.set(key, "%.3f" % value if key == "time" else str(value))
+    output_dir = path.dirname(path.abspath(output_path))
+    if not path.isdir(output_dir):
+        os.makedirs(output_dir)
+    ElementTree.ElementTree(root).write(output_path, encoding="UTF-8")
+    return totals
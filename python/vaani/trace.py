@@ -0,0 +1,171 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+# Records timed spans of what mach spends its time on, written as a Chrome
+# trace-event file that chrome://tracing and Perfetto open. None unless
+# mach runs with --profile, in which case the functions below cost next
+# to nothing.
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self, output_path, start_time=None, python_profile=False):
+        self.path = output_path
+        self.start_time = start_time or time.time()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+        # Spans begun but not ended yet, of each thread, innermost last
+        self.open = {}
+        self.profile = None
+        if python_profile:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def _now(self):
+        # Trace timestamps are in microseconds
+        return (time.time() - self.start_time) * 1e6
+
+    def add(self, event, thread=None):
+        thread = thread or threading.current_thread()
+        event.update({"pid": self.pid, "tid": thread.ident})
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+
+    def complete(self, name, category, start, end, args=None, thread=None):
+        """Record a span from `start` to `end`, in seconds since the epoch."""
+        self.add({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.start_time) * 1e6,
+            "dur": (end - start) * 1e6,
+            "args": args or {},
+        }, thread)
+
+    def begin(self, name, category, args=None):
+        """Start a span of the current thread, recorded by `end`, or by
+        `write` if it never ends, e.g. because the command raised."""
+        thread = threading.current_thread()
+        with self.lock:
+            self.open.setdefault(thread.ident, []).append(
+                (name, category, time.time(), args or {}, thread))
+
+    def end(self, name, category):
+        with self.lock:
+            spans = self.open.get(threading.current_thread().ident, [])
+            for i in reversed(range(len(spans))):
+                if spans[i][:2] == (name, category):
+                    name, category, start, args, thread = spans.pop(i)
+                    break
+            else:
+                return
+        self.complete(name, category, start, time.time(), args, thread)
+
+    def write(self):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path + ".pstats")
+        end = time.time()
+        with self.lock:
+            unfinished = [span for spans in self.open.values() for span in spans]
+            self.open = {}
+        for name, category, start, args, thread in unfinished:
+            self.complete(name, category, start, end, dict(args, unfinished=True), thread)
+        with self.lock:
+            events = list(self.events)
+            events += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                        "args": {"name": name}} for tid, name in self.threads.items()]
+        events.append({"name": "process_name", "ph": "M", "pid": self.pid,
+                       "args": {"name": "mach " + " ".join(sys.argv[1:])}})
+        output_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def start(output_path, start_time=None, python_profile=False):
+    """Start recording spans, to be written to `output_path` by `finish`.
+    With `python_profile`, the Python code of the main thread also runs
+    under cProfile, whose statistics go next to the trace."""
+    global _tracer
+    _tracer = Tracer(output_path, start_time, python_profile)
+    return _tracer
+
+
+def finish():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    tracer.write()
+    sys.stderr.write("Trace written to %s; open it in chrome://tracing or ui.perfetto.dev.\n"
+                     % tracer.path)
+    if tracer.profile is not None:
+        sys.stderr.write("Python profile written to %s.pstats.\n" % tracer.path)
+
+
+def active():
+    return _tracer is not None
+
+
+def complete(name, category, start, end, **args):
+    if _tracer is not None:
+        _tracer.complete(name, category, start, end, args)
+
+
+def begin(name, category="mach", **args):
+    if _tracer is not None:
+        _tracer.begin(name, category, args)
+
+
+def end(name, category="mach"):
+    if _tracer is not None:
+        _tracer.end(name, category)
+
+
+@contextlib.contextmanager
+def span(name, category="mach", **args):
+    """Record the time spent in the block."""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        tracer.complete(name, category, start_time, time.time(), args)
+
+
+def traced(category, label=None):
+    """Decorator recording each call as a span named after the function
+    and, if given, the value of its argument `label`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            name = func.__name__
+            if label is not None:
+                name += " " + unicode(inspect.getcallargs(func, *args, **kwargs)[label])
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from __future__ import print_function, unicode_literals
+
+import os.path as path
+import re
+import shutil
+
+from mach.decorators import (
+    CommandArgument,
+    CommandProvider,
+    Command,
+    SubCommand
+)
+
+from vaani.command_base import *
+from vaani import gitutil, overlay
+from vaani.download import format_size
+
+# Also the value of VAANI_WORKSPACE, so kept to what is safe in a path
+WORKSPACE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+class WorkspaceContext(object):
+    """Command context of another workspace than the one mach runs in."""
+
+    def __init__(self, topdir, workspace, command_loader):
+        self.topdir = topdir
+        self.workspace = workspace
+        self.command_loader = command_loader
+
+
+@CommandProvider
+class MachCommands(CommandBase):
+    def open_workspace(self, name):
+        """The commands of workspace `name`."""
+        return CommandBase(WorkspaceContext(self.context.topdir, name,
+                                            getattr(self.context, "command_loader", None)))
+
+    @Command('workspace',
+             description='List the workspaces: checkouts in ws/ sharing the Maven repository '
+                         'and the caches. Run mach with VAANI_WORKSPACE=<name> to work in one.',
+             category='bootstrap')
+    def workspace(self):
+        names = self.workspaces()
+        if not names:
+            print("No workspaces; create one with |workspace create <name>|.")
+            return 0
+        for name in names:
+            workspace = self.open_workspace(name)
+            branches = set()
+            for repo in workspace.context.repos:
+                repo_dir = path.join(workspace.context.git_dir, repo)
+                try:
+                    branches.add(gitutil.current_branch(repo_dir) or "detached")
+                except gitutil.GitError:
+                    pass
+            print("%s%-16s %-24s %s of its own  %s" % (
+                "*" if name == self.context.workspace else " ", name,
+                ", ".join(sorted(branches)) or "-",
+                format_size(overlay.private_size(workspace.context.m2repo_dir)),
+                workspace.context.local_dir))
+
+    @SubCommand('workspace', 'create',
+                description='Clone the repositories into a new workspace and link the shared '
+                            'Maven repository into it')
+    @CommandArgument('name')
+    @CommandArgument('--branch', '-b',
+                     default=None,
+                     help='Branch to check out in every repository that has it')
+    @CommandArgument('--jobs', '-j',
+                     type=int, default=None,
+                     help='Number of repositories to clone concurrently (default: all)')
+    def workspace_create(self, name, branch=None, jobs=None):
+        if not WORKSPACE_NAME.match(name):
+            print("Invalid workspace name: %s" % name)
+            return 1
+        if name in self.workspaces():
+            print("Workspace %s already exists." % name)
+            return 1
+        workspace = self.open_workspace(name)
+        # Clones from the shared git mirrors, so only new commits are fetched
+        if workspace.dispatch("bootstrap-git", repository="all", jobs=jobs):
+            shutil.rmtree(workspace.context.local_dir, ignore_errors=True)
+            return 1
+        if branch:
+            env = self.build_env()
+            for repo in workspace.context.repos:
+                try:
+                    gitutil.checkout(path.join(workspace.context.git_dir, repo), branch, env=env)
+                except gitutil.GitError:
+                    print("%s has no branch %s; staying on its default branch." % (repo, branch))
+        # Bootstraps Maven and the shared repository where needed, then
+        # builds the overlay
+        workspace.ensure_bootstrapped()
+        print("Created workspace %s in %s." % (name, workspace.context.local_dir))
+        print("Use it with: export VAANI_WORKSPACE=%s" % name)
+
+    @SubCommand('workspace', 'refresh',
+                description='Link what changed in the shared Maven repository into workspaces')
+    @CommandArgument('names',
+                     nargs='*', metavar='NAME',
+                     help='Workspaces to refresh (default: all)')
+    def workspace_refresh(self, names=None):
+        known = self.workspaces()
+        unknown = [name for name in names or [] if name not in known]
+        if unknown:
+            print("Unknown workspaces: %s" % ", ".join(unknown))
+            return 1
+        for name in names or known:
+            self.open_workspace(name).update_overlay()
+
+    @SubCommand('workspace', 'remove',
+                description='Delete a workspace, including its checkouts and what it built')
+    @CommandArgument('name')
+    def workspace_remove(self, name):
+        if name not in self.workspaces():
+            print("Unknown workspace: %s" % name)
+            return 1
+        workspace_dir = path.join(self.context.ws_dir, name)
+        shutil.rmtree(workspace_dir)
+        print("Removed %s." % workspace_dir)